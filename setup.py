@@ -21,6 +21,9 @@ setup(
     packages = ['srastream'],
     scripts = ['bin/sra_dump'],
     install_requires = ['xphyle'],
+    extras_require = {
+        'columnar': ['numpy']
+    },
     tests_require = ['pytest', 'pytest-cov'],
     classifiers=[
         'Development Status :: 3 - Alpha',
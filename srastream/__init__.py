@@ -1,16 +1,52 @@
 """Create iterators over batches of reads from an SRA accession.
 """
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+import copy
+import functools
+import itertools
+import json
+import os
+import queue
+import random
+import re
+import shutil
+import socket
+import threading
+import time
 from ngs import NGS
 from ngs.Read import Read
 # Import members of .utils and .writers to make them available from the
 # top-level module.
 # pylint: disable=wildcard-import
+from .alignments import *
+from .alignments import _worker_read_collection
+from .cache import *
 from .utils import *
+from .workqueue import *
 from .writers import *
 from ._version import get_versions
 __version__ = get_versions()['version']
 del get_versions
 
+READ_CATEGORIES = {
+    'all': Read.all,
+    'aligned': Read.aligned,
+    'fully_aligned': Read.fullyAligned,
+    'partially_aligned': Read.partiallyAligned,
+    'unaligned': Read.unaligned
+}
+"""Names of the NGS read categories that can be used to filter reads."""
+
+READ_FIELDS = ('name', 'bases', 'qualities')
+"""Names of the fields of each fragment tuple, which can be projected to avoid
+fetching fields that are not needed."""
+
+READ_COLLECTION_POOL = HandlePool(NGS.openReadCollection)
+"""The pool of read collections shared by all SraReaders in this process.
+Its `max_open` and `idle_timeout` attributes may be changed to tune the
+pool."""
+
 # TODO: [JD] Incoprorate Popen hacks from
 # https://github.com/brentp/toolshed/blob/master/toolshed/files.py
 # https://github.com/wal-e/wal-e/blob/master/wal_e/pipebuf.py
@@ -23,6 +59,74 @@ class SraReader(object):
         accn: The accession number
         batch_iterator: An iterator over indexes of batches to fetch. Typically,
             this is created using a :class:`srastream.utils.Batcher`.
+        workers: Number of worker processes to use for fetching batches. If
+            None or < 2, batches are fetched serially in the current process.
+            Otherwise, each worker opens its own read collection and fetches
+            the batches it is assigned; reads are still yielded in the same
+            order as the serial path. Cannot be used with an adaptive
+            Batcher.
+        max_in_flight: The maximum number of batches that may be fetched but
+            not yet consumed when `workers` > 1. Defaults to 2 * workers.
+        speculate: When `workers` > 1, re-issue a batch on another worker if
+            it takes more than this many times the median batch fetch time,
+            and use whichever copy finishes first (see
+            :func:`srastream.utils.ordered_map`). None disables speculation.
+        prefetch: The number of batches to fetch ahead on a background thread
+            while the current batch is being consumed. If None or 0, batches
+            are fetched on demand. Ignored when `workers` > 1, since worker
+            processes already fetch ahead up to `max_in_flight` batches.
+        fixed_layout: Whether all spots in the run have the same fragment
+            layout (number and lengths of fragments). If True, the layout is
+            determined from the first spot in `start()`, and the bases and
+            qualities of each spot are then fetched once and split into
+            fragments locally, which requires far fewer calls into the NGS
+            library. Spots whose total length does not match the layout fall
+            back to fetching each fragment separately.
+        metadata_cache: A :class:`srastream.cache.MetadataCache`, or True to
+            use a MetadataCache in the default location. If specified, the run
+            metadata is read from the cache when available rather than being
+            fetched from SRA in `start()`.
+        batch_cache: A :class:`srastream.cache.BatchCache`, or True to use a
+            BatchCache in the default location. If specified, batches are
+            served from the cache when available, and fetched batches are
+            added to the cache.
+        read_collection_pool: The :class:`srastream.utils.HandlePool` from
+            which to acquire the read collection, so that readers of the same
+            accession can share an open read collection. Defaults to
+            READ_COLLECTION_POOL. If False, the read collection is opened in
+            `start()` and closed in `finish()`.
+        sample: A :class:`srastream.utils.Sampler`. If specified, only a
+            random sample of reads is fetched, and `batch_iterator` is
+            ignored, except that if it is a sharded Batcher, only its shard of
+            the sampled ranges is fetched (see
+            :meth:`srastream.utils.Batcher.shard`). Sharding a sample requires
+            the Sampler to have a seed, so that every shard draws the same
+            sample.
+        skip_batches: The number of batches to skip, e.g. when resuming an
+            interrupted dump.
+        category: The name of the category of reads to fetch (one of the keys
+            of READ_CATEGORIES). Filtering is done by the NGS library, so reads
+            in other categories are never fetched. Batches are still defined
+            in terms of all reads, so a batch may contain fewer reads than the
+            batch size. Random access (indexing, slicing and `sample`) is only
+            supported for 'all'.
+        fields: The fields (a subset of READ_FIELDS) to fetch, or None to
+            fetch all fields. Fields that are not fetched are None in the
+            fragment tuples, e.g. ``fields=('name', 'bases')`` yields
+            (name, bases, None) fragments and skips fetching qualities. The
+            bases are always fetched. Typically this is the `fields`
+            attribute of the writer the reads will be passed to.
+        read_groups: Whether to fetch the read group of each spot. If True,
+            each read is yielded as a tuple (read_group, read) rather than
+            just the read.
+        metrics: A :class:`srastream.utils.Metrics` in which to record the
+            time spent opening the read collection ('open'), fetching
+            metadata ('metadata') and batches ('fetch', and within that
+            'read_range' and 'decode'), and, when fetching in parallel or
+            ahead, waiting for batches ('fetch_wait'), along with counts of
+            calls into the NGS library ('native_calls') and batch cache
+            misses ('batch_cache_misses'). Worker processes return their
+            measurements with each batch, and these are recorded here.
         batcher_args: If `batch_iterator` is None, these arguments are used to
             create a Batcher.
     
@@ -32,6 +136,19 @@ class SraReader(object):
             for reads in reader:
                 print("\n".join(str(read) for read in reads))
         
+        # Fetch batches in parallel using 4 worker processes
+        with SraReader(accn, workers=4, batch_size=10000) as reader:
+            for reads in reader:
+                print("\n".join(str(read) for read in reads))
+        
+        # Random access
+        with SraReader(accn) as reader:
+            print("{} reads".format(len(reader)))
+            first = reader[0]
+            # slices are lazy; reads are only fetched when iterated
+            for reads in reader[1000:2000:10]:
+                print("\n".join(str(read) for read in reads))
+        
         # Use manually
         batch_iterator = Batcher(batch_size=1000)
         reader = SraReader(accn, batch_iterator)
@@ -42,15 +159,60 @@ class SraReader(object):
             for reads in reader:
                 print("\n".join(str(read) for read in reads))
         finally:
-            reader.close()
+            reader.finish()
     """
-    def __init__(self, accn, batch_iterator=None, **batcher_args):
+    def __init__(
+            self, accn, batch_iterator=None, workers=None, max_in_flight=None,
+            speculate=None, prefetch=None, fixed_layout=False, metadata_cache=None,
+            batch_cache=None, read_collection_pool=None, sample=None,
+            skip_batches=0, category='all', fields=None, read_groups=False,
+            metrics=None, **batcher_args):
         self.accn = accn
         self.batch_iterator = batch_iterator or Batcher(**batcher_args)
+        if (workers and workers > 1 and
+                getattr(self.batch_iterator, 'adaptive', False)):
+            # adaptive batches are sized from the time between batches being
+            # requested, but the workers request batches ahead of fetching
+            # them, so batch sizes would grow without bound
+            raise ValueError(
+                "Adaptive batch sizes cannot be used with multiple workers")
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.speculate = speculate
+        self.prefetch = prefetch
+        self.fixed_layout = fixed_layout
+        if metadata_cache is True:
+            metadata_cache = MetadataCache()
+        self.metadata_cache = metadata_cache
+        if batch_cache is True:
+            batch_cache = BatchCache()
+        self.batch_cache = batch_cache
+        if read_collection_pool is None:
+            read_collection_pool = READ_COLLECTION_POOL
+        elif read_collection_pool is False:
+            read_collection_pool = None
+        self.read_collection_pool = read_collection_pool
+        if (sample and sample.seed is None and
+                getattr(self.batch_iterator, 'num_shards', 1) > 1):
+            # every shard must draw the same sample
+            raise ValueError("Sharding a sample requires a seed")
+        self.sample = sample
+        self.skip_batches = skip_batches
+        if category not in READ_CATEGORIES:
+            raise ValueError("Invalid read category {}".format(category))
+        if sample and category != 'all':
+            raise ValueError("Cannot sample reads from category {}".format(
+                category))
+        self.category = category
+        self.fields = _project_fields(fields)
+        self.read_groups = read_groups
+        self.metrics = metrics
         self.read_collection = None
         self.run_name = None
         self.read_count = None
         self.frag_count = None
+        self.read_lengths = None
+        self.frag_lengths = None
     
     def __enter__(self):
         self.start()
@@ -62,29 +224,262 @@ class SraReader(object):
     def __iter__(self):
         if self.read_collection is None:
             raise ValueError("Must call start() first")
-        for _, start, size in self.batch_iterator(total=self.read_count):
-            with self.read_collection.getReadRange(start + 1, size, Read.all) as read:
-                for _ in range(size):
-                    read.nextRead()
-                    yield sra_reads(read)
+        for reads in self.iter_batches():
+            yield from reads
+    
+    def __len__(self):
+        if self.read_count is None:
+            raise ValueError("Must call start() first")
+        return self.read_count
+    
+    def __getitem__(self, key):
+        """Get a single read by (0-based) index, or a lazy
+        :class:`SraSlice` of reads.
+        """
+        if self.read_collection is None:
+            raise ValueError("Must call start() first")
+        if self.category != 'all':
+            raise ValueError("Random access requires category 'all'")
+        if isinstance(key, slice):
+            return SraSlice(self, range(self.read_count)[key])
+        index = range(self.read_count)[key]
+        return self.fetch_range(index, 1)[0]
+    
+    def iter_batches(self):
+        """Iterate over whole batches of reads. This avoids the overhead of
+        yielding one read at a time, and is the preferred method of iteration
+        when reads are processed in bulk (e.g. with
+        :meth:`srastream.writers.BatchWriter.write_batch`). Batches are
+        fetched using worker processes or a background thread if so configured.
+        
+        Yields:
+            Lists of :func:`sra_reads` tuples, one per batch, in batch order.
+        """
+        if self.read_collection is None:
+            raise ValueError("Must call start() first")
+        yield from self._iter_fetched(
+            lambda start, size, members: select_reads(
+                self.fetch_range(start, size), start, members),
+            functools.partial(
+                _fetch_batch_worker, fragment_lengths=self.frag_lengths,
+                batch_cache=self.batch_cache, category=self.category,
+                fields=self.fields, read_groups=self.read_groups))
+    
+    def _iter_fetched(self, fetch, worker):
+        """Fetch the batch ranges using worker processes or a background
+        thread if so configured.
+        
+        Args:
+            fetch: Function that fetches a range in the current process,
+                given (start, size, members).
+            worker: Picklable function that fetches a range in a worker
+                process, given (accn, start, size, members). If the reader
+                has metrics, it is also passed ``metrics=True``, and must
+                return a tuple (result, :class:`srastream.utils.MetricsLog`).
+        
+        Yields:
+            The result of fetching each range, in batch order.
+        """
+        ranges = self.iter_ranges()
+        if self.workers and self.workers > 1:
+            if self.metrics is not None:
+                worker = functools.partial(worker, metrics=True)
+            fetched = self._fetch_parallel(
+                worker,
+                ((self.accn, start, size, members)
+                 for start, size, members in ranges))
+            if self.metrics is not None:
+                fetched = _merge_worker_metrics(fetched, self.metrics)
+        else:
+            fetched = (
+                fetch(start, size, members) for start, size, members in ranges)
+            if not self.prefetch:
+                yield from fetched
+                return
+            fetched = prefetch(fetched, self.prefetch)
+        if self.metrics is not None:
+            fetched = timed_batches(fetched, self.metrics, 'fetch_wait')
+        yield from fetched
+    
+    def iter_ranges(self):
+        """Iterate over the read ranges to fetch, from either the sampler or
+        the batch iterator, after sharding and skipping batches. This allows
+        batches to be fetched by other means (e.g.
+        :class:`srastream.aio.AsyncSraReader`) using :meth:`fetch_range` and
+        :func:`select_reads`.
+        
+        Yields:
+            Tuples (start, size, members), where members is None if all reads
+            in the range are wanted, otherwise the list of wanted read indices.
+        """
+        if self.read_collection is None:
+            raise ValueError("Must call start() first")
+        if self.sample:
+            ranges = (
+                (start, size, members)
+                for _, start, size, members in self.sample(
+                    self.read_count, sum(self.read_lengths)))
+            if hasattr(self.batch_iterator, 'shard'):
+                ranges = self.batch_iterator.shard(ranges)
+        else:
+            ranges = (
+                (start, size, None)
+                for _, start, size in self.batch_iterator(
+                    total=self.read_count))
+        if self.skip_batches:
+            ranges = itertools.islice(ranges, self.skip_batches, None)
+        return ranges
+    
+    def iter_columnar(self):
+        """Iterate over batches of reads in columnar form. Requires numpy.
+        
+        The names, bases and qualities of each batch are collected directly
+        into buffers as the reads are fetched (see :func:`fetch_columnar`),
+        without creating per-read tuples. Batches served from the batch
+        cache and sampled batches are instead converted from reads.
+        
+        Yields:
+            One :class:`srastream.utils.ColumnarBatch` per batch.
+        """
+        if self.read_collection is None:
+            raise ValueError("Must call start() first")
+        if self.fields is not None and 'qualities' not in self.fields:
+            raise ValueError("Columnar batches require qualities")
+        if self.read_groups:
+            raise ValueError("Columnar batches do not include read groups")
+        if self.batch_cache or self.sample:
+            for reads in self.iter_batches():
+                yield ColumnarBatch.from_reads(reads)
+            return
+        metrics = self.metrics
+        def fetch(start, size, members):
+            if metrics is not None:
+                started = time.perf_counter()
+            batch = fetch_columnar(
+                self.read_collection, start, size, self.frag_lengths,
+                READ_CATEGORIES[self.category], metrics)
+            if metrics is not None:
+                metrics.record(
+                    'fetch', time.perf_counter() - started, len(batch))
+            return batch
+        yield from self._iter_fetched(
+            fetch,
+            functools.partial(
+                _fetch_columnar_worker, fragment_lengths=self.frag_lengths,
+                category=self.category))
+    
+    def fetch_range(self, start, size, read_collection=None):
+        """Fetch a range of reads in the current process, using the batch
+        cache if there is one.
+        
+        Args:
+            start: The 0-based index of the first read.
+            size: The number of reads.
+            read_collection: The read collection from which to fetch, if not
+                the reader's own (e.g. to fetch from several threads at once).
+        
+        Returns:
+            A list of :func:`sra_reads` tuples.
+        """
+        metrics = self.metrics
+        if read_collection is None:
+            read_collection = self.read_collection
+        def fetch():
+            if metrics is not None and self.batch_cache:
+                metrics.count('batch_cache_misses')
+            return fetch_batch(
+                read_collection, start, size, self.frag_lengths,
+                READ_CATEGORIES[self.category], self.fields,
+                self.read_groups, metrics)
+        if metrics is not None:
+            started = time.perf_counter()
+        if self.batch_cache:
+            reads = self.batch_cache.get_or_fetch(
+                self.accn, start, size, fetch,
+                _cache_variant(self.category, self.fields, self.read_groups))
+        else:
+            reads = fetch()
+        if metrics is not None:
+            metrics.record('fetch', time.perf_counter() - started, len(reads))
+        return reads
+    
+    def _fetch_parallel(self, worker, args):
+        """Fetch batches using a pool of worker processes.
+        
+        Args:
+            worker: The function to call in the worker processes.
+            args: Iterator over tuples of arguments to `worker`.
+        
+        Yields:
+            The result of each call, in batch order.
+        """
+        max_in_flight = self.max_in_flight or (2 * self.workers)
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            yield from ordered_map(
+                executor, worker, args, max_in_flight, self.speculate)
     
     def start(self):
-        """Open the read collection.
+        """Open the read collection and load the run metadata, either from
+        the metadata cache or from SRA.
+        """
+        started = time.perf_counter()
+        if self.read_collection_pool is not None:
+            self.read_collection = self.read_collection_pool.acquire(self.accn)
+        else:
+            self.read_collection = NGS.openReadCollection(self.accn)
+        if self.metrics is not None:
+            self.metrics.record('open', time.perf_counter() - started)
+        metadata = None
+        if self.metadata_cache:
+            metadata = self.metadata_cache.get(self.accn)
+        if metadata is None:
+            started = time.perf_counter()
+            metadata = self._fetch_metadata()
+            if self.metrics is not None:
+                self.metrics.record('metadata', time.perf_counter() - started)
+            if self.metadata_cache:
+                self.metadata_cache.put(self.accn, metadata)
+        self.run_name = metadata['run_name']
+        self.read_count = metadata['read_count']
+        self.frag_count = metadata['frag_count']
+        self.read_lengths = tuple(metadata['read_lengths'])
+        # The fast path can only be used if the fragments account for
+        # all of the bases in the spot (i.e. there are no technical reads).
+        if self.fixed_layout and not metadata['technical_bases']:
+            self.frag_lengths = self.read_lengths
+    
+    def _fetch_metadata(self):
+        """Fetch the run metadata from SRA.
+        
+        Returns:
+            A dict with keys run_name, read_count, frag_count, read_lengths
+            (the fragment lengths of the first spot) and technical_bases
+            (the number of bases in the first spot that are not part of a
+            fragment).
         """
-        self.read_collection = NGS.openReadCollection(self.accn)
-        self.run_name = self.read_collection.getName()
-        self.read_count = self.read_collection.getReadCount()
+        metadata = dict(
+            run_name=self.read_collection.getName(),
+            read_count=self.read_collection.getReadCount())
         # grab the first read use it to determine whether the dataset
         # is single- or paired-end
         with self.read_collection.getReadRange(1, 1, Read.all) as read:
             read.nextRead()
-            self.frag_count = len(sra_reads(read))
+            frags = sra_reads(read)
+            read_lengths = [len(frag[1]) for frag in frags]
+            metadata.update(
+                frag_count=len(frags),
+                read_lengths=read_lengths,
+                technical_bases=len(read.getReadBases()) - sum(read_lengths))
+        return metadata
     
     def finish(self):
-        """Close the read collection.
+        """Close the read collection, or return it to the pool.
         """
         if self.read_collection is not None:
-            self.read_collection.close()
+            if self.read_collection_pool is not None:
+                self.read_collection_pool.release(self.accn)
+            else:
+                self.read_collection.close()
             self.read_collection = None
     
     @property
@@ -104,7 +499,61 @@ class SraReader(object):
                 "to call 'start()' first.".format(name))
         return getattr(self.read_collection, name)
 
-def sra_reads(read, paired=None, expected_fragments=None):
+class SraSlice(object):
+    """A lazy view of a subset of the reads of a started :class:`SraReader`,
+    usually created by slicing the reader. No reads are fetched until the
+    slice is iterated, at which point nearby indices are coalesced into as few
+    getReadRange calls as possible.
+    
+    Args:
+        reader: The SraReader.
+        indices: A range of read indices.
+        max_gap: The maximum number of unwanted reads to fetch between two
+            wanted reads rather than starting a new read range.
+        max_size: The maximum number of reads to fetch with a single
+            getReadRange call.
+    """
+    def __init__(self, reader, indices, max_gap=100, max_size=1000):
+        self.reader = reader
+        self.indices = indices
+        self.max_gap = max_gap
+        self.max_size = max_size
+    
+    def __len__(self):
+        return len(self.indices)
+    
+    def __getitem__(self, key):
+        indices = self.indices[key]
+        if isinstance(key, slice):
+            return SraSlice(self.reader, indices, self.max_gap, self.max_size)
+        return self.reader[indices]
+    
+    def __iter__(self):
+        for reads in self.iter_batches():
+            yield from reads
+    
+    def iter_batches(self):
+        """Iterate over the reads in the slice, one batch per coalesced read
+        range.
+        
+        Yields:
+            Lists of :func:`sra_reads` tuples.
+        """
+        step = self.indices.step
+        ascending = self.indices if step > 0 else self.indices[::-1]
+        ranges = coalesce_ranges(ascending, self.max_gap, self.max_size)
+        if step < 0:
+            ranges = reversed(list(ranges))
+        for start, size, members in ranges:
+            reads = select_reads(
+                self.reader.fetch_range(start, size), start, members)
+            if step < 0:
+                reads.reverse()
+            yield reads
+
+def sra_reads(
+        read, paired=None, expected_fragments=None, fragment_lengths=None,
+        fields=None):
     """Creates sequence of (name, sequence, qualities) tuples from the current
     read of an ngs.ReadIterator. Typically the sequence has one or two tuples
     for single- and paired-end reads, respectively.
@@ -114,37 +563,311 @@ def sra_reads(read, paired=None, expected_fragments=None):
         paired: Whether this is paired-end data.
         expected_fragments: The number of fragments expected for this read. If
             None, fragment number is not validated.
+        fragment_lengths: The expected length of each fragment. If not None,
+            and the read has the expected number of fragments whose lengths sum
+            to the length of the read, the bases and qualities of the whole
+            read are fetched once and split into fragments locally. Otherwise
+            each fragment is fetched separately.
+        fields: The fields (a subset of READ_FIELDS) to fetch, or None to
+            fetch all fields. Fields that are not fetched are None.
     
     Returns:
         The tuple (frag1, frag2...), where each fragment is a tuple 
         (read_name, sequence, qualities).
     """
-    read_name = read.getReadName()
+    get_qualities = fields is None or 'qualities' in fields
+    if fields is None or 'name' in fields:
+        read_name = read.getReadName()
+    else:
+        read_name = None
     num_fragments = read.getNumFragments()
     if expected_fragments and num_fragments != expected_fragments:
         raise Exception("Read {} has fewer than {} fragments".format(
-            read_name, expected_fragments))
+            read.getReadName(), expected_fragments))
     
-    # TODO: extract other useful information such as read group
-    #read_group = read.getReadGroup()
+    if fragment_lengths and num_fragments == len(fragment_lengths):
+        bases = read.getReadBases()
+        if len(bases) == sum(fragment_lengths):
+            qualities = read.getReadQualities() if get_qualities else None
+            frags = []
+            offset = 0
+            for length in fragment_lengths:
+                end = offset + length
+                frags.append((
+                    read_name, bases[offset:end],
+                    qualities[offset:end] if get_qualities else None))
+                offset = end
+            return tuple(frags)
     
     def next_frag():
         """Create (name, bases, qualities) tuple from the next fragment.
         """
         read.nextFragment()
         if paired and not read.isPaired():
-            raise Exception("Read {} is not paired".format(read_name))
+            raise Exception("Read {} is not paired".format(read.getReadName()))
         return (
             read_name,
             read.getFragmentBases(),
-            read.getFragmentQualities())
+            read.getFragmentQualities() if get_qualities else None)
     
     return tuple(next_frag() for i in range(num_fragments))
 
+def fetch_batch(
+        read_collection, start, size, fragment_lengths=None,
+        category=Read.all, fields=None, read_groups=False, metrics=None):
+    """Fetch a batch of reads from a read collection.
+    
+    Args:
+        read_collection: An open NGS ReadCollection.
+        start: The 0-based index of the first read in the batch.
+        size: The number of reads in the batch.
+        fragment_lengths: Expected fragment lengths, passed to
+            :func:`sra_reads`.
+        category: The NGS read category (e.g. Read.unaligned) of reads to
+            fetch. Reads in other categories are skipped by the NGS library,
+            so fewer than `size` reads may be returned.
+        fields: The fields to fetch, passed to :func:`sra_reads`.
+        read_groups: Whether to also fetch the read group of each spot.
+        metrics: A :class:`srastream.utils.Metrics` in which to record the
+            time spent creating the read iterator ('read_range') and
+            iterating over and decoding the reads ('decode'), and the number
+            of calls into the NGS library ('native_calls').
+    
+    Returns:
+        A list of :func:`sra_reads` tuples, or of (read_group, read) tuples
+        if `read_groups` is True.
+    """
+    if metrics is not None:
+        started = time.perf_counter()
+    with read_collection.getReadRange(start + 1, size, category) as read:
+        if metrics is not None:
+            opened = time.perf_counter()
+            metrics.record('read_range', opened - started)
+        reads = []
+        append = reads.append
+        next_read = read.nextRead
+        if read_groups:
+            get_read_group = read.getReadGroup
+            while next_read():
+                append((get_read_group(), sra_reads(
+                    read, fragment_lengths=fragment_lengths, fields=fields)))
+        else:
+            while next_read():
+                append(sra_reads(
+                    read, fragment_lengths=fragment_lengths, fields=fields))
+    if metrics is not None:
+        metrics.record('decode', time.perf_counter() - opened, len(reads))
+        metrics.count('native_calls', _native_calls(
+            reads, fragment_lengths, fields, read_groups))
+    return reads
+
+def fetch_columnar(
+        read_collection, start, size, fragment_lengths=None,
+        category=Read.all, metrics=None):
+    """Fetch a batch of reads from a read collection in columnar form. The
+    name of each read and the bases and qualities of each fragment are
+    collected into buffers as the reads are iterated, without creating
+    per-read tuples.
+    
+    Args:
+        read_collection: An open NGS ReadCollection.
+        start: The 0-based index of the first read in the batch.
+        size: The number of reads in the batch.
+        fragment_lengths: Expected fragment lengths. If not None, the bases
+            and qualities of each read with the expected layout are fetched
+            once rather than per fragment (see :func:`sra_reads`).
+        category: The NGS read category of reads to fetch.
+        metrics: A :class:`srastream.utils.Metrics` in which to record the
+            time spent creating the read iterator ('read_range') and
+            iterating over the reads ('decode').
+    
+    Returns:
+        A :class:`srastream.utils.ColumnarBatch`.
+    """
+    names = []
+    bases = []
+    qualities = []
+    lengths = []
+    num_fragments = []
+    if fragment_lengths:
+        spot_length = sum(fragment_lengths)
+    if metrics is not None:
+        started = time.perf_counter()
+    with read_collection.getReadRange(start + 1, size, category) as read:
+        if metrics is not None:
+            opened = time.perf_counter()
+            metrics.record('read_range', opened - started)
+        while read.nextRead():
+            names.append(read.getReadName())
+            frags = read.getNumFragments()
+            num_fragments.append(frags)
+            if fragment_lengths and frags == len(fragment_lengths):
+                read_bases = read.getReadBases()
+                if len(read_bases) == spot_length:
+                    bases.append(read_bases)
+                    qualities.append(read.getReadQualities())
+                    lengths.extend(fragment_lengths)
+                    continue
+            for _ in range(frags):
+                read.nextFragment()
+                frag_bases = read.getFragmentBases()
+                bases.append(frag_bases)
+                qualities.append(read.getFragmentQualities())
+                lengths.append(len(frag_bases))
+    if metrics is not None:
+        metrics.record('decode', time.perf_counter() - opened, len(names))
+    return ColumnarBatch.from_fragments(
+        names, bases, qualities, lengths, num_fragments)
+
+def _native_calls(reads, fragment_lengths=None, fields=None, read_groups=False):
+    """Count the calls into the NGS library made by :func:`fetch_batch` to
+    fetch a batch of reads. The count is computed from the numbers of reads
+    and fragments rather than by counting each call, and assumes that the
+    fixed layout path of :func:`sra_reads` is taken for every spot when
+    `fragment_lengths` is set.
+    """
+    if read_groups:
+        reads = [read for _, read in reads]
+    get_names = fields is None or 'name' in fields
+    get_qualities = fields is None or 'qualities' in fields
+    # nextRead and getNumFragments, plus getReadName and getReadGroup
+    per_read = 2 + get_names + bool(read_groups)
+    if fragment_lengths:
+        # getReadBases and getReadQualities
+        per_read += 1 + get_qualities
+        per_fragment = 0
+    else:
+        # nextFragment, getFragmentBases and getFragmentQualities
+        per_fragment = 2 + get_qualities
+    num_fragments = sum(map(len, reads)) if per_fragment else 0
+    # getReadRange and the final call to nextRead
+    return 2 + len(reads) * per_read + num_fragments * per_fragment
+
+def _project_fields(fields):
+    """Validate a field projection.
+    
+    Args:
+        fields: Iterable of field names, or None for all fields.
+    
+    Returns:
+        The fields as a tuple in READ_FIELDS order, or None if all fields are
+        selected.
+    """
+    if fields is None:
+        return None
+    fields = set(fields)
+    invalid = fields.difference(READ_FIELDS)
+    if invalid:
+        raise ValueError("Invalid read field(s) {}".format(
+            ', '.join(sorted(invalid))))
+    if 'bases' not in fields:
+        raise ValueError("Read field 'bases' is required")
+    if len(fields) == len(READ_FIELDS):
+        return None
+    return tuple(field for field in READ_FIELDS if field in fields)
+
+def _cache_variant(category, fields=None, read_groups=False):
+    """The batch cache variant for reads of the given category and field
+    projection, with or without read groups.
+    """
+    parts = []
+    if category != 'all':
+        parts.append(category)
+    if fields is not None:
+        parts.extend(fields)
+    if read_groups:
+        parts.append('read_group')
+    return '-'.join(parts) or None
+
+def select_reads(reads, start, members=None):
+    """Select a subset of the reads in a range.
+    
+    Args:
+        reads: The list of reads in the range.
+        start: The index of the first read in the range.
+        members: The indices of the reads to select, or None to select all
+            reads.
+    
+    Returns:
+        The list of selected reads.
+    """
+    if members is None or len(members) == len(reads):
+        return reads
+    return [reads[index - start] for index in members]
+
+def _fetch_batch_worker(
+        accn, start, size, members=None, fragment_lengths=None,
+        batch_cache=None, category='all', fields=None, read_groups=False,
+        metrics=False):
+    """Fetch a batch of reads in a worker process or thread. If `metrics` is
+    True, the measurements recorded by :meth:`SraReader.fetch_range` are
+    returned with the reads as a tuple (reads, MetricsLog).
+    """
+    log = MetricsLog() if metrics else None
+    def fetch():
+        if log is not None and batch_cache:
+            log.count('batch_cache_misses')
+        return fetch_batch(
+            _worker_read_collection(accn), start, size, fragment_lengths,
+            READ_CATEGORIES[category], fields, read_groups, log)
+    if log is not None:
+        started = time.perf_counter()
+    if batch_cache:
+        reads = batch_cache.get_or_fetch(
+            accn, start, size, fetch,
+            _cache_variant(category, fields, read_groups))
+    else:
+        reads = fetch()
+    if log is None:
+        return select_reads(reads, start, members)
+    log.record('fetch', time.perf_counter() - started, len(reads))
+    return select_reads(reads, start, members), log
+
+def _fetch_columnar_worker(
+        accn, start, size, members=None, fragment_lengths=None,
+        category='all', metrics=False):
+    """Fetch a batch of reads in columnar form in a worker process. Members
+    are not supported, since sampled batches are fetched as reads. If
+    `metrics` is True, returns a tuple (batch, MetricsLog).
+    """
+    log = MetricsLog() if metrics else None
+    if log is not None:
+        started = time.perf_counter()
+    batch = fetch_columnar(
+        _worker_read_collection(accn), start, size, fragment_lengths,
+        READ_CATEGORIES[category], log)
+    if log is None:
+        return batch
+    log.record('fetch', time.perf_counter() - started, len(batch))
+    return batch, log
+
+def _merge_worker_metrics(fetched, metrics):
+    """Record the measurements returned by worker processes along with each
+    batch.
+    
+    Args:
+        fetched: Iterator over (batch, MetricsLog) tuples.
+        metrics: The :class:`srastream.utils.Metrics` in which to record
+            the measurements.
+    
+    Yields:
+        The batches.
+    """
+    try:
+        for batch, log in fetched:
+            metrics.merge(log)
+            yield batch
+    finally:
+        if hasattr(fetched, 'close'):
+            fetched.close()
+
 def sra_dump(
         accn, prefix=None, compression=True, fifos=False, batch_size=1000, 
-        **batcher_args):
-    """Convenience method to stream reads from SRA to FASTQ files.
+        workers=None, speculate=None, prefetch=None, fixed_layout=False,
+        metadata_cache=None, batch_cache=None, checkpoint=False, resume=False,
+        sample=None, category='all', output_format='fastq',
+        split_read_groups=False, metrics=None, **batcher_args):
+    """Convenience method to stream reads from SRA to FASTQ (or FASTA) files.
 
     Args:
         accn: SRA accession.
@@ -154,38 +877,679 @@ def sra_dump(
         fifos: Whether output files should be FIFOs. If True, `compression` is
             ignored, and 'pv' must be callable. Can also be a string specifying 
             the program to use for buffering instead of pv.
+        workers: Number of worker processes to use for fetching reads.
+        speculate: Factor of the median batch fetch time after which a
+            straggling batch is re-issued on another worker (see
+            :class:`SraReader`).
+        prefetch: Number of batches to fetch ahead of the writer on a
+            background thread.
+        fixed_layout: Whether all spots have the same fragment layout, which
+            enables faster fetching (see :class:`SraReader`).
+        metadata_cache: A :class:`srastream.cache.MetadataCache`, or True to
+            use the default metadata cache.
+        batch_cache: A :class:`srastream.cache.BatchCache`, or True to use
+            the default batch cache.
+        checkpoint: Whether to record progress in a checkpoint file
+            (<prefix>.checkpoint.json) after each batch is written, so that
+            the dump can be resumed if it fails. Each batch is written as a
+            separate compressed stream (e.g. a gzip member), so finished data
+            never need to be re-compressed. The checkpoint file is removed
+            when the dump completes.
+        resume: Whether to resume from the checkpoint file, if it exists. The
+            output files are truncated to the last checkpointed batch, and
+            streaming continues from the next batch. Implies `checkpoint`. A
+            ValueError is raised if the checkpoint was saved by a dump with
+            different arguments (accession, category, output format,
+            compression, Batcher arguments, or `sample`).
+        sample: A :class:`srastream.utils.Sampler` for dumping a random
+            sample of reads. If `checkpoint` is True and the Sampler has no
+            seed, a random seed is used and saved with the checkpoint, so that
+            the same sample is drawn when the dump is resumed.
+        category: The name of the category of reads to dump (see
+            :class:`SraReader`).
+        output_format: The output format (one of the keys of READ_WRITERS).
+            Only the fields used by the format are fetched, e.g. qualities
+            are not fetched for 'fasta'.
+        split_read_groups: Whether to write the reads of each read group to
+            separate output files (<prefix>.<read_group>.1.fq.gz, etc.) in a
+            single pass. Output files are created as new read groups are
+            encountered. Characters in read group names that are unsafe in
+            file names are replaced with '_', spots without a read group are
+            written to <prefix>._nogroup_.1.fq.gz, and the returned
+            'read_groups' dict gives the files of each read group. Cannot be
+            combined with `fifos` or `checkpoint`.
+        metrics: A :class:`srastream.utils.Metrics` in which to record
+            metrics (see :class:`SraReader`), along with the time spent
+            writing each batch ('write', which includes 'output': the time
+            spent in the string writer, including compression or waiting on
+            FIFO readers) and saving checkpoints ('checkpoint'). If None, a
+            new Metrics is used.
         batcher_args: Specify arguments to the :class:`srastream.utils.Batcher`
-            that will be used for batch iteration.
+            that will be used for batch iteration. If `num_shards` > 1, the
+            output prefix has the suffix .shard<shard_index>of<num_shards>.
     
     Returns:
         A dict containing the output file names ('file1' and 'file2'),
-        and read_count.
+        read_count, and metrics (see :meth:`srastream.utils.Metrics.summary`,
+        plus the overall reads_per_second, and bytes_per_second of
+        uncompressed output). If `split_read_groups` is True, the output file
+        names are instead in 'read_groups', a dict mapping each read group to
+        a dict of its output file names.
     """
-    reader = SraReader(accn, batch_size=batch_size, **batcher_args)
+    if output_format not in READ_WRITERS:
+        raise ValueError("Invalid output format {}".format(output_format))
+    writer_class = READ_WRITERS[output_format]
+    prefix = _shard_prefix(prefix or accn, batcher_args)
+    checkpoint = checkpoint or resume
+    if checkpoint and fifos:
+        raise ValueError("Cannot checkpoint when writing to FIFOs")
+    if checkpoint and batcher_args.get('adaptive'):
+        # resuming relies on batch boundaries being reproducible
+        raise ValueError("Cannot checkpoint with adaptive batch sizes")
+    if split_read_groups and (checkpoint or fifos):
+        raise ValueError(
+            "Cannot checkpoint or write to FIFOs when splitting by read group")
+    
+    if metrics is None:
+        metrics = Metrics()
+    
+    batcher = Batcher(batch_size=batch_size, **batcher_args)
+    if sample and sample.seed is None and batcher.num_shards > 1:
+        raise ValueError("Sharding a sample requires a seed")
+    state = None
+    if checkpoint:
+        checkpoint = Checkpoint('{}.checkpoint.json'.format(prefix))
+        if resume:
+            state = checkpoint.load()
+        if sample and sample.seed is None:
+            sample = _seed_sampler(sample, state)
+        params = _checkpoint_params(
+            accn, batcher, sample, category=category,
+            output_format=output_format,
+            compression='gz' if compression is True else compression)
+        if state:
+            _check_checkpoint(checkpoint, state, params)
+    
+    reader = SraReader(
+        accn, batcher, workers=workers, speculate=speculate,
+        prefetch=prefetch, fixed_layout=fixed_layout,
+        metadata_cache=metadata_cache, batch_cache=batch_cache, sample=sample,
+        skip_batches=state['batches'] if state else 0, category=category,
+        fields=writer_class.fields, read_groups=split_read_groups,
+        metrics=metrics)
+    
+    if split_read_groups:
+        with reader:
+            writer_args = dict(read_groups=_dump_read_groups(
+                reader, prefix, compression, writer_class, batch_size,
+                metrics))
+        writer_args['accn'] = accn
+        writer_args['read_count'] = reader.read_count
+        writer_args['metrics'] = _dump_summary(metrics)
+        return writer_args
+    
     with reader:
-        read_indexes = (1,2) if reader.paired else (1,)
+        writer_args, string_writer = _create_string_writer(
+            prefix, reader.paired, compression, fifos, checkpoint,
+            state['offsets'] if state else None, writer_class.extension)
         
-        writer_args = dict(
-            ('file{}'.format(read), '{}.{}.fq'.format(prefix or accn, read)) 
-            for read in read_indexes)
-        
-        if fifos:
-            if isinstance(fifos, str):
-                writer_args['buffer'] = fifos
-            string_writer = FifoWriter(**writer_args)
-        else:
-            if compression is True:
-                compression = 'gz'
-            if compression:
-                writer_args = dict(
-                    (key, '{}.{}'.format(name, compression)) 
-                    for key, name in writer_args.items())
-            string_writer = FileWriter(**writer_args, compression=compression)
-        
-        with FastqWriter(string_writer, batch_size) as writer:
-            for reads in reader:
-                writer(*reads)
+        with writer_class(string_writer, batch_size) as writer:
+            writer.metrics = metrics
+            if checkpoint:
+                batches = state['batches'] if state else 0
+                reads_written = state['reads'] if state else 0
+                for reads in reader.iter_batches():
+                    started = time.perf_counter()
+                    writer.write_batch(reads)
+                    if writer.index > 0:
+                        writer.flush()
+                    synced = time.perf_counter()
+                    metrics.record('write', synced - started, len(reads))
+                    batches += 1
+                    reads_written += len(reads)
+                    checkpoint.save(
+                        params=params, batches=batches, reads=reads_written,
+                        offsets=string_writer.sync())
+                    metrics.record('checkpoint', time.perf_counter() - synced)
+            else:
+                for reads in reader.iter_batches():
+                    started = time.perf_counter()
+                    writer.write_batch(reads)
+                    metrics.record(
+                        'write', time.perf_counter() - started, len(reads))
+    
+    if checkpoint:
+        checkpoint.remove()
     
     writer_args['accn'] = accn
     writer_args['read_count'] = reader.read_count
+    writer_args['metrics'] = _dump_summary(metrics)
     return writer_args
+
+# Batcher and Sampler attributes that determine which reads are dumped, and
+# so must not change when a checkpointed dump is resumed.
+_CHECKPOINT_BATCHER_ARGS = (
+    'item_start', 'item_stop', 'item_limit', 'batch_start', 'batch_stop',
+    'batch_size', 'batch_step', 'shard_index', 'num_shards', 'shard_mode')
+_CHECKPOINT_SAMPLER_ARGS = (
+    'fraction', 'count', 'coverage', 'genome_size', 'seed', 'item_start',
+    'item_stop', 'max_gap', 'batch_size')
+
+def _checkpoint_params(accn, batcher, sample=None, **params):
+    """The arguments of a checkpointed dump that determine which reads are
+    written and how, which are saved with the checkpoint.
+    
+    Args:
+        accn: The accession.
+        batcher: The :class:`srastream.utils.Batcher`.
+        sample: The :class:`srastream.utils.Sampler`, or None.
+        params: Other JSON-serializable arguments.
+    
+    Returns:
+        A dict.
+    """
+    params['accn'] = accn
+    params.update(
+        (name, getattr(batcher, name)) for name in _CHECKPOINT_BATCHER_ARGS)
+    params['sample'] = dict(
+        (name, getattr(sample, name))
+        for name in _CHECKPOINT_SAMPLER_ARGS) if sample else None
+    return params
+
+def _seed_sampler(sample, state=None):
+    """Copy a Sampler that has no seed, giving it the seed saved with a
+    checkpoint if there is one, otherwise a random seed. A checkpointed dump
+    must draw the same sample when it is resumed.
+    
+    Args:
+        sample: The :class:`srastream.utils.Sampler`.
+        state: The state saved with the checkpoint, or None.
+    
+    Returns:
+        A seeded Sampler.
+    """
+    sample = copy.copy(sample)
+    saved = state.get('params', {}).get('sample') if state else None
+    if saved and saved.get('seed') is not None:
+        sample.seed = saved['seed']
+    else:
+        sample.seed = random.randrange(2 ** 32)
+    return sample
+
+def _check_checkpoint(checkpoint, state, params):
+    """Check that a checkpoint can be resumed.
+    
+    Args:
+        checkpoint: The :class:`srastream.writers.Checkpoint`.
+        state: The state saved with the checkpoint.
+        params: The arguments of the dump being resumed (see
+            :func:`_checkpoint_params`).
+    
+    Raises:
+        ValueError if the checkpoint was saved by a dump with different
+        arguments, since resuming it would append reads that do not match the
+        reads already written.
+    """
+    saved = state.get('params', {})
+    changed = sorted(
+        key for key in set(params).union(saved)
+        if params.get(key) != saved.get(key))
+    if changed:
+        raise ValueError(
+            "Checkpoint {} was saved with different arguments ({}); remove it "
+            "to restart the dump".format(checkpoint.path, ', '.join(changed)))
+
+def _dump_summary(metrics):
+    """Summarize the metrics of a dump, adding the overall throughput in reads
+    and bytes of (uncompressed) output per second.
+    """
+    summary = metrics.summary()
+    stages = summary['stages']
+    elapsed = summary['elapsed']
+    reads = stages['write']['items'] if 'write' in stages else 0
+    nbytes = stages['output']['bytes'] if 'output' in stages else 0
+    summary['reads_per_second'] = reads / elapsed if elapsed else None
+    summary['bytes_per_second'] = nbytes / elapsed if elapsed else None
+    return summary
+
+def _shard_prefix(prefix, batcher_args):
+    """Add the shard to an output prefix if the batches are sharded.
+    """
+    num_shards = batcher_args.get('num_shards', 1)
+    if num_shards > 1:
+        prefix = '{}.shard{}of{}'.format(
+            prefix, batcher_args.get('shard_index', 0), num_shards)
+    return prefix
+
+def _dump_read_groups(
+        reader, prefix, compression, writer_class, batch_size, metrics=None):
+    """Write the reads of each read group to separate files, in a single pass
+    over a started :class:`SraReader` created with `read_groups=True`. A
+    writer is created the first time each read group is encountered.
+    
+    Args:
+        reader: The SraReader.
+        prefix: Output file prefix; the files of each read group are named
+            <prefix>.<label>, where label is the read group name made safe
+            for use in a file name (see :func:`_read_group_label`).
+        compression: See :func:`sra_dump`.
+        writer_class: The BatchWriter class to use.
+        batch_size: The writer batch size.
+        metrics: A :class:`srastream.utils.Metrics`, or None.
+    
+    Returns:
+        A dict mapping each read group to a dict of its output file names.
+    """
+    files = {}
+    writers = {}
+    labels = set()
+    with ExitStack() as stack:
+        for reads in reader.iter_batches():
+            groups = {}
+            for read_group, read in reads:
+                groups.setdefault(read_group, []).append(read)
+            for read_group, group_reads in groups.items():
+                writer = writers.get(read_group)
+                if writer is None:
+                    label = _read_group_label(read_group, labels)
+                    labels.add(label.lower())
+                    group_prefix = '{}.{}'.format(prefix, label)
+                    files[read_group], string_writer = _create_string_writer(
+                        group_prefix, reader.paired, compression,
+                        extension=writer_class.extension)
+                    writer = stack.enter_context(
+                        writer_class(string_writer, batch_size))
+                    writer.metrics = metrics
+                    writers[read_group] = writer
+                if metrics is None:
+                    writer.write_batch(group_reads)
+                else:
+                    started = time.perf_counter()
+                    writer.write_batch(group_reads)
+                    metrics.record(
+                        'write', time.perf_counter() - started,
+                        len(group_reads))
+    return files
+
+_UNSAFE_LABEL_CHARS = re.compile(r'[^A-Za-z0-9._-]')
+
+def _read_group_label(read_group, used=()):
+    """Convert a read group name to a string that is safe to use in a file
+    name. Characters other than letters, digits, '.', '_' and '-' are
+    replaced with '_', and spots without a read group are labeled
+    '_nogroup_'. If the label (ignoring case, for case-insensitive file
+    systems) is already used by another read group, a numeric suffix is
+    added, so that two read groups are never written to the same files.
+    
+    Args:
+        read_group: The read group name.
+        used: The lower-case labels of the other read groups.
+    
+    Returns:
+        The label.
+    """
+    if read_group:
+        label = _UNSAFE_LABEL_CHARS.sub('_', read_group)
+    else:
+        label = '_nogroup_'
+    unique = label
+    suffix = 1
+    while unique.lower() in used:
+        suffix += 1
+        unique = '{}_{}'.format(label, suffix)
+    return unique
+
+def sra_dump_worker(
+        accn, work_queue, prefix=None, compression=True,
+        output_format='fastq', worker=None, batch_size=1000, **reader_args):
+    """Stream reads from SRA by claiming batches from a :class:`WorkQueue`
+    shared with other workers (in other processes, or on other hosts that
+    share a filesystem). Each batch is written to its own set of output
+    files (<prefix>.<batch_num>.1.fq.gz, etc.), so a batch claimed by a worker
+    that died is simply redone by another worker. The first worker populates
+    the queue with the batches defined by the Batcher arguments; all workers
+    must use the same accession and Batcher arguments.
+    
+    When all batches are done, a manifest (<prefix>.manifest.json) listing
+    the chunk files in batch order is written, from which the chunks can be
+    concatenated using :func:`concatenate_chunks`.
+    
+    Args:
+        accn: SRA accession.
+        work_queue: A :class:`WorkQueue`, or the path to its database.
+        prefix: Output file prefix. If None, the accession is used.
+        compression: Whether to compress the output files (bool), or the name of
+            a compression scheme (e.g. 'gz', 'bz2', or 'xz').
+        output_format: The output format (one of the keys of READ_WRITERS).
+        worker: Identifier of this worker; defaults to <hostname>:<pid>.
+        batch_size: The number of reads in each batch.
+        reader_args: Additional arguments to :class:`SraReader` (except
+            `workers`, `prefetch` and `sample`), including Batcher arguments.
+    
+    Returns:
+        A dict containing accn, worker, the number of batches written by this
+        worker ('batches') and the path of the manifest ('manifest'), which is
+        None if batches remain to be done.
+    
+    Examples:
+        # run on each of several hosts
+        sra_dump_worker('SRR1', '/shared/SRR1.queue.db', '/shared/SRR1')
+    """
+    if output_format not in READ_WRITERS:
+        raise ValueError("Invalid output format {}".format(output_format))
+    writer_class = READ_WRITERS[output_format]
+    prefix = prefix or accn
+    worker = worker or '{}:{}'.format(socket.gethostname(), os.getpid())
+    owns_queue = not isinstance(work_queue, WorkQueue)
+    if owns_queue:
+        work_queue = WorkQueue(work_queue)
+    batches = 0
+    try:
+        reader = SraReader(
+            accn, fields=writer_class.fields, batch_size=batch_size,
+            **reader_args)
+        with reader:
+            work_queue.populate(
+                reader.batch_iterator.batches(reader.read_count), accn=accn,
+                paired=reader.paired)
+            if work_queue.info()['accn'] != accn:
+                raise ValueError("Work queue {} is not for accession {}".format(
+                    work_queue.path, accn))
+            while True:
+                batch = work_queue.claim(worker)
+                if batch is None:
+                    break
+                batch_num, start, size = batch
+                reads = reader.fetch_range(start, size)
+                files, string_writer = _create_string_writer(
+                    '{}.{:08d}'.format(prefix, batch_num), reader.paired,
+                    compression, atomic=True, extension=writer_class.extension)
+                with writer_class(string_writer, batch_size) as writer:
+                    writer.write_batch(reads)
+                work_queue.complete(
+                    batch_num, dict(files=files, read_count=len(reads)))
+                batches += 1
+            manifest = None
+            if work_queue.is_complete():
+                manifest = '{}.manifest.json'.format(prefix)
+                files = _output_files(
+                    prefix, reader.paired, compression,
+                    writer_class.extension)
+                chunks = [
+                    dict(batch_num=batch_num, start=start, size=size, **result)
+                    for batch_num, start, size, result
+                    in work_queue.results()]
+                write_atomic(manifest, json.dumps(dict(
+                    accn=accn, paired=reader.paired, files=files,
+                    chunks=chunks)).encode('utf-8'))
+    finally:
+        if owns_queue:
+            work_queue.close()
+    return dict(accn=accn, worker=worker, batches=batches, manifest=manifest)
+
+def concatenate_chunks(manifest, remove=False):
+    """Concatenate the chunk files listed in a manifest written by
+    :func:`sra_dump_worker`, in batch order. The chunks are concatenated as
+    bytes, which is valid for uncompressed files and for all of the supported
+    compression formats.
+    
+    Args:
+        manifest: Path to the manifest.
+        remove: Whether to remove the chunk files after concatenating them.
+    
+    Returns:
+        A dict containing the output file names ('file1' and 'file2'),
+        accn and read_count.
+    """
+    with open(manifest, 'rt') as inp:
+        manifest = json.load(inp)
+    files = manifest['files']
+    for key, path in files.items():
+        with open(path, 'wb') as out:
+            for chunk in manifest['chunks']:
+                with open(chunk['files'][key], 'rb') as inp:
+                    shutil.copyfileobj(inp, out)
+    if remove:
+        for chunk in manifest['chunks']:
+            for path in chunk['files'].values():
+                os.remove(path)
+    result = dict(files)
+    result['accn'] = manifest['accn']
+    result['read_count'] = sum(
+        chunk['read_count'] for chunk in manifest['chunks'])
+    return result
+
+def _output_files(prefix, paired, compression=True, extension='fq'):
+    """Determine the output file names.
+    
+    Args:
+        prefix: Output file prefix.
+        paired: Whether there is a pair of outputs.
+        compression: The compression scheme, or True for 'gz', or False or
+            None for no compression.
+        extension: The file extension of the output format.
+    
+    Returns:
+        A dict containing the output file names ('file1' and 'file2').
+    """
+    read_indexes = (1,2) if paired else (1,)
+    files = dict(
+        ('file{}'.format(read), '{}.{}.{}'.format(prefix, read, extension))
+        for read in read_indexes)
+    if compression is True:
+        compression = 'gz'
+    if compression:
+        files = dict(
+            (key, '{}.{}'.format(name, compression))
+            for key, name in files.items())
+    return files
+
+def _create_string_writer(
+        prefix, paired, compression=True, fifos=False, checkpoint=False,
+        offsets=None, extension='fq', atomic=False):
+    """Create the string writer for :func:`sra_dump`.
+    
+    Args:
+        prefix: Output file prefix.
+        paired: Whether to create a pair of outputs.
+        compression, fifos: See :func:`sra_dump`.
+        checkpoint: Whether to create a :class:`CheckpointFileWriter`.
+        offsets: Offsets from which to resume writing, if `checkpoint` is True.
+        extension: The file extension of the output format.
+        atomic: Whether to create an :class:`AtomicFileWriter`.
+    
+    Returns:
+        Tuple (files, string_writer), where files is a dict containing the
+        output file names ('file1' and 'file2').
+    """
+    if fifos:
+        files = _output_files(prefix, paired, False, extension)
+        buffer_args = {}
+        if isinstance(fifos, str):
+            buffer_args['buffer'] = fifos
+        string_writer = FifoWriter(**files, **buffer_args)
+    else:
+        if compression is True:
+            compression = 'gz'
+        files = _output_files(prefix, paired, compression, extension)
+        if checkpoint:
+            string_writer = CheckpointFileWriter(
+                **files, compression=compression, offsets=offsets)
+        elif atomic:
+            string_writer = AtomicFileWriter(**files, compression=compression)
+        else:
+            string_writer = FileWriter(**files, compression=compression)
+    
+    return files, string_writer
+
+class MultiSraReader(object):
+    """Iterates through the reads of multiple accessions in a deterministic
+    order (all reads of the first accession, then all reads of the second,
+    etc.), while opening and fetching from up to `concurrency` accessions at a
+    time in background threads. This hides the per-accession startup latency,
+    and keeps the network busy while the reads of the current accession are
+    being consumed.
+    
+    Args:
+        accns: Sequence of accession numbers.
+        concurrency: The maximum number of accessions to read from at the same
+            time.
+        read_ahead: The maximum number of batches to buffer for each
+            accession that is being read ahead of the consumer.
+        reader_args: Additional arguments to :class:`SraReader` (e.g.
+            `fixed_layout`, `metadata_cache`, or Batcher arguments).
+    
+    Examples:
+        reader = MultiSraReader(['SRR1', 'SRR2', 'SRR3'], concurrency=3)
+        for sra_reader, reads in reader.iter_batches():
+            print("{} reads from {}".format(len(reads), sra_reader.accn))
+    """
+    def __init__(self, accns, concurrency=4, read_ahead=2, **reader_args):
+        self.accns = list(accns)
+        self.concurrency = concurrency
+        self.read_ahead = read_ahead
+        self.reader_args = reader_args
+    
+    def __iter__(self):
+        for _, reads in self.iter_batches():
+            yield from reads
+    
+    def iter_batches(self):
+        """Iterate over whole batches of reads from all accessions.
+        
+        Yields:
+            Tuples (reader, reads), where reader is the started
+            :class:`SraReader` for the accession from which the batch was
+            fetched, and reads is a list of :func:`sra_reads` tuples.
+        """
+        stop = threading.Event()
+        queues = [queue.Queue(maxsize=self.read_ahead) for _ in self.accns]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            # Accessions are submitted in order, so the accession currently
+            # being consumed always has a running producer.
+            futures = [
+                executor.submit(self._produce, accn, batches, stop)
+                for accn, batches in zip(self.accns, queues)]
+            try:
+                for batches in queues:
+                    while True:
+                        reader, reads, err = batches.get()
+                        if err is not None:
+                            raise err
+                        if reads is None:
+                            break
+                        yield reader, reads
+            finally:
+                stop.set()
+                for future in futures:
+                    future.cancel()
+    
+    def _produce(self, accn, batches, stop):
+        """Fetch the batches of one accession into a queue. The queue receives
+        (reader, reads, None) tuples for each batch, followed by
+        (reader, None, None) when done, or (None, None, error) on failure.
+        """
+        if stop.is_set():
+            return
+        try:
+            with SraReader(accn, **self.reader_args) as reader:
+                for reads in reader.iter_batches():
+                    if not put_until_stopped(
+                            batches, (reader, reads, None), stop):
+                        return
+            put_until_stopped(batches, (reader, None, None), stop)
+        except Exception as err: # pylint: disable=broad-except
+            put_until_stopped(batches, (None, None, err), stop)
+
+def sra_dump_many(
+        accns, prefix=None, concurrency=4, concatenate=False, **dump_args):
+    """Stream reads from multiple accessions to FASTQ (or FASTA) files.
+    
+    Args:
+        accns: Sequence of accessions.
+        prefix: Output file prefix. If `concatenate` is False, this is used as
+            a prefix to the accession, i.e. outputs are named
+            <prefix><accn>.1.fq.gz. If `concatenate` is True, this is the
+            prefix of the single set of output files, and must not be None.
+        concurrency: The maximum number of accessions to stream at the same
+            time.
+        concatenate: Whether to concatenate the reads from all accessions, in
+            the order given, into one set of output files. All accessions must
+            be either single- or paired-end.
+        dump_args: Additional arguments to :func:`sra_dump`. If `concatenate`
+            is True, these are limited to the `compression`, `fifos` and
+            `output_format` arguments of sra_dump plus arguments to
+            :class:`SraReader`.
+    
+    Returns:
+        If `concatenate` is False, a list of the results of calling sra_dump
+        on each accession. Otherwise, a dict containing the output file names
+        ('file1' and 'file2'), the accessions ('accns'), the total number of
+        reads (read_count) and a summary of metrics (see :func:`sra_dump`).
+    """
+    if not concatenate:
+        if dump_args.get('metrics') is not None:
+            raise ValueError(
+                "Metrics cannot be shared between processes; the result for "
+                "each accession includes a summary of its own metrics")
+        # Each accession is dumped in a separate process, so that compression
+        # of the outputs is not limited to a single core.
+        dump = functools.partial(
+            _sra_dump_with_prefix, prefix=prefix, **dump_args)
+        with ProcessPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(dump, accns))
+    
+    if prefix is None:
+        raise ValueError("'prefix' is required when concatenating")
+    prefix = _shard_prefix(prefix, dump_args)
+    if dump_args.pop('checkpoint', False) or dump_args.pop('resume', False):
+        raise ValueError("Cannot checkpoint when concatenating")
+    if dump_args.pop('split_read_groups', False):
+        raise ValueError("Cannot split by read group when concatenating")
+    compression = dump_args.pop('compression', True)
+    fifos = dump_args.pop('fifos', False)
+    output_format = dump_args.pop('output_format', 'fastq')
+    if output_format not in READ_WRITERS:
+        raise ValueError("Invalid output format {}".format(output_format))
+    writer_class = READ_WRITERS[output_format]
+    dump_args['fields'] = writer_class.fields
+    if dump_args.get('metrics') is None:
+        dump_args['metrics'] = Metrics()
+    metrics = dump_args['metrics']
+    batch_size = dump_args.setdefault('batch_size', 1000)
+    reader = MultiSraReader(accns, concurrency=concurrency, **dump_args)
+    result = dict(accns=reader.accns, read_count=0)
+    batches = reader.iter_batches()
+    try:
+        # the outputs can't be created until we know whether the first
+        # accession is paired
+        first = next(batches, None)
+        if first is None:
+            result['metrics'] = _dump_summary(metrics)
+            return result
+        paired = first[0].paired
+        files, string_writer = _create_string_writer(
+            prefix, paired, compression, fifos,
+            extension=writer_class.extension)
+        result.update(files)
+        with writer_class(string_writer, batch_size) as writer:
+            writer.metrics = metrics
+            for sra_reader, reads in itertools.chain([first], batches):
+                if sra_reader.paired != paired:
+                    raise ValueError(
+                        "Cannot concatenate single- and paired-end "
+                        "accessions")
+                started = time.perf_counter()
+                writer.write_batch(reads)
+                metrics.record(
+                    'write', time.perf_counter() - started, len(reads))
+                result['read_count'] += len(reads)
+    finally:
+        batches.close()
+    result['metrics'] = _dump_summary(metrics)
+    return result
+
+def _sra_dump_with_prefix(accn, prefix=None, **dump_args):
+    """Call :func:`sra_dump` with the output prefix <prefix><accn>.
+    """
+    return sra_dump(accn, prefix='{}{}'.format(prefix or '', accn), **dump_args)
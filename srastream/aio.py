@@ -0,0 +1,171 @@
+"""Streaming reads from SRA in asyncio programs. Requires python 3.6+.
+"""
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from ngs import NGS
+from . import SraReader, select_reads
+
+class AsyncSraReader(object):
+    """Asynchronous counterpart of :class:`srastream.SraReader`. Batches are
+    fetched from SRA in an executor so that the event loop remains responsive,
+    and a single event loop can drive many readers concurrently. Batches are
+    selected using the same :class:`srastream.utils.Batcher` semantics as
+    SraReader, and are yielded in batch order.
+    
+    Args:
+        accn: The accession number.
+        batch_iterator: An iterator over indexes of batches to fetch.
+        concurrency: The number of batches to fetch concurrently. Each
+            concurrent fetch uses its own read collection. Read collections
+            are re-used by later fetches and closed by `finish()`, so at most
+            one is open per concurrent fetch, even when an executor is shared
+            by many readers.
+        read_ahead: The maximum number of batches that may be fetched but not
+            yet consumed. Defaults to 2 * concurrency.
+        executor: The :class:`concurrent.futures.Executor` in which to fetch
+            batches. If None, a ThreadPoolExecutor with `concurrency` workers
+            is created when the reader is started and shut down when it is
+            finished.
+        reader_args: Additional arguments to :class:`srastream.SraReader`
+            (e.g. `fixed_layout`, `metadata_cache`, `batch_cache`, `sample`,
+            `skip_batches`, or Batcher arguments other than `adaptive`).
+    
+    Examples:
+        async def count_reads(accn):
+            count = 0
+            async with AsyncSraReader(
+                    accn, concurrency=4, batch_size=10000) as reader:
+                async for reads in reader.iter_batches():
+                    count += len(reads)
+            return count
+        
+        loop = asyncio.get_event_loop()
+        counts = loop.run_until_complete(asyncio.gather(
+            *(count_reads(accn) for accn in accns)))
+    """
+    def __init__(
+            self, accn, batch_iterator=None, concurrency=1, read_ahead=None,
+            executor=None, **reader_args):
+        self.reader = SraReader(accn, batch_iterator, **reader_args)
+        self.concurrency = concurrency
+        self.read_ahead = read_ahead or (2 * concurrency)
+        if getattr(self.reader.batch_iterator, 'adaptive', False):
+            # batches are requested before they are fetched, so the time
+            # between requests does not reflect the fetch time
+            raise ValueError(
+                "Adaptive batch sizes cannot be used with AsyncSraReader")
+        self.executor = executor
+        self._owns_executor = False
+        # read collections that are not in use by a fetch; None when the
+        # reader is not started
+        self._read_collections = None
+        self._lock = threading.Lock()
+    
+    async def __aenter__(self):
+        await self.start()
+        return self
+    
+    async def __aexit__(self, exception_type, exception_value, traceback):
+        await self.finish()
+    
+    def __aiter__(self):
+        return self._iter_reads()
+    
+    @property
+    def accn(self):
+        return self.reader.accn
+    
+    @property
+    def read_count(self):
+        return self.reader.read_count
+    
+    @property
+    def paired(self):
+        return self.reader.paired
+    
+    async def start(self):
+        """Open the read collection and load the run metadata.
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+            self._owns_executor = True
+        self._read_collections = []
+        await asyncio.get_event_loop().run_in_executor(
+            self.executor, self.reader.start)
+    
+    async def finish(self):
+        """Close the read collections.
+        """
+        if self.executor is None:
+            return
+        await asyncio.get_event_loop().run_in_executor(
+            self.executor, self._close)
+        if self._owns_executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+            self._owns_executor = False
+    
+    def _close(self):
+        """Close the reader and the read collections used for fetching.
+        """
+        self.reader.finish()
+        with self._lock:
+            read_collections = self._read_collections or []
+            self._read_collections = None
+        for read_collection in read_collections:
+            read_collection.close()
+    
+    def _fetch(self, start, size, members=None):
+        """Fetch a range of reads in an executor thread, using a read
+        collection that is not in use by any other fetch, and select the
+        `members` of the range (see :func:`srastream.select_reads`).
+        """
+        read_collection = None
+        with self._lock:
+            if self._read_collections:
+                read_collection = self._read_collections.pop()
+        if read_collection is None:
+            read_collection = NGS.openReadCollection(self.reader.accn)
+        try:
+            return select_reads(
+                self.reader.fetch_range(start, size, read_collection), start,
+                members)
+        finally:
+            with self._lock:
+                if self._read_collections is not None:
+                    self._read_collections.append(read_collection)
+                    read_collection = None
+            # the reader was finished during the fetch
+            if read_collection is not None:
+                read_collection.close()
+    
+    async def _iter_reads(self):
+        async for reads in self.iter_batches():
+            for read in reads:
+                yield read
+    
+    async def iter_batches(self):
+        """Iterate over whole batches of reads.
+        
+        Yields:
+            Lists of :func:`srastream.sra_reads` tuples, one per batch, in
+            batch order.
+        """
+        reader = self.reader
+        if reader.read_collection is None:
+            raise ValueError("Must call start() first")
+        loop = asyncio.get_event_loop()
+        pending = deque()
+        try:
+            for start, size, members in reader.iter_ranges():
+                if len(pending) >= self.read_ahead:
+                    yield await pending.popleft()
+                pending.append(loop.run_in_executor(
+                    self.executor, self._fetch, start, size, members))
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for future in pending:
+                future.cancel()
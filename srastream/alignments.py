@@ -0,0 +1,569 @@
+"""Streaming alignments, per-position read depth, and reference sequences
+for specific regions of the reference from aligned SRA accessions.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import threading
+from ngs import NGS
+from ngs.Alignment import Alignment
+from .utils import Batcher, ordered_map
+from .writers import ChunkedFastaWriter, FastqWriter, FileWriter, SamWriter
+
+ALIGNMENT_CATEGORIES = {
+    'primary': Alignment.primaryAlignment,
+    'secondary': Alignment.secondaryAlignment,
+    'all': Alignment.all
+}
+"""Names of the NGS alignment categories that can be used to filter
+alignments."""
+
+COMPLEMENT = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+def reverse_complement(bases):
+    """Reverse-complement a nucleotide sequence.
+    """
+    return bases.translate(COMPLEMENT)[::-1]
+
+def read_bed(path):
+    """Read regions from a BED file.
+    
+    Args:
+        path: Path to the BED file.
+    
+    Returns:
+        A list of (reference, start, end) tuples, where start is 0-based and
+        end is exclusive.
+    """
+    regions = []
+    with open(path, 'rt') as bed:
+        for line in bed:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.split('\t')
+            regions.append((fields[0], int(fields[1]), int(fields[2])))
+    return regions
+
+def list_references(read_collection):
+    """Get the references of a read collection.
+    
+    Args:
+        read_collection: An open NGS ReadCollection.
+    
+    Returns:
+        A list of (common_name, canonical_name, length) tuples.
+    """
+    refs = []
+    with read_collection.getReferences() as ref:
+        while ref.nextReference():
+            refs.append((
+                ref.getCommonName(), ref.getCanonicalName(), ref.getLength()))
+    return refs
+
+class AlignmentReader(object):
+    """Iterates through the alignments that overlap a set of regions of an
+    aligned SRA accession, using the NGS reference and alignment slice APIs so
+    that only the alignments in those regions are fetched.
+    
+    Each region is split into chunks of at most `chunk_size` bases, which are
+    fetched in order (or in parallel if `workers` > 1). An alignment that
+    overlaps more than one chunk of a region is only returned once (with the
+    first chunk it overlaps), but an alignment that overlaps more than one
+    region is returned once per region.
+    
+    Args:
+        accn: The accession number.
+        regions: Sequence of (reference, start, end) tuples, where start is
+            0-based and end is exclusive (i.e. BED coordinates), or the path
+            to a BED file. The reference may be given by its common name
+            (e.g. 'chr1') or canonical name (e.g. 'NC_000001.10').
+        category: The name of the category of alignments to fetch (one of the
+            keys of ALIGNMENT_CATEGORIES).
+        chunk_size: The maximum number of reference bases to fetch
+            alignments for in a single call.
+        workers: Number of worker processes to use for fetching chunks. If
+            None or < 2, chunks are fetched serially in the current process.
+        max_in_flight: The maximum number of chunks that may be fetched but
+            not yet consumed when `workers` > 1. Defaults to 2 * workers.
+        speculate: When `workers` > 1, re-issue a chunk on another worker if
+            it takes more than this many times the median chunk fetch time
+            (see :func:`srastream.utils.ordered_map`).
+    
+    Examples:
+        with AlignmentReader(accn, 'targets.bed', workers=4) as reader:
+            for record in reader:
+                print("\\t".join(str(field) for field in record))
+    """
+    def __init__(
+            self, accn, regions, category='primary', chunk_size=100000,
+            workers=None, max_in_flight=None, speculate=None):
+        self.accn = accn
+        if isinstance(regions, str):
+            regions = read_bed(regions)
+        self.regions = list(regions)
+        if category not in ALIGNMENT_CATEGORIES:
+            raise ValueError("Invalid alignment category {}".format(category))
+        self.category = category
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.speculate = speculate
+        self.read_collection = None
+    
+    def __enter__(self):
+        self.start()
+        return self
+    
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.finish()
+    
+    def __iter__(self):
+        for records in self.iter_batches():
+            yield from records
+    
+    def start(self):
+        """Open the read collection.
+        """
+        self.read_collection = NGS.openReadCollection(self.accn)
+    
+    def finish(self):
+        """Close the read collection.
+        """
+        if self.read_collection is not None:
+            self.read_collection.close()
+            self.read_collection = None
+    
+    def references(self):
+        """Get the references of the accession.
+        
+        Returns:
+            A list of (common_name, canonical_name, length) tuples.
+        """
+        if self.read_collection is None:
+            raise ValueError("Must call start() first")
+        return list_references(self.read_collection)
+    
+    def sam_header(self):
+        """Create a SAM header containing a @SQ line for each reference.
+        """
+        lines = ['@HD\tVN:1.6\tSO:unsorted']
+        for name, _, length in self.references():
+            lines.append('@SQ\tSN:{}\tLN:{}'.format(name, length))
+        return '\n'.join(lines)
+    
+    def chunks(self):
+        """Split the regions into chunks.
+        
+        Yields:
+            Tuples (reference, start, size, first), where first is whether the
+            chunk is the first chunk of its region.
+        """
+        if self.read_collection is None:
+            raise ValueError("Must call start() first")
+        lengths = {}
+        for reference, start, end in self.regions:
+            if reference not in lengths:
+                lengths[reference] = self.read_collection.getReference(
+                    reference).getLength()
+            batcher = Batcher(
+                item_start=start, item_stop=end, batch_size=self.chunk_size)
+            for batch_num, chunk_start, size in batcher(lengths[reference]):
+                yield (reference, chunk_start, size, batch_num == 0)
+    
+    def iter_batches(self):
+        """Iterate over the alignments in each chunk of each region.
+        
+        Yields:
+            Lists of alignment records, one list per chunk, in region order.
+            Each record is a tuple of the 11 mandatory SAM fields (see
+            :func:`fetch_alignments`).
+        """
+        chunks = self.chunks()
+        if self.workers and self.workers > 1:
+            max_in_flight = self.max_in_flight or (2 * self.workers)
+            args = (
+                (self.accn, reference, start, size, first, self.category)
+                for reference, start, size, first in chunks)
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                yield from ordered_map(
+                    executor, _fetch_alignments_worker, args, max_in_flight,
+                    self.speculate)
+        else:
+            for reference, start, size, first in chunks:
+                yield fetch_alignments(
+                    self.read_collection, reference, start, size, first,
+                    ALIGNMENT_CATEGORIES[self.category])
+
+def fetch_alignments(
+        read_collection, reference, start, size, include_overlapping=True,
+        category=Alignment.primaryAlignment):
+    """Fetch the alignments in a slice of a reference.
+    
+    Args:
+        read_collection: An open NGS ReadCollection.
+        reference: The reference name.
+        start: The 0-based start position of the slice.
+        size: The length of the slice.
+        include_overlapping: Whether to include alignments that start before
+            the slice but overlap it.
+        category: The NGS alignment category.
+    
+    Returns:
+        A list of tuples of the 11 mandatory SAM fields: (qname, flag, rname,
+        pos, mapq, cigar, rnext, pnext, tlen, seq, qual). Bases and qualities
+        are in reference orientation, and pos is 1-based. Paired alignments
+        are flagged as the first or last fragment of the template according
+        to their fragment ID. Mate information (rnext and pnext) is not
+        filled in.
+    """
+    records = []
+    ref = read_collection.getReference(reference)
+    with ref.getAlignmentSlice(start, size, category) as aln:
+        while aln.nextAlignment():
+            position = aln.getAlignmentPosition()
+            if position < start and not include_overlapping:
+                continue
+            flag = 0
+            if aln.isPaired():
+                flag |= 0x1
+                fragment_index = _fragment_index(aln.getFragmentId())
+                if fragment_index == 0:
+                    flag |= 0x40
+                elif fragment_index is not None:
+                    flag |= 0x80
+            bases = aln.getFragmentBases()
+            qualities = aln.getFragmentQualities()
+            if aln.getIsReversedOrientation():
+                flag |= 0x10
+                bases = reverse_complement(bases)
+                qualities = qualities[::-1]
+            if aln.getAlignmentCategory() == Alignment.secondaryAlignment:
+                flag |= 0x100
+            records.append((
+                aln.getReadId(), flag, reference, position + 1,
+                aln.getMappingQuality(), aln.getShortCigar(False), '*', 0,
+                aln.getTemplateLength(), bases, qualities))
+    return records
+
+def _fragment_index(fragment_id):
+    """Get the index of a fragment within its read from an NGS fragment ID,
+    which has the form '<run>.FA<index>.<row>' for aligned fragments (or
+    '<run>.FR<index>.<row>' for unaligned fragments).
+    
+    Returns:
+        The 0-based index, or None if the ID does not have this form.
+    """
+    parts = fragment_id.rsplit('.', 2)
+    if (len(parts) == 3 and parts[1][:2] in ('FA', 'FR') and
+            parts[1][2:].isdigit()):
+        return int(parts[1][2:])
+    return None
+
+def alignment_to_fastq(record):
+    """Convert an alignment record to a (name, sequence, qualities) tuple, with
+    the sequence in the original read orientation.
+    """
+    bases, qualities = record[9], record[10]
+    if record[1] & 0x10:
+        bases = reverse_complement(bases)
+        qualities = qualities[::-1]
+    return (record[0], bases, qualities)
+
+class PileupReader(AlignmentReader):
+    """Iterates through the per-position read depth of a set of regions of an
+    aligned SRA accession, using the NGS pileup API, so that coverage can be
+    computed without fetching (or writing) the reads themselves.
+    
+    Regions are split into chunks of at most `chunk_size` bases, exactly as
+    for :class:`AlignmentReader`, and the depth of each chunk is returned as a
+    NumPy array. Requires numpy.
+    
+    Args:
+        accn: The accession number.
+        regions: Sequence of (reference, start, end) tuples (BED coordinates),
+            or the path to a BED file.
+        category: The name of the category of alignments to count (one of the
+            keys of ALIGNMENT_CATEGORIES).
+        chunk_size: The maximum number of reference positions per chunk.
+        workers: Number of worker processes to use for fetching chunks. If
+            None or < 2, chunks are fetched serially in the current process.
+        max_in_flight: The maximum number of chunks that may be fetched but
+            not yet consumed when `workers` > 1. Defaults to 2 * workers.
+        speculate: When `workers` > 1, re-issue a chunk on another worker if
+            it takes more than this many times the median chunk fetch time
+            (see :func:`srastream.utils.ordered_map`).
+    
+    Examples:
+        with PileupReader(accn, 'targets.bed') as reader:
+            for reference, start, depth in reader:
+                print(reference, start, depth.mean(), (depth >= 10).mean())
+    """
+    def __iter__(self):
+        return self.iter_batches()
+    
+    def iter_batches(self):
+        """Iterate over the read depth of each chunk of each region.
+        
+        Yields:
+            Tuples (reference, start, depth), in region order, where depth is
+            a uint32 array with the depth at each position of the chunk.
+        """
+        chunks = list(self.chunks())
+        if self.workers and self.workers > 1:
+            max_in_flight = self.max_in_flight or (2 * self.workers)
+            args = (
+                (self.accn, reference, start, size, self.category)
+                for reference, start, size, _ in chunks)
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                depths = ordered_map(
+                    executor, _fetch_pileup_worker, args, max_in_flight,
+                    self.speculate)
+                for (reference, start, _, _), depth in zip(chunks, depths):
+                    yield (reference, start, depth)
+        else:
+            for reference, start, size, _ in chunks:
+                yield (reference, start, fetch_pileup(
+                    self.read_collection, reference, start, size,
+                    ALIGNMENT_CATEGORIES[self.category]))
+
+def fetch_pileup(
+        read_collection, reference, start, size,
+        category=Alignment.primaryAlignment):
+    """Fetch the read depth at each position of a slice of a reference.
+    Requires numpy.
+    
+    Args:
+        read_collection: An open NGS ReadCollection.
+        reference: The reference name.
+        start: The 0-based start position of the slice.
+        size: The length of the slice.
+        category: The NGS alignment category.
+    
+    Returns:
+        A uint32 array of length `size`, where element i is the depth at
+        reference position start + i. Positions not covered by any alignment
+        have depth 0.
+    """
+    import numpy as np
+    depth = np.zeros(size, dtype=np.uint32)
+    stop = start + size
+    ref = read_collection.getReference(reference)
+    with ref.getPileupSlice(start, size, category) as pileup:
+        while pileup.nextPileup():
+            position = pileup.getReferencePosition()
+            if start <= position < stop:
+                depth[position - start] = pileup.getPileupDepth()
+    return depth
+
+# Read collections opened by workers, keyed by accession. This is
+# thread-local, and each worker process has its own copy, so every worker
+# (whether a process or a thread) opens its own handle the first time it is
+# assigned a batch from a given accession.
+_WORKER_STATE = threading.local()
+
+def _worker_read_collection(accn):
+    """Get the read collection for an accession in a worker process, opening
+    it the first time it is needed. This is shared by all kinds of fetches
+    (reads, alignments, pileups and references), so a worker opens only one
+    read collection per accession.
+    """
+    if not hasattr(_WORKER_STATE, 'read_collections'):
+        _WORKER_STATE.read_collections = {}
+    read_collection = _WORKER_STATE.read_collections.get(accn)
+    if read_collection is None:
+        read_collection = NGS.openReadCollection(accn)
+        _WORKER_STATE.read_collections[accn] = read_collection
+    return read_collection
+
+def _fetch_alignments_worker(accn, reference, start, size, first, category):
+    """Fetch the alignments in a slice of a reference in a worker process.
+    """
+    return fetch_alignments(
+        _worker_read_collection(accn), reference, start, size, first,
+        ALIGNMENT_CATEGORIES[category])
+
+def _fetch_pileup_worker(accn, reference, start, size, category):
+    """Fetch the read depth of a slice of a reference in a worker process.
+    """
+    return fetch_pileup(
+        _worker_read_collection(accn), reference, start, size,
+        ALIGNMENT_CATEGORIES[category])
+
+def alignment_dump(
+        accn, regions, prefix=None, output_format='fastq', compression=True,
+        batch_size=1000, **reader_args):
+    """Convenience method to stream the alignments overlapping a set of
+    regions to a FASTQ or SAM file.
+    
+    Args:
+        accn: SRA accession.
+        regions: Regions, or the path to a BED file (see
+            :class:`AlignmentReader`).
+        prefix: Output file prefix. If None, the accession is used.
+        output_format: 'fastq' or 'sam'.
+        compression: Whether to compress the output file (bool), or the name of
+            a compression scheme (e.g. 'gz', 'bz2', or 'xz').
+        batch_size: The number of records to buffer before writing.
+        reader_args: Additional arguments to :class:`AlignmentReader`.
+    
+    Returns:
+        A dict containing the output file name ('file1'), accn, and
+        record_count.
+    """
+    if output_format not in ('fastq', 'sam'):
+        raise ValueError("Invalid output format {}".format(output_format))
+    if compression is True:
+        compression = 'gz'
+    filename = '{}.{}'.format(
+        prefix or accn, 'fq' if output_format == 'fastq' else 'sam')
+    if compression:
+        filename = '{}.{}'.format(filename, compression)
+    record_count = 0
+    with AlignmentReader(accn, regions, **reader_args) as reader:
+        string_writer = FileWriter(filename, compression=compression)
+        if output_format == 'fastq':
+            writer = FastqWriter(string_writer, batch_size)
+        else:
+            writer = SamWriter(string_writer, batch_size, reader.sam_header())
+        with writer:
+            for records in reader.iter_batches():
+                if output_format == 'fastq':
+                    writer.write_batch(
+                        (alignment_to_fastq(record),) for record in records)
+                else:
+                    writer.write_batch((record,) for record in records)
+                record_count += len(records)
+    return dict(file1=filename, accn=accn, record_count=record_count)
+
+class ReferenceReader(object):
+    """Streams the reference sequences embedded in an aligned SRA accession.
+    Each reference is fetched in chunks of at most `chunk_size` bases (using
+    :class:`srastream.utils.Batcher`), so that a large reference is never
+    held in memory all at once.
+    
+    Args:
+        accn: The accession number.
+        references: The names of the references to fetch, or None to fetch all
+            references.
+        chunk_size: The maximum number of bases to fetch in a single call.
+        workers: Number of worker processes to use for fetching chunks. If
+            None or < 2, chunks are fetched serially in the current process.
+        max_in_flight: The maximum number of chunks that may be fetched but
+            not yet consumed when `workers` > 1. Defaults to 2 * workers.
+        speculate: When `workers` > 1, re-issue a chunk on another worker if
+            it takes more than this many times the median chunk fetch time
+            (see :func:`srastream.utils.ordered_map`).
+    
+    Examples:
+        with ReferenceReader(accn, ['chr21']) as reader:
+            for name, offset, bases in reader:
+                print("{}:{} {}".format(name, offset, len(bases)))
+    """
+    def __init__(
+            self, accn, references=None, chunk_size=1000000, workers=None,
+            max_in_flight=None, speculate=None):
+        self.accn = accn
+        self.references = references
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.speculate = speculate
+        self.read_collection = None
+        self.lengths = None
+    
+    def __enter__(self):
+        self.start()
+        return self
+    
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.finish()
+    
+    def start(self):
+        """Open the read collection and determine the reference lengths.
+        """
+        self.read_collection = NGS.openReadCollection(self.accn)
+        if self.references is None:
+            self.lengths = [
+                (name, length)
+                for name, _, length in list_references(self.read_collection)]
+        else:
+            self.lengths = [
+                (name, self.read_collection.getReference(name).getLength())
+                for name in self.references]
+    
+    def finish(self):
+        """Close the read collection.
+        """
+        if self.read_collection is not None:
+            self.read_collection.close()
+            self.read_collection = None
+    
+    def chunks(self):
+        """Split the references into chunks.
+        
+        Yields:
+            Tuples (reference, start, size).
+        """
+        if self.read_collection is None:
+            raise ValueError("Must call start() first")
+        batcher = Batcher(batch_size=self.chunk_size)
+        for name, length in self.lengths:
+            for _, start, size in batcher(length):
+                yield (name, start, size)
+    
+    def __iter__(self):
+        """Iterate over chunks of reference sequence.
+        
+        Yields:
+            Tuples (reference, start, bases), in reference order.
+        """
+        chunks = self.chunks()
+        if self.workers and self.workers > 1:
+            chunks = list(chunks)
+            max_in_flight = self.max_in_flight or (2 * self.workers)
+            args = (
+                (self.accn, name, start, size) for name, start, size in chunks)
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                fetched = ordered_map(
+                    executor, _fetch_reference_worker, args, max_in_flight,
+                    self.speculate)
+                for (name, start, _), bases in zip(chunks, fetched):
+                    yield (name, start, bases)
+        else:
+            for name, start, size in chunks:
+                bases = self.read_collection.getReference(
+                    name).getReferenceBases(start, size)
+                yield (name, start, bases)
+
+def _fetch_reference_worker(accn, reference, start, size):
+    """Fetch a chunk of a reference sequence in a worker process.
+    """
+    return _worker_read_collection(accn).getReference(
+        reference).getReferenceBases(start, size)
+
+def reference_dump(
+        accn, prefix=None, compression=True, line_length=70, **reader_args):
+    """Convenience method to stream reference sequences to a FASTA file.
+    
+    Args:
+        accn: SRA accession.
+        prefix: Output file prefix. If None, the accession is used.
+        compression: Whether to compress the output file (bool), or the name of
+            a compression scheme (e.g. 'gz', 'bz2', or 'xz').
+        line_length: The number of bases per line.
+        reader_args: Additional arguments to :class:`ReferenceReader`.
+    
+    Returns:
+        A dict containing the output file name ('file1'), accn, and
+        the names of the references that were written.
+    """
+    if compression is True:
+        compression = 'gz'
+    filename = '{}.fa'.format(prefix or accn)
+    if compression:
+        filename = '{}.{}'.format(filename, compression)
+    with ReferenceReader(accn, **reader_args) as reader:
+        string_writer = FileWriter(filename, compression=compression)
+        with ChunkedFastaWriter(string_writer, line_length) as writer:
+            for name, _, bases in reader:
+                writer(name, bases)
+        references = [name for name, _ in reader.lengths]
+    return dict(file1=filename, accn=accn, references=references)
@@ -0,0 +1,344 @@
+"""On-disk caches for data fetched from SRA.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+
+# Names that are safe to use as-is in a cache directory, and characters that
+# are not.
+_SAFE_NAME = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*$')
+_UNSAFE_CHARS = re.compile(r'[^A-Za-z0-9._-]')
+
+def default_cache_dir(name):
+    """Get the default path of a cache directory. This is
+    ``$SRASTREAM_CACHE/<name>`` if the SRASTREAM_CACHE environment variable is
+    set, otherwise ``$XDG_CACHE_HOME/srastream/<name>`` (where XDG_CACHE_HOME
+    defaults to ~/.cache).
+    
+    Args:
+        name: The name of the cache.
+    
+    Returns:
+        The cache directory path.
+    """
+    root = os.environ.get('SRASTREAM_CACHE')
+    if not root:
+        root = os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+            'srastream')
+    return os.path.join(root, name)
+
+def write_atomic(path, data):
+    """Write bytes to a file such that concurrent readers never see a
+    partially written file: the data are written to a temporary file in the
+    same directory, which is then renamed to `path`.
+    
+    Args:
+        path: The destination path.
+        data: The bytes to write.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(data)
+        os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def _entry_name(accn):
+    """Convert an accession to a string that is safe to use as a file name in
+    a cache directory. Accession numbers are returned unchanged. Anything else
+    (e.g. the path of a local run) is replaced with its base name, made safe,
+    followed by a hash of the absolute path, so that different runs never
+    share a name and entries are never written outside the cache directory.
+    
+    Args:
+        accn: The accession, or the path or URL of a run.
+    
+    Returns:
+        The file name.
+    """
+    if _SAFE_NAME.match(accn) and not os.path.exists(accn):
+        return accn
+    if os.path.exists(accn):
+        accn = os.path.abspath(accn)
+    digest = hashlib.sha1(accn.encode('utf-8')).hexdigest()[:16]
+    base = _UNSAFE_CHARS.sub('_', os.path.basename(accn.rstrip('/')))
+    return '_{}-{}'.format(base, digest)
+
+def _to_tuple(value):
+    """Recursively convert lists (as decoded from JSON) to tuples.
+    """
+    if isinstance(value, list):
+        return tuple(_to_tuple(item) for item in value)
+    return value
+
+class MetadataCache(object):
+    """Caches the metadata that :meth:`srastream.SraReader.start` otherwise
+    has to fetch from SRA (run name, read count, and fragment layout). Each
+    accession is stored as a separate JSON file, so the cache can be shared
+    between processes.
+    
+    Args:
+        path: The cache directory. Defaults to
+            ``default_cache_dir('metadata')``.
+        ttl: Time-to-live of cache entries, in seconds. Entries older than this
+            are ignored and eventually evicted. None means entries never
+            expire.
+        max_entries: The maximum number of entries to keep. When exceeded, the
+            least recently written entries are evicted.
+    
+    Examples:
+        cache = MetadataCache(ttl=24*60*60)
+        for start in range(0, 1000000, 1000):
+            with SraReader(
+                    accn, metadata_cache=cache, item_start=start,
+                    item_limit=1000) as reader:
+                ...
+    """
+    def __init__(self, path=None, ttl=7*24*60*60, max_entries=10000):
+        self.path = path or default_cache_dir('metadata')
+        self.ttl = ttl
+        self.max_entries = max_entries
+        os.makedirs(self.path, exist_ok=True)
+    
+    def _entry_path(self, accn):
+        return os.path.join(self.path, '{}.json'.format(_entry_name(accn)))
+    
+    def _expired(self, timestamp, now=None):
+        if self.ttl is None:
+            return False
+        return (now or time.time()) - timestamp > self.ttl
+    
+    def get(self, accn):
+        """Get the cached metadata for an accession.
+        
+        Args:
+            accn: The accession.
+        
+        Returns:
+            A dict of metadata, or None if the accession is not cached or the
+            entry has expired.
+        """
+        try:
+            with open(self._entry_path(accn), 'rt') as inp:
+                entry = json.load(inp)
+        except (OSError, ValueError):
+            return None
+        if self._expired(entry.get('timestamp', 0)):
+            return None
+        return entry['metadata']
+    
+    def put(self, accn, metadata):
+        """Add or replace the metadata for an accession.
+        
+        Args:
+            accn: The accession.
+            metadata: JSON-serializable dict of metadata.
+        """
+        entry = dict(timestamp=time.time(), metadata=metadata)
+        write_atomic(
+            self._entry_path(accn), json.dumps(entry).encode('utf-8'))
+        self.evict()
+    
+    def evict(self):
+        """Remove expired entries, and the oldest entries in excess of
+        `max_entries`.
+        """
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                mtime = os.path.getmtime(path)
+                if self._expired(mtime, now):
+                    os.remove(path)
+                else:
+                    entries.append((mtime, path))
+            except OSError:
+                # removed by another process
+                pass
+        if self.max_entries and len(entries) > self.max_entries:
+            entries.sort()
+            for _, path in entries[:len(entries) - self.max_entries]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+    
+    def clear(self):
+        """Remove all entries.
+        """
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+class BatchCache(object):
+    """Caches batches of reads on disk so that overlapping slices of the same
+    run do not have to be re-fetched from SRA. Each batch is stored as a
+    separate gzip-compressed JSON file keyed by (accession, start, size).
+    The total size of the cache is kept under a budget by evicting the least
+    recently used batches.
+    
+    The cache is safe to share between concurrent processes on one host:
+    batches are written atomically, and readers treat batches that are
+    evicted by another process as cache misses.
+    
+    Args:
+        path: The cache directory. Defaults to ``default_cache_dir('batches')``.
+        max_bytes: The maximum total size of the cache, in bytes.
+        low_water: When the cache exceeds `max_bytes`, batches are evicted
+            until its size is within this fraction of `max_bytes`, so that
+            eviction (which scans the cache directory) is only needed after
+            a number of further writes.
+        compresslevel: The gzip compression level.
+        rescan_interval: The number of writes after which the cache directory
+            is re-scanned to account for batches written by other processes.
+    
+    Examples:
+        cache = BatchCache(max_bytes=10 * 1024 ** 3)
+        with SraReader(accn, batch_cache=cache, item_limit=100000) as reader:
+            ...
+    """
+    def __init__(
+            self, path=None, max_bytes=10 * 1024 ** 3, low_water=0.9,
+            compresslevel=6, rescan_interval=100):
+        self.path = path or default_cache_dir('batches')
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.compresslevel = compresslevel
+        self.rescan_interval = rescan_interval
+        self._size = None
+        self._writes = 0
+        os.makedirs(self.path, exist_ok=True)
+    
+    def _entry_path(self, accn, start, size, variant=None):
+        name = '{}-{}'.format(start, size)
+        if variant:
+            name = '{}-{}'.format(name, variant)
+        return os.path.join(
+            self.path, _entry_name(accn), '{}.json.gz'.format(name))
+    
+    def get(self, accn, start, size, variant=None):
+        """Get a cached batch.
+        
+        Args:
+            accn: The accession.
+            start: The index of the first read in the batch.
+            size: The number of reads in the batch.
+            variant: Optional string that distinguishes different
+                representations of the same range of reads.
+        
+        Returns:
+            The list of reads, or None if the batch is not cached.
+        """
+        path = self._entry_path(accn, start, size, variant)
+        try:
+            with open(path, 'rb') as inp:
+                data = inp.read()
+            # mark as recently used
+            os.utime(path)
+        except OSError:
+            return None
+        reads = json.loads(gzip.decompress(data).decode('utf-8'))
+        return [_to_tuple(read) for read in reads]
+    
+    def put(self, accn, start, size, reads, variant=None):
+        """Add a batch to the cache, evicting old batches if necessary.
+        
+        Args:
+            accn: The accession.
+            start: The index of the first read in the batch.
+            size: The number of reads in the batch.
+            reads: The list of reads.
+            variant: Optional string that distinguishes different
+                representations of the same range of reads.
+        """
+        path = self._entry_path(accn, start, size, variant)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = gzip.compress(
+            json.dumps(reads).encode('utf-8'), self.compresslevel)
+        write_atomic(path, data)
+        self._writes += 1
+        if self._size is None or self._writes % self.rescan_interval == 0:
+            self._size = None
+        else:
+            self._size += len(data)
+        if self._size is None or self._size > self.max_bytes:
+            self.evict()
+    
+    def get_or_fetch(self, accn, start, size, fetch, variant=None):
+        """Get a batch from the cache, or fetch and cache it.
+        
+        Args:
+            accn: The accession.
+            start: The index of the first read in the batch.
+            size: The number of reads in the batch.
+            fetch: Function with no arguments that fetches the batch.
+            variant: Optional string that distinguishes different
+                representations of the same range of reads.
+        
+        Returns:
+            The list of reads.
+        """
+        reads = self.get(accn, start, size, variant)
+        if reads is None:
+            reads = fetch()
+            self.put(accn, start, size, reads, variant)
+        return reads
+    
+    def _entries(self):
+        """List (last_used, bytes, path) for all batches in the cache.
+        """
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if not name.endswith('.json.gz'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+    
+    def evict(self):
+        """If the cache is over its size budget, remove the least recently
+        used batches until it is within `low_water` of the budget.
+        """
+        entries = self._entries()
+        total = sum(entry[1] for entry in entries)
+        if total > self.max_bytes:
+            target = self.max_bytes * self.low_water
+            entries.sort()
+            for _, nbytes, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= nbytes
+        self._size = total
+    
+    def clear(self):
+        """Remove all batches.
+        """
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._size = 0
@@ -1,6 +1,16 @@
 """srastream utility classes.
 """
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+import functools
+import itertools
 import math
+import queue
+import random
+import statistics
+import threading
+import time
 
 class Batcher(object):
     """Creates iterators over batches of items. Assuming a sequence of items,
@@ -30,6 +40,34 @@ class Batcher(object):
         batch_step: The number of batches to advance between successive 
             iterations.
         progress: Whether to wrap the iterator in a progress bar.
+        adaptive: Whether to adapt the batch size to the observed throughput.
+            The first batch has `min_batch_size` items, so that the first
+            items are available quickly. After that, each batch is sized so
+            that it takes about `target_latency` seconds, based on the time
+            between the previous batch being yielded and the next batch being
+            requested (i.e. the time the consumer took to fetch and process
+            it). The batch size at most doubles or halves from one batch to
+            the next. `batch_size` is ignored, and the batch-level limits
+            (`batch_start`, `batch_stop` and `batch_step`) are not supported,
+            since batch boundaries depend on timing. Batches must be fetched
+            as they are requested; if they are requested ahead of being
+            fetched (e.g. by :func:`ordered_map`), the time between requests
+            does not reflect the fetch time, and batches grow to
+            `max_batch_size`.
+        min_batch_size: The smallest (and first) batch size in adaptive mode.
+        max_batch_size: The largest batch size in adaptive mode.
+        target_latency: The target time, in seconds, to spend on each batch in
+            adaptive mode.
+        shard_index: The index (0-based) of the shard of batches to return.
+        num_shards: The number of shards into which to partition the batches,
+            e.g. to split a dump across multiple nodes. The partition is
+            applied after all other limits, so shards are balanced to within
+            one batch, and is deterministic, so that together the shards
+            cover every batch exactly once. Batch numbers are those of the
+            unsharded sequence. Not supported in adaptive mode.
+        shard_mode: How batches are assigned to shards: 'contiguous' (each
+            shard gets a contiguous run of batches) or 'interleaved' (shard i
+            gets batches i, i + num_shards, i + 2*num_shards, ...).
     
     Examples:
         # Given a sequence of size 10, we define a batcher that yields 3 batches 
@@ -41,7 +79,20 @@ class Batcher(object):
     """
     def __init__(
             self, item_start=0, item_stop=None, item_limit=None, batch_start=0, 
-            batch_stop=None, batch_size=1000, batch_step=1, progress=False):
+            batch_stop=None, batch_size=1000, batch_step=1, progress=False,
+            adaptive=False, min_batch_size=100, max_batch_size=100000,
+            target_latency=1.0, shard_index=0, num_shards=1,
+            shard_mode='contiguous'):
+        if adaptive and (
+                batch_start or batch_stop or batch_step != 1 or num_shards > 1):
+            raise ValueError(
+                "Batch-level limits and sharding cannot be used with adaptive "
+                "batch sizes")
+        if not 0 <= shard_index < num_shards:
+            raise ValueError("Invalid shard {} of {}".format(
+                shard_index, num_shards))
+        if shard_mode not in ('contiguous', 'interleaved'):
+            raise ValueError("Invalid shard mode {}".format(shard_mode))
         self.item_start = item_start
         self.item_stop = item_stop
         self.item_limit = item_limit
@@ -49,6 +100,13 @@ class Batcher(object):
         self.batch_stop = batch_stop
         self.batch_size = batch_size
         self.batch_step = batch_step
+        self.adaptive = adaptive
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.target_latency = target_latency
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        self.shard_mode = shard_mode
         
         if progress is True:
             try:
@@ -72,11 +130,39 @@ class Batcher(object):
             The later two can be used to index into a sequence (e.g. 
             seq[start:(start+size)]).
         """
+        if self.adaptive:
+            itr = self._adaptive_batches(total)
+            if self.progress:
+                itr = self.progress(itr)
+            yield from itr
+            return
+        
+        # iterate over batches, possibly wrapping with a progress bar
+        itr = self.batches(total)
+        if self.progress:
+            itr = self.progress(itr, total=len(itr))
+        yield from itr
+    
+    def batches(self, total):
+        """Create a lazy sequence of batches. No batches are enumerated, so
+        this takes constant time and memory regardless of the number of
+        batches. Not supported in adaptive mode.
+        
+        Args:
+            total: The total number of items in the sequence.
+        
+        Returns:
+            A :class:`BatchRange` of the (batch_num, start, size) tuples that
+            would be yielded by ``self(total)``.
+        """
+        if self.adaptive:
+            raise ValueError("Adaptive batches cannot be computed in advance")
+        
         # determine the last read in the slice
         stop = min(total, self.item_stop) if self.item_stop else total
         
-        # enumerate the batch start indices
-        starts = list(range(self.item_start, stop, self.batch_size))
+        # the batch start indices
+        starts = range(self.item_start, stop, self.batch_size)
         
         # subset batches
         batch_stop = len(starts)
@@ -90,21 +176,69 @@ class Batcher(object):
             limit = min(limit, self.item_limit)
         
         # determine the number of batches based on the number of items
-        batches = math.ceil(limit / self.batch_size)
+        batches = -(-limit // self.batch_size)
         if batches < len(starts):
             starts = starts[:batches]
         
-        # iterate over starts, possibly wrapping with a progress bar
-        itr = starts
-        if self.progress:
-            itr = self.progress(itr, total=batches)
+        return self.shard(BatchRange(starts, self.batch_size, limit, stop))
+    
+    def shard(self, batches):
+        """Select this Batcher's shard of a sequence of batches (see
+        `num_shards` and `shard_mode`). This is applied by :meth:`batches`,
+        and can be applied to batches defined in other ways, e.g. the ranges
+        of a :class:`Sampler`.
+        
+        Args:
+            batches: A sequence of batches that supports slicing, or an
+                iterator over batches. Contiguous sharding needs the number
+                of batches, so an iterator is then read into a list.
         
-        # yield batch_num, batch_start, batch_size tuples
-        for batch_num, start in enumerate(itr):
-            size = self.batch_size
-            if batch_num == (batches-1):
-                size = limit - (batch_num * size)
+        Returns:
+            The subsequence of batches in this shard, or an iterator over
+            them if `batches` is an iterator.
+        """
+        if self.num_shards < 2:
+            return batches
+        if not hasattr(batches, '__getitem__'):
+            if self.shard_mode == 'interleaved':
+                return itertools.islice(
+                    batches, self.shard_index, None, self.num_shards)
+            batches = list(batches)
+        if self.shard_mode == 'interleaved':
+            return batches[self.shard_index::self.num_shards]
+        num_batches = len(batches)
+        return batches[
+            (num_batches * self.shard_index) // self.num_shards:
+            (num_batches * (self.shard_index + 1)) // self.num_shards]
+    
+    def _adaptive_batches(self, total):
+        """Iterate over batches whose sizes adapt to the observed throughput.
+        """
+        start = self.item_start
+        stop = min(total, self.item_stop) if self.item_stop else total
+        if self.item_limit:
+            stop = min(stop, start + self.item_limit)
+        size = self.min_batch_size
+        batch_num = 0
+        while start < stop:
+            size = min(size, stop - start)
+            yielded = time.monotonic()
             yield (batch_num, start, size)
+            elapsed = time.monotonic() - yielded
+            start += size
+            batch_num += 1
+            size = self._next_batch_size(size, elapsed)
+    
+    def _next_batch_size(self, size, elapsed):
+        """Determine the next adaptive batch size, given that the previous
+        batch of `size` items took `elapsed` seconds.
+        """
+        if elapsed > 0:
+            target = size * self.target_latency / elapsed
+        else:
+            target = size * 2
+        target = max(size / 2, min(size * 2, target))
+        return int(max(self.min_batch_size, min(self.max_batch_size, target)))
     
     def batches_from_sequence(self, seq, total=None, items_only=False):
         """Create an iterator over batches of items from a sequence.
@@ -122,8 +256,923 @@ class Batcher(object):
         if total is None:
             total = len(seq)
         for batch in self(total):
-            items = seq[batch[1]:batch[2]]
+            items = seq[batch[1]:(batch[1] + batch[2])]
             if items_only:
                 yield items
             else:
                 yield batch + (items,)
+
+class BatchRange(object):
+    """A lazy, immutable sequence of (batch_num, start, size) tuples, as
+    created by :meth:`Batcher.batches`. The start and size of each batch are
+    computed on demand, so the length, indexing and slicing all take
+    constant time. Slicing preserves the batch numbers, e.g. ``batches[10:]``
+    starts with batch number 10.
+    
+    Args:
+        starts: A range of the start index of each batch.
+        batch_size: The size of each batch.
+        limit: The total number of items in all batches, which determines the
+            size of the last batch.
+        stop: The index after the last item; no batch extends beyond it.
+        indices: The range of batch numbers in this sequence. Defaults to all
+            batches.
+    """
+    def __init__(self, starts, batch_size, limit, stop, indices=None):
+        self.starts = starts
+        self.batch_size = batch_size
+        self.limit = limit
+        self.stop = stop
+        self.indices = range(len(starts)) if indices is None else indices
+    
+    def __len__(self):
+        return len(self.indices)
+    
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return BatchRange(
+                self.starts, self.batch_size, self.limit, self.stop,
+                self.indices[key])
+        return self._batch(self.indices[key])
+    
+    def __iter__(self):
+        for batch_num in self.indices:
+            yield self._batch(batch_num)
+    
+    def _batch(self, batch_num):
+        start = self.starts[batch_num]
+        size = self.batch_size
+        if batch_num == len(self.starts) - 1:
+            size = self.limit - (batch_num * size)
+        return (batch_num, start, min(size, self.stop - start))
+
+class Sampler(object):
+    """Draws a reproducible random sample of items (e.g. reads) and groups
+    the sampled indices into ranges that can be fetched efficiently (see
+    :func:`coalesce_ranges`). Unlike subsampling with `Batcher.batch_step`,
+    which selects whole batches, every item in the slice has the same
+    probability of being sampled.
+    
+    Exactly one of `fraction`, `count`, or `coverage` must be specified.
+    The sampled indices are generated lazily, in ascending order, so that
+    memory use does not depend on the number of items.
+    
+    Args:
+        fraction: The probability with which each item is sampled. The size
+            of the sample therefore varies around `fraction` of the items.
+        count: The number of items to sample.
+        coverage: The target coverage (depth) of the sample. Requires
+            `genome_size`, and the number of bases per item must be passed
+            when the Sampler is called.
+        genome_size: The genome size, for computing `coverage`.
+        seed: The random seed.
+        item_start: The first item that may be sampled.
+        item_stop: The item after the last item that may be sampled, or None
+            for all items.
+        max_gap: The maximum number of unsampled items to fetch between two
+            sampled items rather than starting a new range.
+        batch_size: The maximum size of each range.
+    
+    Examples:
+        # sample 10% of reads
+        with SraReader(accn, sample=Sampler(fraction=0.1, seed=1)) as reader:
+            for reads in reader:
+                ...
+    """
+    def __init__(
+            self, fraction=None, count=None, coverage=None, genome_size=None,
+            seed=None, item_start=0, item_stop=None, max_gap=100,
+            batch_size=1000):
+        if sum(arg is not None for arg in (fraction, count, coverage)) != 1:
+            raise ValueError(
+                "Exactly one of fraction, count, or coverage is required")
+        if coverage is not None and not genome_size:
+            raise ValueError("genome_size is required with coverage")
+        self.fraction = fraction
+        self.count = count
+        self.coverage = coverage
+        self.genome_size = genome_size
+        self.seed = seed
+        self.item_start = item_start
+        self.item_stop = item_stop
+        self.max_gap = max_gap
+        self.batch_size = batch_size
+    
+    def population(self, total):
+        """The range of items that may be sampled.
+        
+        Args:
+            total: The total number of items.
+        """
+        stop = min(total, self.item_stop) if self.item_stop else total
+        return range(self.item_start, stop)
+    
+    def sample_size(self, total, bases_per_item=None):
+        """The number of items to sample (the expected number, when sampling
+        a `fraction`).
+        
+        Args:
+            total: The total number of items.
+            bases_per_item: The number of bases per item, required for
+                coverage-based sampling.
+        """
+        population = len(self.population(total))
+        if self.fraction is not None:
+            size = int(round(self.fraction * population))
+        elif self.count is not None:
+            size = self.count
+        else:
+            if not bases_per_item:
+                raise ValueError(
+                    "bases_per_item is required for coverage-based sampling")
+            size = int(math.ceil(
+                self.coverage * self.genome_size / bases_per_item))
+        return min(size, population)
+    
+    def indices(self, total, bases_per_item=None):
+        """Draw the sample.
+        
+        Args:
+            total: The total number of items.
+            bases_per_item: The number of bases per item, required for
+                coverage-based sampling.
+        
+        Returns:
+            A sorted list of item indices.
+        """
+        return list(self.iter_indices(total, bases_per_item))
+    
+    def iter_indices(self, total, bases_per_item=None):
+        """Draw the sample lazily.
+        
+        Args:
+            total: The total number of items.
+            bases_per_item: The number of bases per item, required for
+                coverage-based sampling.
+        
+        Yields:
+            Sampled item indices, in ascending order.
+        """
+        population = self.population(total)
+        rng = random.Random(self.seed)
+        if self.fraction is not None:
+            offsets = _bernoulli_sample(rng, len(population), self.fraction)
+        else:
+            offsets = _sequential_sample(
+                rng, len(population), self.sample_size(total, bases_per_item))
+        for offset in offsets:
+            yield population.start + offset
+    
+    def __call__(self, total, bases_per_item=None):
+        """Draw the sample and group it into ranges.
+        
+        Args:
+            total: The total number of items.
+            bases_per_item: The number of bases per item, required for
+                coverage-based sampling.
+        
+        Yields:
+            Tuples (batch_num, start, size, members), where members is the
+            list of sampled indices in range(start, start + size).
+        """
+        ranges = coalesce_ranges(
+            self.iter_indices(total, bases_per_item), self.max_gap,
+            self.batch_size)
+        for batch_num, (start, size, members) in enumerate(ranges):
+            yield (batch_num, start, size, members)
+
+def _bernoulli_sample(rng, population, fraction):
+    """Select each of `population` items with probability `fraction`, by
+    skipping a geometrically distributed number of items between selections.
+    
+    Yields:
+        The selected indices, in ascending order.
+    """
+    if fraction >= 1:
+        yield from range(population)
+        return
+    if fraction <= 0:
+        return
+    log_q = math.log1p(-fraction)
+    index = -1
+    while True:
+        index += 1 + int(math.log(1.0 - rng.random()) / log_q)
+        if index >= population:
+            return
+        yield index
+
+def _sequential_sample(rng, population, size):
+    """Select `size` of `population` items uniformly at random using Vitter's
+    sequential sampling method D (falling back to method A once the sample
+    is dense), which takes time proportional to `size` rather than to
+    `population`.
+    
+    Yields:
+        The selected indices, in ascending order.
+    """
+    def uniform():
+        return 1.0 - rng.random()
+    n = min(size, population)
+    N = population
+    index = -1
+    if n <= 0:
+        return
+    ninv = 1.0 / n
+    vprime = math.exp(math.log(uniform()) * ninv)
+    qu1 = N - n + 1
+    while n > 1 and 13 * n < N:
+        nmin1inv = 1.0 / (n - 1)
+        while True:
+            while True:
+                x = N * (1.0 - vprime)
+                skip = int(x)
+                if skip < qu1:
+                    break
+                vprime = math.exp(math.log(uniform()) * ninv)
+            y1 = math.exp(math.log(uniform() * N / qu1) * nmin1inv)
+            vprime = y1 * (1.0 - x / N) * (qu1 / (qu1 - skip))
+            if vprime <= 1.0:
+                break
+            y2 = 1.0
+            top = N - 1.0
+            if n - 1 > skip:
+                bottom = float(N - n)
+                limit = N - skip
+            else:
+                bottom = N - skip - 1.0
+                limit = qu1
+            for _ in range(limit, N):
+                y2 = y2 * top / bottom
+                top -= 1.0
+                bottom -= 1.0
+            if N / (N - x) >= y1 * math.exp(math.log(y2) * nmin1inv):
+                vprime = math.exp(math.log(uniform()) * nmin1inv)
+                break
+            vprime = math.exp(math.log(uniform()) * ninv)
+        index += skip + 1
+        yield index
+        N -= skip + 1
+        n -= 1
+        ninv = nmin1inv
+        qu1 -= skip
+    if n == 1:
+        index += min(int(N * vprime), N - 1) + 1
+        yield index
+        return
+    # method A
+    top = N - n
+    while n > 0:
+        v = rng.random()
+        skip = 0
+        quot = top / N
+        while quot > v:
+            skip += 1
+            top -= 1
+            N -= 1
+            quot = quot * top / N
+        index += skip + 1
+        yield index
+        N -= 1
+        n -= 1
+
+def coalesce_ranges(indices, max_gap=0, max_size=1000):
+    """Group sorted indices into ranges that can each be fetched with a single
+    request. Consecutive indices are placed in the same range if they are
+    separated by at most `max_gap` unwanted items, and the range would not
+    exceed `max_size` items.
+    
+    Args:
+        indices: Iterable of unique indices in ascending order.
+        max_gap: The maximum number of unwanted items to fetch in order to
+            avoid starting a new range.
+        max_size: The maximum size of a range.
+    
+    Yields:
+        Tuples (start, size, members), where members is the list of wanted
+        indices in range(start, start + size).
+    
+    Examples:
+        list(coalesce_ranges([1, 2, 4, 10], max_gap=1))
+        # => [(1, 4, [1, 2, 4]), (10, 1, [10])]
+    """
+    start = prev = None
+    members = []
+    for index in indices:
+        if start is not None and (
+                index - prev - 1 > max_gap or index - start >= max_size):
+            yield (start, prev - start + 1, members)
+            start = None
+        if start is None:
+            start = index
+            members = []
+        members.append(index)
+        prev = index
+    if start is not None:
+        yield (start, prev - start + 1, members)
+
+def ordered_map(
+        executor, func, args_iterator, max_in_flight, speculate=None,
+        min_samples=5, poll_interval=0.05):
+    """Map `func` over argument tuples using an executor, yielding results in
+    the order in which the arguments were provided, regardless of the order in
+    which they complete.
+    
+    Args:
+        executor: A :class:`concurrent.futures.Executor`.
+        func: The function to call. Must be picklable if `executor` is a
+            ProcessPoolExecutor.
+        args_iterator: An iterator over tuples of arguments to `func`.
+        max_in_flight: The maximum number of submitted calls whose results have
+            not yet been yielded. Bounds memory usage when the consumer is
+            slower than the workers.
+        speculate: If not None, straggling calls are speculatively re-issued:
+            when the call whose result is next to be yielded has been running
+            for more than `speculate` times the median duration of completed
+            calls, it is submitted again (and so runs on another worker), and
+            whichever copy finishes first is used. `func` must therefore be
+            safe to call more than once with the same arguments.
+        min_samples: The number of calls that must complete before any call
+            is re-issued.
+        poll_interval: How often (in seconds) to check for stragglers.
+    
+    Yields:
+        The result of each call to `func`, in submission order.
+    """
+    if max_in_flight < 1:
+        raise ValueError("max_in_flight must be >= 1")
+    if speculate:
+        yield from _speculative_map(
+            executor, func, args_iterator, max_in_flight, speculate,
+            min_samples, poll_interval)
+        return
+    pending = deque()
+    try:
+        for args in args_iterator:
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, *args))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+def _timed_call(func, *args):
+    """Call `func`, and also return how long the call took.
+    
+    Returns:
+        The tuple (seconds, result).
+    """
+    start = time.monotonic()
+    result = func(*args)
+    return (time.monotonic() - start, result)
+
+def _speculative_map(
+        executor, func, args_iterator, max_in_flight, speculate, min_samples,
+        poll_interval):
+    """Implementation of :func:`ordered_map` with speculative re-issuing of
+    straggling calls.
+    """
+    timed_func = functools.partial(_timed_call, func)
+    durations = deque(maxlen=100)
+    
+    def get_result(args, future):
+        futures = [future]
+        started = None
+        while True:
+            done, _ = wait(
+                futures, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for finished in done:
+                if finished.exception() is None:
+                    for other in futures:
+                        if other is not finished:
+                            other.cancel()
+                    duration, result = finished.result()
+                    durations.append(duration)
+                    return result
+            if done:
+                if len(done) == len(futures):
+                    # every copy failed; raise the error of the first copy
+                    return futures[0].result()
+                futures = [other for other in futures if other not in done]
+            # only the original call is re-issued, and only once
+            if (futures[0] is not future or len(futures) > 1 or
+                    len(durations) < min_samples):
+                continue
+            # a call's duration is measured from when it is first seen
+            # running, since it may have waited in the executor's queue
+            now = time.monotonic()
+            if started is None:
+                if future.running():
+                    started = now
+            elif now - started > speculate * statistics.median(durations):
+                futures.append(executor.submit(timed_func, *args))
+    
+    pending = deque()
+    try:
+        for args in args_iterator:
+            if len(pending) >= max_in_flight:
+                yield get_result(*pending.popleft())
+            pending.append((args, executor.submit(timed_func, *args)))
+        while pending:
+            yield get_result(*pending.popleft())
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+def put_until_stopped(items, item, stop, timeout=0.1):
+    """Put an item on a bounded queue, blocking until there is room or until
+    `stop` is set (e.g. because the consumer has gone away).
+    
+    Args:
+        items: A :class:`queue.Queue`.
+        item: The item to put.
+        stop: A :class:`threading.Event`.
+        timeout: How often to check `stop`, in seconds.
+    
+    Returns:
+        True if the item was added, or False if `stop` was set.
+    """
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=timeout)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def prefetch(iterator, depth):
+    """Iterate over `iterator` in a background thread, buffering up to `depth`
+    items ahead of the consumer. This allows the work of producing the next
+    items (e.g. fetching reads) to overlap with the work of consuming the
+    current item (e.g. compressing and writing reads).
+    
+    Exceptions raised by `iterator` are re-raised in the consuming thread. If
+    the consumer stops iterating early, the background thread is signaled to
+    stop and joined before returning.
+    
+    Args:
+        iterator: The iterator to consume in the background.
+        depth: The maximum number of items to buffer.
+    
+    Yields:
+        The items of `iterator`, in order.
+    """
+    if depth < 1:
+        raise ValueError("depth must be >= 1")
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+    
+    def produce():
+        """Fill the queue from `iterator`.
+        """
+        try:
+            for item in iterator:
+                if not put_until_stopped(items, (item, None), stop):
+                    return
+        except Exception as err: # pylint: disable=broad-except
+            put_until_stopped(items, (None, err), stop)
+            return
+        put_until_stopped(items, (done, None), stop)
+    
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, err = items.get()
+            if err is not None:
+                raise err
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+class ColumnarBatch(object):
+    """A batch of reads stored as contiguous NumPy arrays rather than as
+    per-read tuples. Fragments are stored in read order, i.e. for paired-end
+    data the fragments of read i are at fragment indices
+    ``read_offsets[i]:read_offsets[i+1]``.
+    
+    Requires numpy.
+    
+    Args:
+        names: Array of read names (one per read).
+        bases: uint8 array of the concatenated bases of all fragments (ASCII
+            codes).
+        qualities: uint8 array of the concatenated base qualities of all
+            fragments (Phred scores, i.e. ASCII code - 33).
+        offsets: Array of the offset of each fragment in `bases`/`qualities`.
+        lengths: Array of the length of each fragment.
+        read_offsets: Array of size ``len(names) + 1`` giving the index of the
+            first fragment of each read.
+    
+    Examples:
+        with SraReader(accn, batch_size=10000) as reader:
+            for batch in reader.iter_columnar():
+                mean_quality = batch.qualities.mean()
+    """
+    def __init__(
+            self, names, bases, qualities, offsets, lengths, read_offsets):
+        self.names = names
+        self.bases = bases
+        self.qualities = qualities
+        self.offsets = offsets
+        self.lengths = lengths
+        self.read_offsets = read_offsets
+    
+    @staticmethod
+    def from_reads(reads):
+        """Create a ColumnarBatch from a sequence of :func:`sra_reads` tuples.
+        
+        Args:
+            reads: Sequence of tuples of (name, sequence, qualities) tuples.
+        
+        Returns:
+            A ColumnarBatch.
+        """
+        frags = [frag for read in reads for frag in read]
+        return ColumnarBatch.from_fragments(
+            [read[0][0] if read else '' for read in reads],
+            [frag[1] for frag in frags], [frag[2] for frag in frags],
+            [len(frag[1]) for frag in frags], [len(read) for read in reads])
+    
+    @staticmethod
+    def from_fragments(names, bases, qualities, lengths, num_fragments):
+        """Create a ColumnarBatch from buffers filled as reads are iterated
+        (see :func:`srastream.fetch_columnar`).
+        
+        Args:
+            names: List of read names (one per read).
+            bases: List of strings whose concatenation is the bases of all
+                fragments, in read order.
+            qualities: List of strings whose concatenation is the qualities
+                (ASCII codes) of all fragments, in read order.
+            lengths: List of the length of each fragment.
+            num_fragments: List of the number of fragments of each read.
+        
+        Returns:
+            A ColumnarBatch.
+        """
+        import numpy as np
+        lengths = np.array(lengths, dtype=np.int64)
+        offsets = np.zeros(len(lengths), dtype=np.int64)
+        if len(lengths) > 1:
+            np.cumsum(lengths[:-1], out=offsets[1:])
+        read_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum(
+            np.array(num_fragments, dtype=np.int64), out=read_offsets[1:])
+        bases = np.frombuffer(''.join(bases).encode('ascii'), dtype=np.uint8)
+        qualities = np.frombuffer(
+            ''.join(qualities).encode('ascii'), dtype=np.uint8) - 33
+        return ColumnarBatch(
+            np.array(names), bases, qualities, offsets, lengths, read_offsets)
+    
+    def __len__(self):
+        return len(self.names)
+    
+    @property
+    def num_fragments(self):
+        """The total number of fragments in the batch.
+        """
+        return len(self.lengths)
+    
+    def fragment(self, index):
+        """Get the bases and qualities arrays of a single fragment.
+        
+        Args:
+            index: The fragment index.
+        
+        Returns:
+            Tuple (bases, qualities) of array views.
+        """
+        start = self.offsets[index]
+        stop = start + self.lengths[index]
+        return (self.bases[start:stop], self.qualities[start:stop])
+    
+    def to_reads(self):
+        """Convert back to a list of :func:`sra_reads` tuples.
+        """
+        reads = []
+        for i, name in enumerate(self.names):
+            frags = []
+            for j in range(self.read_offsets[i], self.read_offsets[i+1]):
+                bases, quals = self.fragment(j)
+                frags.append((
+                    str(name),
+                    bases.tobytes().decode('ascii'),
+                    (quals + 33).astype('uint8').tobytes().decode('ascii')))
+            reads.append(tuple(frags))
+        return reads
+
+class HandlePool(object):
+    """A thread-safe pool of open handles (e.g. NGS read collections), keyed
+    by the name from which they are opened. Handles are reference counted:
+    :meth:`acquire` returns the already-open handle for a key if there is one,
+    and :meth:`release` does not close the handle, but keeps it open for
+    re-use until it has been idle for `idle_timeout` seconds.
+    
+    `max_open` is a soft limit: when it is reached, the least recently used
+    idle handle is closed to make room for a new one, but if all handles are
+    in use, `acquire` opens another handle rather than waiting (which could
+    deadlock a thread that holds one handle while acquiring another). Idle
+    handles in excess of `max_open` are closed as soon as they are released.
+    
+    Args:
+        open_handle: Function that opens a handle given a key.
+        close_handle: Function that closes a handle. Defaults to calling the
+            handle's `close` method.
+        max_open: The number of open handles above which idle handles are
+            closed.
+        idle_timeout: The number of seconds after which an idle handle is
+            closed, by a background timer.
+    """
+    def __init__(
+            self, open_handle, close_handle=None, max_open=16, idle_timeout=60):
+        self.open_handle = open_handle
+        self.close_handle = close_handle or (lambda handle: handle.close())
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self._cond = threading.Condition()
+        # key -> [handle, refcount, last_used]; handle is None while the
+        # handle is being opened
+        self._entries = {}
+        self._timer = None
+    
+    def __len__(self):
+        with self._cond:
+            return len(self._entries)
+    
+    def acquire(self, key):
+        """Get the open handle for `key`, opening it if necessary.
+        
+        Args:
+            key: The key.
+        
+        Returns:
+            The handle. Must be returned to the pool by calling
+            ``release(key)``.
+        """
+        with self._cond:
+            while True:
+                self._close_expired()
+                entry = self._entries.get(key)
+                if entry is None:
+                    break
+                if entry[0] is None:
+                    # another thread is opening this handle
+                    self._cond.wait()
+                    continue
+                entry[1] += 1
+                return entry[0]
+            if len(self._entries) >= self.max_open:
+                self._close_lru()
+            entry = [None, 1, None]
+            self._entries[key] = entry
+        # open outside the lock so that slow opens don't block other keys
+        try:
+            handle = self.open_handle(key)
+        except BaseException:
+            with self._cond:
+                del self._entries[key]
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            entry[0] = handle
+            self._cond.notify_all()
+        return handle
+    
+    def release(self, key):
+        """Return a handle acquired by :meth:`acquire` to the pool.
+        
+        Args:
+            key: The key.
+        """
+        with self._cond:
+            entry = self._entries[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                entry[2] = time.monotonic()
+            self._close_expired()
+            while len(self._entries) > self.max_open and self._close_lru():
+                pass
+            self._schedule_expiry()
+    
+    def close_idle(self):
+        """Close all handles that are not in use.
+        """
+        with self._cond:
+            for key, entry in list(self._entries.items()):
+                if entry[1] == 0:
+                    self._close(key)
+    
+    def _close(self, key):
+        handle = self._entries.pop(key)[0]
+        self.close_handle(handle)
+    
+    def _close_expired(self):
+        now = time.monotonic()
+        for key, entry in list(self._entries.items()):
+            if entry[1] == 0 and now - entry[2] >= self.idle_timeout:
+                self._close(key)
+    
+    def _close_lru(self):
+        """Close the least recently used idle handle.
+        
+        Returns:
+            True if a handle was closed, or False if all handles are in use.
+        """
+        idle = [
+            (entry[2], key) for key, entry in self._entries.items()
+            if entry[1] == 0]
+        if not idle:
+            return False
+        self._close(min(idle)[1])
+        return True
+    
+    def _schedule_expiry(self):
+        """Start a timer to close the idle handles as they expire, unless one
+        is already due to run by the time the first of them expires.
+        """
+        idle = [
+            entry[2] for entry in self._entries.values() if entry[1] == 0]
+        if not idle:
+            return
+        deadline = min(idle) + self.idle_timeout
+        timer = self._timer
+        if timer is not None and timer.is_alive():
+            if timer.deadline <= deadline:
+                return
+            timer.cancel()
+        self._timer = threading.Timer(
+            max(deadline - time.monotonic(), 0), self._expire)
+        self._timer.deadline = deadline
+        self._timer.daemon = True
+        self._timer.start()
+    
+    def _expire(self):
+        with self._cond:
+            if self._timer is threading.current_thread():
+                self._timer = None
+            self._close_expired()
+            self._schedule_expiry()
+
+LATENCY_BUCKETS = (
+    0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50,
+    100)
+"""Default upper bounds (in seconds) of the latency histogram buckets."""
+
+class Metrics(object):
+    """Collects throughput and latency metrics for the stages of streaming
+    reads (e.g. opening the read collection, fetching batches, writing
+    output). Measurements are made once per batch rather than per read, so
+    metrics are cheap enough to leave enabled. Metrics may be recorded from
+    multiple threads. Measurements made in worker processes are recorded in
+    a :class:`MetricsLog`, which is returned to the parent process and added
+    using :meth:`merge`.
+    
+    Each stage accumulates the number of measurements, the total time, the
+    number of items (e.g. reads) and bytes processed, and a histogram of
+    the duration of each measurement. Counters accumulate arbitrary counts
+    (e.g. the number of calls into the NGS library).
+    
+    Args:
+        callbacks: Functions to call with the arguments (stage, seconds,
+            items, nbytes) each time a measurement is recorded, e.g. to
+            export metrics to a monitoring system.
+        buckets: Upper bounds, in seconds, of the histogram buckets. There is
+            an additional bucket for longer durations.
+    
+    Examples:
+        metrics = Metrics(callbacks=[
+            lambda stage, seconds, items, nbytes: print(stage, seconds)])
+        result = sra_dump(accn, metrics=metrics)
+        print(result['metrics']['reads_per_second'])
+    """
+    def __init__(self, callbacks=(), buckets=LATENCY_BUCKETS):
+        self.callbacks = list(callbacks)
+        self.buckets = tuple(buckets)
+        self.started = time.monotonic()
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+    
+    def record(self, stage, seconds, items=0, nbytes=0):
+        """Record a measurement.
+        
+        Args:
+            stage: The name of the stage.
+            seconds: The duration of the measurement.
+            items: The number of items processed.
+            nbytes: The number of bytes processed.
+        """
+        with self._lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = [0, 0.0, 0, 0, [0] * (len(self.buckets) + 1)]
+                self.stages[stage] = stats
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] += items
+            stats[3] += nbytes
+            stats[4][bisect_left(self.buckets, seconds)] += 1
+        for callback in self.callbacks:
+            callback(stage, seconds, items, nbytes)
+    
+    def count(self, counter, num=1):
+        """Increment a counter.
+        
+        Args:
+            counter: The name of the counter.
+            num: The amount by which to increment the counter.
+        """
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + num
+    
+    def merge(self, log):
+        """Record the measurements and counts in a :class:`MetricsLog`.
+        
+        Args:
+            log: The MetricsLog.
+        """
+        for measurement in log.measurements:
+            self.record(*measurement)
+        for counter, num in log.counters.items():
+            self.count(counter, num)
+    
+    def summary(self):
+        """Summarize the metrics.
+        
+        Returns:
+            A JSON-serializable dict with keys 'elapsed' (seconds since the
+            Metrics was created), 'counters', and 'stages'. Stages maps each
+            stage to a dict with keys calls, seconds, items, bytes,
+            items_per_second and bytes_per_second (while the stage was
+            active), and histogram (the number of measurements in each
+            non-empty bucket, keyed by the bucket's upper bound).
+        """
+        labels = [str(bound) for bound in self.buckets] + ['+Inf']
+        stages = {}
+        with self._lock:
+            for stage, stats in self.stages.items():
+                calls, seconds, items, nbytes, histogram = stats
+                stages[stage] = dict(
+                    calls=calls, seconds=seconds, items=items, bytes=nbytes,
+                    items_per_second=items / seconds if seconds else None,
+                    bytes_per_second=nbytes / seconds if seconds else None,
+                    histogram=dict(
+                        (label, num)
+                        for label, num in zip(labels, histogram) if num))
+            counters = dict(self.counters)
+        return dict(
+            elapsed=time.monotonic() - self.started, counters=counters,
+            stages=stages)
+
+class MetricsLog(object):
+    """Records measurements and counts with the same methods as
+    :class:`Metrics`, but only keeps a log of them. A MetricsLog can be
+    pickled, so that the measurements made while fetching a batch in a
+    worker process can be returned along with the batch and added to the
+    Metrics of the parent process using :meth:`Metrics.merge`.
+    """
+    def __init__(self):
+        self.measurements = []
+        self.counters = {}
+    
+    def record(self, stage, seconds, items=0, nbytes=0):
+        """Record a measurement (see :meth:`Metrics.record`).
+        """
+        self.measurements.append((stage, seconds, items, nbytes))
+    
+    def count(self, counter, num=1):
+        """Increment a counter (see :meth:`Metrics.count`).
+        """
+        self.counters[counter] = self.counters.get(counter, 0) + num
+
+def timed_batches(batches, metrics, stage):
+    """Wrap an iterator over batches, recording the time spent waiting for
+    each batch.
+    
+    Args:
+        batches: Iterator over sized batches.
+        metrics: A :class:`Metrics`.
+        stage: The name of the stage to record.
+    
+    Yields:
+        The batches.
+    """
+    batches = iter(batches)
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            metrics.record(stage, time.perf_counter() - started, len(batch))
+            yield batch
+    finally:
+        if hasattr(batches, 'close'):
+            batches.close()
@@ -0,0 +1,182 @@
+"""Coordinating the fetching of batches between processes and hosts using a
+shared work queue.
+"""
+from contextlib import contextmanager
+import json
+import sqlite3
+import time
+
+class WorkQueue(object):
+    """A queue of batches stored in an SQLite database, from which workers
+    (processes on one host, or hosts sharing a filesystem) dynamically claim
+    batches. Unlike static sharding, fast workers simply claim more batches,
+    so slow ranges do not leave the other workers idle.
+    
+    A claimed batch that is not completed within `lease` seconds is assumed
+    to belong to a worker that died, and may be claimed by another worker.
+    Workers should therefore write their output such that a batch can be
+    redone (e.g. by writing each batch to its own file atomically).
+    
+    The database relies on SQLite file locking, which requires a filesystem
+    with working POSIX locks (this is not the case for some NFS
+    configurations).
+    
+    Args:
+        path: Path to the database file, which is created if it does not
+            exist.
+        lease: The number of seconds after which an uncompleted batch may be
+            claimed again.
+        timeout: The number of seconds to wait for another worker to release
+            the database lock.
+    
+    Examples:
+        # in each worker process
+        with WorkQueue('SRR1.queue.db') as work_queue:
+            work_queue.populate(Batcher(batch_size=10000).batches(read_count))
+            while True:
+                batch = work_queue.claim()
+                if batch is None:
+                    break
+                batch_num, start, size = batch
+                ...
+                work_queue.complete(batch_num, dict(read_count=size))
+    """
+    def __init__(self, path, lease=600, timeout=60):
+        self.path = path
+        self.lease = lease
+        self.db = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        with self._transaction():
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS batches ("
+                "batch_num INTEGER PRIMARY KEY, start INTEGER NOT NULL, "
+                "size INTEGER NOT NULL, worker TEXT, claimed REAL, "
+                "done INTEGER NOT NULL DEFAULT 0, result TEXT)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS info ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+    
+    @contextmanager
+    def _transaction(self):
+        """Execute statements in a transaction that holds the database write
+        lock from the start, so that claims are atomic across processes.
+        """
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+    
+    def populate(self, batches, **info):
+        """Add batches to the queue, unless it has already been populated
+        (e.g. by another worker).
+        
+        Args:
+            batches: Iterable of (batch_num, start, size) tuples, e.g. a
+                :class:`srastream.utils.BatchRange`.
+            info: JSON-serializable values to store with the queue (see
+                :meth:`info`).
+        
+        Returns:
+            True if the queue was populated by this call, otherwise False.
+        """
+        with self._transaction():
+            populated = self.db.execute(
+                "SELECT 1 FROM info WHERE key = 'populated'").fetchone()
+            if populated:
+                return False
+            self.db.executemany(
+                "INSERT INTO batches (batch_num, start, size) VALUES (?, ?, ?)",
+                batches)
+            info['populated'] = True
+            self.db.executemany(
+                "INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)",
+                ((key, json.dumps(value)) for key, value in info.items()))
+        return True
+    
+    def info(self):
+        """Get the values stored by :meth:`populate`.
+        
+        Returns:
+            A dict.
+        """
+        return dict(
+            (key, json.loads(value))
+            for key, value in self.db.execute("SELECT key, value FROM info"))
+    
+    def claim(self, worker=None):
+        """Claim the next batch that has not been claimed, or whose lease has
+        expired.
+        
+        Args:
+            worker: Optional identifier of the claiming worker, for
+                diagnostics.
+        
+        Returns:
+            The tuple (batch_num, start, size), or None if there are no
+            batches left to claim.
+        """
+        now = time.time()
+        with self._transaction():
+            batch = self.db.execute(
+                "SELECT batch_num, start, size FROM batches WHERE done = 0 "
+                "AND (claimed IS NULL OR claimed < ?) ORDER BY batch_num "
+                "LIMIT 1", (now - self.lease,)).fetchone()
+            if batch is not None:
+                self.db.execute(
+                    "UPDATE batches SET worker = ?, claimed = ? "
+                    "WHERE batch_num = ?", (worker, now, batch[0]))
+        return batch
+    
+    def complete(self, batch_num, result=None):
+        """Mark a batch as done.
+        
+        Args:
+            batch_num: The batch number.
+            result: JSON-serializable result of processing the batch (e.g. the
+                names of its output files), which is returned by
+                :meth:`results`.
+        """
+        with self._transaction():
+            self.db.execute(
+                "UPDATE batches SET done = 1, result = ? WHERE batch_num = ?",
+                (json.dumps(result), batch_num))
+    
+    def progress(self):
+        """Get the progress of the queue.
+        
+        Returns:
+            The tuple (done, total) of numbers of batches.
+        """
+        return self.db.execute(
+            "SELECT COALESCE(SUM(done), 0), COUNT(*) FROM batches").fetchone()
+    
+    def is_complete(self):
+        """Whether the queue has been populated and all batches are done.
+        """
+        done, total = self.progress()
+        return done == total and 'populated' in self.info()
+    
+    def results(self):
+        """Get the results of the completed batches.
+        
+        Returns:
+            A list of (batch_num, start, size, result) tuples, in batch order.
+        """
+        return [
+            (batch_num, start, size, json.loads(result))
+            for batch_num, start, size, result in self.db.execute(
+                "SELECT batch_num, start, size, result FROM batches "
+                "WHERE done = 1 ORDER BY batch_num")]
+    
+    def close(self):
+        """Close the database connection.
+        """
+        self.db.close()
@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
 """Writing reads to files.
 """
+import bz2
 import copy
+import functools
+import gzip
+import json
+import lzma
 import os
 from subprocess import Popen, PIPE
+import time
 from xphyle import xopen
+from .cache import write_atomic
 
 class BatchWriter(object):
     """Wrapper for a string writer (e.g. FifoWriter) that improves performance
@@ -19,7 +26,20 @@ class BatchWriter(object):
             file format (should be passed by the subclass in a
             super().__init__ call).
         linesep: The separator to use between each line (defaults to os.linesep)
+    
+    Attributes:
+        fields: The read fields (see :data:`srastream.READ_FIELDS`) used by
+            the output format. Fields that are not used need not be fetched.
+        extension: The default file extension of the output format.
+        metrics: A :class:`srastream.utils.Metrics`, or None. If set, each
+            flush records the 'output' stage: the time spent in the string
+            writer (which includes compression, or blocking on a full FIFO),
+            the number of reads, and the number of (uncompressed) bytes.
     """
+    fields = ('name', 'bases', 'qualities')
+    extension = None
+    metrics = None
+    
     def __init__(self, writer, batch_size, lines_per_row, linesep=os.linesep):
         self.writer = writer
         self.batch_size = batch_size
@@ -58,6 +78,30 @@ class BatchWriter(object):
         if self.index >= self.bufsize:
             self.flush()
     
+    def write_batch(self, reads):
+        """Add a sequence of reads/pairs to the buffer, writing to the
+        underlying writer each time the buffer fills. Equivalent to calling
+        ``self(*read)`` for each read, but with less per-read overhead.
+        
+        Args:
+            reads: Sequence of tuples (read1, [read2]), e.g. as yielded by
+                :meth:`srastream.SraReader.iter_batches`.
+        """
+        add_to_batch = self.add_to_batch
+        lines_per_row = self.lines_per_row
+        bufsize = self.bufsize
+        index = self.index
+        for read in reads:
+            add_to_batch(*read[0], self.read1_batch, index)
+            if len(read) > 1:
+                add_to_batch(*read[1], self.read2_batch, index)
+            index += lines_per_row
+            if index >= bufsize:
+                self.index = index
+                self.flush()
+                index = 0
+        self.index = index
+    
     def add_to_batch(self, name, sequence, qualities, batch, index):
         """Add a read to the batch. Must be implemented by a subclass.
 
@@ -91,8 +135,17 @@ class BatchWriter(object):
         reads = [batch_to_str(self.read1_batch)]
         if self.paired:
             reads.append(batch_to_str(self.read2_batch))
-        self.writer(*reads)
-        self.writer(*self._end_records)
+        if self.metrics is None:
+            self.writer(*reads)
+            self.writer(*self._end_records)
+        else:
+            started = time.perf_counter()
+            self.writer(*reads)
+            self.writer(*self._end_records)
+            self.metrics.record(
+                'output', time.perf_counter() - started,
+                self.index // self.lines_per_row,
+                sum(len(string) + len(self.linesep) for string in reads))
         self.index = 0
     
     def close(self):
@@ -106,6 +159,8 @@ class BatchWriter(object):
 class FastqWriter(BatchWriter):
     """BatchWriter implementation for FASTQ format.
     """
+    extension = 'fq'
+    
     def __init__(self, writer, batch_size):
         super(FastqWriter, self).__init__(writer, batch_size, 4)
     
@@ -117,6 +172,110 @@ class FastqWriter(BatchWriter):
         batch[index+1] = sequence
         batch[index+3] = qualities
 
+class FastaWriter(BatchWriter):
+    """BatchWriter implementation for FASTA format. Qualities are not written,
+    so they do not need to be fetched.
+    """
+    fields = ('name', 'bases')
+    extension = 'fa'
+    
+    def __init__(self, writer, batch_size):
+        super(FastaWriter, self).__init__(writer, batch_size, 2)
+    
+    def add_to_batch(self, name, sequence, qualities, batch, index):
+        batch[index] = '>' + name
+        batch[index+1] = sequence
+
+READ_WRITERS = {
+    'fastq': FastqWriter,
+    'fasta': FastaWriter
+}
+"""BatchWriter classes for the supported read output formats."""
+
+class SamWriter(BatchWriter):
+    """BatchWriter implementation for SAM format. Each read is a tuple of the
+    11 mandatory SAM fields (qname, flag, rname, pos, mapq, cigar, rnext,
+    pnext, tlen, seq, qual), e.g. as yielded by
+    :class:`srastream.alignments.AlignmentReader`. Only single-end (i.e.
+    single file) output is supported.
+    
+    Args:
+        writer: The string writer to wrap.
+        batch_size: The size of the read buffer.
+        header: The SAM header, which is written before any reads.
+    """
+    extension = 'sam'
+    
+    def __init__(self, writer, batch_size, header=None):
+        super(SamWriter, self).__init__(writer, batch_size, 1)
+        if header:
+            self.writer(header.rstrip('\n') + self.linesep)
+    
+    def add_to_batch(self, *args): # pylint: disable=arguments-differ
+        """Add a record to the batch.
+        
+        Args:
+            args: The SAM fields, followed by the batch and the item index.
+        """
+        batch, index = args[-2:]
+        batch[index] = '\t'.join(str(field) for field in args[:-2])
+
+class ChunkedFastaWriter(object):
+    """Writes sequences in FASTA format, with a fixed line length. Each
+    sequence may be written in multiple chunks (e.g. as yielded by
+    :class:`srastream.alignments.ReferenceReader`), so that the whole sequence
+    never needs to be held in memory.
+    
+    Args:
+        writer: The string writer to wrap (single-end).
+        line_length: The maximum number of bases per line.
+        linesep: The separator to use between each line (defaults to os.linesep)
+    """
+    def __init__(self, writer, line_length=70, linesep=os.linesep):
+        self.writer = writer
+        self.line_length = line_length
+        self.linesep = linesep
+        self.name = None
+        self.remainder = ''
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+    
+    def __call__(self, name, bases):
+        """Write a chunk of a sequence. A new FASTA record is started whenever
+        `name` differs from the name of the previous chunk.
+        
+        Args:
+            name: The sequence name.
+            bases: The next chunk of the sequence.
+        """
+        if name != self.name:
+            self._end_record()
+            self.writer('>' + name + self.linesep)
+            self.name = name
+        bases = self.remainder + bases
+        line_length = self.line_length
+        full = len(bases) - (len(bases) % line_length)
+        if full:
+            self.writer(self.linesep.join(
+                bases[i:(i + line_length)]
+                for i in range(0, full, line_length)) + self.linesep)
+        self.remainder = bases[full:]
+    
+    def _end_record(self):
+        if self.remainder:
+            self.writer(self.remainder + self.linesep)
+            self.remainder = ''
+    
+    def close(self):
+        """Write any remaining bases and close the underlying string writer.
+        """
+        self._end_record()
+        self.writer.close()
+
 class StringWriter(object):
     """Interface for classes that write strings to files.
     """
@@ -191,3 +350,165 @@ class FileWriter(StringWriter):
         self.file1.close()
         if self.paired:
             self.file2.close()
+
+COMPRESSORS = dict(gz=gzip.compress, bz2=bz2.compress, xz=lzma.compress)
+"""Functions that compress a bytes object into a complete, independently
+decompressible stream. Decompressors for all of these formats accept
+multiple concatenated streams."""
+
+COMPRESSION_LEVELS = dict(gz=4, bz2=9, xz=2)
+"""The default compression level of each format, which matches the default
+used by xphyle (and therefore by :class:`FileWriter`)."""
+
+def get_compressor(compression, compresslevel=None):
+    """Get a function that compresses a bytes object into a complete stream.
+    
+    Args:
+        compression: The compression format (one of the keys of
+            `COMPRESSORS`), or None.
+        compresslevel: The compression level, or None for the default level
+            of the format (see `COMPRESSION_LEVELS`).
+    
+    Returns:
+        A function, or None if `compression` is None.
+    """
+    if not compression:
+        return None
+    if compression not in COMPRESSORS:
+        raise ValueError("Unsupported compression {}".format(compression))
+    if compresslevel is None:
+        compresslevel = COMPRESSION_LEVELS[compression]
+    if compression == 'xz':
+        return functools.partial(lzma.compress, preset=compresslevel)
+    return functools.partial(
+        COMPRESSORS[compression], compresslevel=compresslevel)
+
+class CheckpointFileWriter(StringWriter):
+    """String writer that writes to a pair of files in a way that allows
+    writing to be resumed after a failure. Strings are buffered in memory until
+    :meth:`sync` is called, at which point the buffered data are written
+    (as a separate compressed stream, if `compression` is set) and the current
+    file offsets are returned. Truncating the files at any offsets returned by
+    `sync` leaves them in a consistent state.
+    
+    Args:
+        file1: Path to the read1 file
+        file2: Path to the read2 file
+        compression: The compression format (one of the keys of
+            `COMPRESSORS`), or None.
+        offsets: If not None, the files are opened for resuming: they are
+            truncated to these offsets (as returned by a previous call to
+            `sync`), and subsequent writes are appended.
+        compresslevel: The compression level (see :func:`get_compressor`).
+    """
+    def __init__(
+            self, file1, file2=None, compression=None, offsets=None,
+            compresslevel=None):
+        self.paired = file2 is not None
+        self.compress = get_compressor(compression, compresslevel)
+        files = (file1, file2) if self.paired else (file1,)
+        self.files = []
+        for i, path in enumerate(files):
+            if offsets is None:
+                fileobj = open(path, 'wb')
+            else:
+                fileobj = open(path, 'r+b')
+                fileobj.truncate(offsets[i])
+                fileobj.seek(offsets[i])
+            self.files.append(fileobj)
+        self.buffers = [[] for _ in files]
+    
+    def __call__(self, read1_str, read2_str=None):
+        self.buffers[0].append(read1_str)
+        if read2_str:
+            self.buffers[1].append(read2_str)
+    
+    def sync(self):
+        """Write all buffered data to the files.
+        
+        Returns:
+            List of the current offsets of the files.
+        """
+        offsets = []
+        for fileobj, buf in zip(self.files, self.buffers):
+            if buf:
+                data = ''.join(buf).encode('utf-8')
+                del buf[:]
+                if self.compress:
+                    data = self.compress(data)
+                fileobj.write(data)
+                fileobj.flush()
+            offsets.append(fileobj.tell())
+        return offsets
+    
+    def close(self):
+        self.sync()
+        for fileobj in self.files:
+            fileobj.close()
+
+class AtomicFileWriter(StringWriter):
+    """String writer that buffers strings in memory and writes each file
+    atomically when closed, so that a file either does not exist or is
+    complete. Intended for small outputs, such as the per-batch chunks
+    written by :func:`srastream.sra_dump_worker`.
+    
+    Args:
+        file1: Path to the read1 file
+        file2: Path to the read2 file
+        compression: The compression format (one of the keys of
+            `COMPRESSORS`), or None.
+        compresslevel: The compression level (see :func:`get_compressor`).
+    """
+    def __init__(self, file1, file2=None, compression=None, compresslevel=None):
+        self.paired = file2 is not None
+        self.compress = get_compressor(compression, compresslevel)
+        self.files = (file1, file2) if self.paired else (file1,)
+        self.buffers = [[] for _ in self.files]
+    
+    def __call__(self, read1_str, read2_str=None):
+        self.buffers[0].append(read1_str)
+        if read2_str:
+            self.buffers[1].append(read2_str)
+    
+    def close(self):
+        for path, buf in zip(self.files, self.buffers):
+            data = ''.join(buf).encode('utf-8')
+            if self.compress:
+                data = self.compress(data)
+            write_atomic(path, data)
+        self.buffers = None
+
+class Checkpoint(object):
+    """A JSON sidecar file that records the progress of a resumable dump.
+    
+    Args:
+        path: Path to the checkpoint file.
+    """
+    def __init__(self, path):
+        self.path = path
+    
+    def load(self):
+        """Load the checkpoint.
+        
+        Returns:
+            The dict of state saved by the most recent call to `save`, or None
+            if there is no checkpoint.
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rt') as inp:
+            return json.load(inp)
+    
+    def save(self, **state):
+        """Atomically replace the checkpoint.
+        
+        Args:
+            state: JSON-serializable state.
+        """
+        write_atomic(self.path, json.dumps(state).encode('utf-8'))
+    
+    def remove(self):
+        """Remove the checkpoint file.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
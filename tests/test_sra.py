@@ -1,3 +1,4 @@
+import os
 from unittest import TestCase
 from srastream import *
 
@@ -17,3 +18,1419 @@ def test_batcher():
         item_start=5, item_stop=95, item_limit=15,
         batch_start=1, batch_size=10, batch_step=4)
     assert list(batcher(100)) == [(0,15,10),(1,55,5)]
+
+def test_batch_range():
+    batcher = Batcher(
+        item_start=5, item_stop=95, item_limit=15,
+        batch_start=1, batch_size=10, batch_step=4)
+    batches = batcher.batches(100)
+    assert len(batches) == 2
+    assert list(batches) == list(batcher(100))
+    assert batches[-1] == (1, 55, 5)
+    # constant-time arithmetic for very large runs
+    batches = Batcher(batch_size=10).batches(10 ** 12 + 5)
+    assert len(batches) == 10 ** 11 + 1
+    assert batches[12345] == (12345, 123450, 10)
+    assert batches[-1] == (10 ** 11, 10 ** 12, 5)
+    tail = batches[-2:]
+    assert len(tail) == 2
+    assert list(tail) == [
+        (10 ** 11 - 1, 10 ** 12 - 10, 10), (10 ** 11, 10 ** 12, 5)]
+    # the last batch never extends past the end of the items
+    assert list(Batcher(item_start=5, batch_size=10).batches(20)) == [
+        (0, 5, 10), (1, 15, 5)]
+    assert list(Batcher(batch_size=10).batches(0)) == []
+
+def test_batcher_shards():
+    import pytest
+    with pytest.raises(ValueError):
+        Batcher(shard_index=2, num_shards=2)
+    with pytest.raises(ValueError):
+        Batcher(adaptive=True, num_shards=2)
+    full = list(Batcher(batch_size=10, batch_step=2)(205))
+    assert len(full) == 11
+    for mode in ('contiguous', 'interleaved'):
+        shards = [
+            list(Batcher(
+                batch_size=10, batch_step=2, shard_index=i, num_shards=3,
+                shard_mode=mode)(205))
+            for i in range(3)]
+        assert sorted(sum(shards, [])) == full
+        assert [len(shard) for shard in shards] in ([3, 4, 4], [4, 4, 3])
+    assert list(Batcher(
+        batch_size=10, shard_index=1, num_shards=3)(100)) == [
+            (3, 30, 10), (4, 40, 10), (5, 50, 10)]
+    assert list(Batcher(
+        batch_size=10, shard_index=1, num_shards=3,
+        shard_mode='interleaved')(100)) == [
+            (1, 10, 10), (4, 40, 10), (7, 70, 10)]
+    # iterators are sharded too
+    for mode in ('contiguous', 'interleaved'):
+        batcher = Batcher(shard_index=1, num_shards=3, shard_mode=mode)
+        assert list(batcher.shard(iter(range(10)))) == list(
+            batcher.shard(list(range(10))))
+
+def test_batches_from_sequence():
+    sequence = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+    batcher = Batcher(item_start=2, item_limit=7, batch_size=2)
+    assert list(batcher.batches_from_sequence(sequence, items_only=True)) == [
+        [2, 3], [4, 5], [6, 7], [8]]
+
+def test_batcher_adaptive():
+    import pytest
+    with pytest.raises(ValueError):
+        Batcher(adaptive=True, batch_step=2)
+    batcher = Batcher(
+        item_start=5, item_limit=1000, adaptive=True, min_batch_size=10,
+        max_batch_size=80)
+    batches = list(batcher(500))
+    # contiguous batches covering exactly the requested items
+    assert batches[0] == (0, 5, 10)
+    assert [batch[0] for batch in batches] == list(range(len(batches)))
+    for prev, batch in zip(batches, batches[1:]):
+        assert batch[1] == prev[1] + prev[2]
+    assert batches[-1][1] + batches[-1][2] == 500
+    assert all(10 <= size <= 80 for _, _, size in batches[:-1])
+    # batches shrink when slow and grow when fast, by at most 2x
+    assert batcher._next_batch_size(100, 4.0) == 50
+    assert batcher._next_batch_size(40, 0.01) == 80
+    assert batcher._next_batch_size(10, 10.0) == 10
+    assert batcher._next_batch_size(30, 0.5) == 60
+    assert batcher._next_batch_size(30, 0.75) == 40
+    # workers request batches before fetching them, so the time between
+    # requests is not the fetch time
+    with pytest.raises(ValueError):
+        SraReader('SRR1', workers=2, adaptive=True)
+    SraReader('SRR1', workers=1, adaptive=True)
+    from srastream.aio import AsyncSraReader
+    with pytest.raises(ValueError):
+        AsyncSraReader('SRR1', adaptive=True)
+
+def test_ordered_map():
+    from concurrent.futures import ThreadPoolExecutor
+    import time
+    def delayed(i):
+        time.sleep(0.01 * (5 - i))
+        return i * 2
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(ordered_map(
+            executor, delayed, ((i,) for i in range(5)), 2))
+    assert results == [0, 2, 4, 6, 8]
+
+def test_ordered_map_speculate():
+    from concurrent.futures import ThreadPoolExecutor
+    import threading
+    import time
+    calls = []
+    lock = threading.Lock()
+    def flaky(i):
+        with lock:
+            calls.append(i)
+            first = calls.count(i) == 1
+        # the first attempt at item 7 stalls
+        time.sleep(2 if i == 7 and first else 0.01)
+        return i * 2
+    begin = time.monotonic()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(ordered_map(
+            executor, flaky, ((i,) for i in range(12)), 4, speculate=3,
+            poll_interval=0.01))
+        elapsed = time.monotonic() - begin
+    assert results == [i * 2 for i in range(12)]
+    assert elapsed < 1
+    assert calls.count(7) == 2
+    assert all(calls.count(i) == 1 for i in range(12) if i != 7)
+
+def test_prefetch():
+    assert list(prefetch(iter(range(10)), 3)) == list(range(10))
+    def failing():
+        yield 1
+        raise IOError("fetch failed")
+    itr = prefetch(failing(), 2)
+    assert next(itr) == 1
+    try:
+        next(itr)
+        assert False
+    except IOError:
+        pass
+    # stopping early should not hang
+    itr = prefetch(iter(range(100)), 2)
+    assert next(itr) == 0
+    itr.close()
+
+class MockSraReader(object):
+    """Stands in for SraReader in MultiSraReader. Accession names ending in
+    'p' are paired, earlier accessions are slower to fetch, and the accession
+    'bad' fails.
+    """
+    active = set()
+    def __init__(self, accn, **kwargs):
+        self.accn = accn
+        self.paired = accn.endswith('p')
+    def __enter__(self):
+        MockSraReader.active.add(self.accn)
+        return self
+    def __exit__(self, exception_type, exception_value, traceback):
+        MockSraReader.active.discard(self.accn)
+    def iter_batches(self):
+        import time
+        if self.accn == 'bad':
+            raise IOError("cannot open {}".format(self.accn))
+        for batch in range(3):
+            time.sleep(0.01 * (ord('E') - ord(self.accn[0])))
+            yield [
+                tuple(
+                    ('{}.{}.{}'.format(self.accn, batch, i), 'ACGT', 'IIII')
+                    for _ in range(2 if self.paired else 1))
+                for i in range(2)]
+
+def _read_names(reads):
+    return [read[0][0] for read in reads]
+
+def test_multi_sra_reader(monkeypatch):
+    import pytest
+    import srastream
+    monkeypatch.setattr(srastream, 'SraReader', MockSraReader)
+    # reads are yielded in accession order, whichever finishes first
+    reader = MultiSraReader(['A', 'B', 'C', 'D'], concurrency=3)
+    assert _read_names(reader) == [
+        '{}.{}.{}'.format(accn, batch, i)
+        for accn in 'ABCD' for batch in range(3) for i in range(2)]
+    assert not MockSraReader.active
+    # errors in a producer are raised in the consumer
+    batches = MultiSraReader(['A', 'bad', 'C'], concurrency=3).iter_batches()
+    assert next(batches)[0].accn == 'A'
+    with pytest.raises(IOError):
+        for _ in batches:
+            pass
+    assert not MockSraReader.active
+    # stopping early stops the producers
+    batches = MultiSraReader(
+        ['A', 'B', 'C', 'D'], concurrency=2, read_ahead=1).iter_batches()
+    assert next(batches)[0].accn == 'A'
+    batches.close()
+    assert not MockSraReader.active
+
+def test_multi_sra_reader_handle_pool(monkeypatch):
+    import threading
+    import time
+    import srastream
+    class PooledReader(MockSraReader):
+        """Holds a read collection from a pool while open, like SraReader.
+        The first accession is slow to start.
+        """
+        def __init__(self, accn, read_collection_pool=None, **kwargs):
+            super().__init__(accn)
+            self.pool = read_collection_pool
+        def __enter__(self):
+            if self.accn == 'A':
+                time.sleep(0.2)
+            self.pool.acquire(self.accn)
+            return super().__enter__()
+        def __exit__(self, exception_type, exception_value, traceback):
+            super().__exit__(exception_type, exception_value, traceback)
+            self.pool.release(self.accn)
+    monkeypatch.setattr(srastream, 'SraReader', PooledReader)
+    pool = HandlePool(lambda accn: object(), lambda handle: None, max_open=2)
+    # more accessions at a time than there are handles in the pool must not
+    # leave the first accession waiting for a handle held by the others
+    reader = MultiSraReader(
+        ['A', 'B', 'C'], concurrency=3, read_ahead=1,
+        read_collection_pool=pool)
+    names = []
+    thread = threading.Thread(
+        target=lambda: names.extend(_read_names(reader)), daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert len(names) == 18
+
+def test_sra_dump_many_concatenate(monkeypatch):
+    import pytest
+    import tempfile
+    import srastream
+    monkeypatch.setattr(srastream, 'SraReader', MockSraReader)
+    with tempfile.TemporaryDirectory() as path:
+        prefix = os.path.join(path, 'all')
+        with pytest.raises(ValueError):
+            sra_dump_many(['A', 'B'], concatenate=True)
+        result = sra_dump_many(
+            ['B', 'A'], prefix=prefix, concatenate=True, compression=False)
+        assert result['accns'] == ['B', 'A']
+        assert result['read_count'] == 12
+        assert result['file1'] == prefix + '.1.fq'
+        with open(result['file1'], 'rt') as inp:
+            names = inp.read().splitlines()[::4]
+        assert names == [
+            '@{}.{}.{}'.format(accn, batch, i)
+            for accn in 'BA' for batch in range(3) for i in range(2)]
+        # single- and paired-end accessions cannot be concatenated
+        with pytest.raises(ValueError):
+            sra_dump_many(
+                ['A', 'Bp'], prefix=prefix, concatenate=True,
+                compression=False)
+    assert not MockSraReader.active
+
+class MockReadCollection(object):
+    def __init__(self):
+        self.closed = False
+    def close(self):
+        self.closed = True
+
+def _async_reader(**kwargs):
+    """Create an AsyncSraReader over 100 reads that is ready to iterate without
+    opening a read collection.
+    """
+    from srastream.aio import AsyncSraReader
+    reader = AsyncSraReader('SRR1', **kwargs)
+    reader.reader.read_collection = object()
+    reader.reader.read_count = 100
+    return reader
+
+def test_async_sra_reader():
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    import threading
+    import time
+    fetched = []
+    lock = threading.Lock()
+    def fetch(start, size, members):
+        with lock:
+            fetched.append(start)
+        # later batches finish first
+        time.sleep(0.01 * (4 - (start // 10) % 5))
+        return list(range(start, start + size))
+    async def consume(reader, limit=None):
+        batches = []
+        itr = reader.iter_batches()
+        try:
+            async for reads in itr:
+                # at most read_ahead batches are fetched ahead of the consumer
+                assert len(fetched) <= len(batches) + reader.read_ahead
+                batches.append(reads)
+                if len(batches) == limit:
+                    break
+        finally:
+            await itr.aclose()
+        return batches
+    executor = ThreadPoolExecutor(max_workers=2)
+    reader = _async_reader(
+        concurrency=2, read_ahead=3, executor=executor, batch_size=10)
+    reader._fetch = fetch
+    loop = asyncio.new_event_loop()
+    try:
+        batches = loop.run_until_complete(consume(reader))
+        assert sum(batches, []) == list(range(100))
+        # stopping early cancels the batches that have not been started
+        del fetched[:]
+        batches = loop.run_until_complete(consume(reader, limit=2))
+        assert batches == [list(range(10)), list(range(10, 20))]
+        executor.shutdown(wait=True)
+        assert len(fetched) <= 2 + reader.read_ahead
+    finally:
+        loop.close()
+
+def test_async_sra_reader_ranges(monkeypatch):
+    import asyncio
+    import srastream.aio
+    monkeypatch.setattr(
+        srastream.aio.NGS, 'openReadCollection',
+        lambda accn: MockReadCollection())
+    async def consume(reader):
+        await reader.start()
+        try:
+            return [reads async for reads in reader.iter_batches()]
+        finally:
+            await reader.finish()
+    def read_all(**kwargs):
+        reader = _async_reader(concurrency=2, **kwargs)
+        reader.reader.start = reader.reader.finish = lambda: None
+        reader.reader.read_lengths = (4,)
+        reader.reader.fetch_range = (
+            lambda start, size, read_collection: list(
+                range(start, start + size)))
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(consume(reader))
+        finally:
+            loop.close()
+    # the same batches as SraReader, including skipped batches and samples
+    assert sum(read_all(batch_size=10, skip_batches=8), []) == list(
+        range(80, 100))
+    sampler = Sampler(count=10, seed=1, max_gap=0, batch_size=4)
+    assert sum(read_all(sample=sampler), []) == sampler.indices(100)
+
+def test_async_sra_reader_read_collections(monkeypatch):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    import srastream.aio
+    opened = []
+    def open_read_collection(accn):
+        opened.append(MockReadCollection())
+        return opened[-1]
+    monkeypatch.setattr(
+        srastream.aio.NGS, 'openReadCollection', open_read_collection)
+    executor = ThreadPoolExecutor(max_workers=8)
+    async def consume(reader):
+        await reader.start()
+        try:
+            return [reads async for reads in reader.iter_batches()]
+        finally:
+            await reader.finish()
+    loop = asyncio.new_event_loop()
+    try:
+        for _ in range(3):
+            reader = _async_reader(
+                concurrency=2, read_ahead=2, executor=executor,
+                batch_size=10)
+            reader.reader.start = reader.reader.finish = lambda: None
+            reader.reader.fetch_range = (
+                lambda start, size, read_collection: [read_collection] * size)
+            batches = loop.run_until_complete(consume(reader))
+            assert len(batches) == 10
+    finally:
+        loop.close()
+        executor.shutdown()
+    # each reader opens at most one read collection per concurrent fetch,
+    # even though the executor is shared, and closes them when finished
+    assert 3 <= len(opened) <= 6
+    assert all(read_collection.closed for read_collection in opened)
+
+def test_columnar_batch():
+    import pytest
+    pytest.importorskip('numpy')
+    reads = [
+        (('r1', 'ACGT', 'IIII'), ('r1', 'GG', '#I')),
+        (('r2', 'TTA', '!!5'), ('r2', 'C', 'I'))
+    ]
+    batch = ColumnarBatch.from_reads(reads)
+    assert len(batch) == 2
+    assert batch.num_fragments == 4
+    assert list(batch.names) == ['r1', 'r2']
+    assert list(batch.offsets) == [0, 4, 6, 9]
+    assert list(batch.lengths) == [4, 2, 3, 1]
+    assert list(batch.read_offsets) == [0, 2, 4]
+    assert batch.bases.tobytes() == b'ACGTGGTTAC'
+    assert list(batch.qualities[:6]) == [40, 40, 40, 40, 2, 40]
+    assert batch.to_reads() == reads
+
+class ListWriter(StringWriter):
+    def __init__(self, paired=False):
+        self.paired = paired
+        self.strings = ([], [])
+    
+    def __call__(self, read1_str, read2_str=None):
+        self.strings[0].append(read1_str)
+        if read2_str:
+            self.strings[1].append(read2_str)
+    
+    def close(self):
+        pass
+
+def test_write_batch():
+    reads = [
+        (('r{}'.format(i), 'ACGT', 'IIII'), ('r{}'.format(i), 'TT', 'II'))
+        for i in range(5)]
+    expected = ListWriter(paired=True)
+    with FastqWriter(expected, 2) as writer:
+        for read in reads:
+            writer(*read)
+    actual = ListWriter(paired=True)
+    with FastqWriter(actual, 2) as writer:
+        writer.write_batch(reads[:3])
+        writer.write_batch(reads[3:])
+    assert actual.strings == expected.strings
+    assert ''.join(actual.strings[1]).startswith('@r0\nTT\n+\nII\n@r1')
+
+class MockRead(object):
+    """Mimics the parts of the ngs Read API used by sra_reads, counting the
+    number of calls.
+    """
+    def __init__(self, name, frags):
+        self.name = name
+        self.frags = frags
+        self.frag_index = -1
+        self.calls = 0
+    
+    def __getattribute__(self, attr):
+        if attr.startswith(('get', 'next', 'is')):
+            self.calls += 1
+        return object.__getattribute__(self, attr)
+    
+    def getReadName(self):
+        return self.name
+    
+    def getNumFragments(self):
+        return len(self.frags)
+    
+    def getReadBases(self):
+        return ''.join(frag[0] for frag in self.frags)
+    
+    def getReadQualities(self):
+        return ''.join(frag[1] for frag in self.frags)
+    
+    def nextFragment(self):
+        self.frag_index += 1
+    
+    def isPaired(self):
+        return len(self.frags) > 1
+    
+    def getFragmentBases(self):
+        return self.frags[self.frag_index][0]
+    
+    def getFragmentQualities(self):
+        return self.frags[self.frag_index][1]
+
+class MockReadRange(object):
+    """Mimics an ngs read iterator over a range of spots.
+    """
+    def __init__(self, reads):
+        self.reads = reads
+        self.read = None
+        self.index = -1
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exception_type, exception_value, traceback):
+        pass
+    
+    def nextRead(self):
+        self.index += 1
+        if self.index >= len(self.reads):
+            return False
+        self.read = self.reads[self.index]
+        return True
+    
+    def __getattr__(self, attr):
+        return getattr(self.read, attr)
+
+class MockCategoryCollection(object):
+    """Mimics a read collection in which the even-numbered spots are
+    unaligned and the odd-numbered spots are aligned.
+    """
+    def __init__(self):
+        self.ranges = []
+    
+    def getReadRange(self, first, count, category):
+        self.ranges.append((first, count, category))
+        wanted = {
+            READ_CATEGORIES['all']: (0, 1),
+            READ_CATEGORIES['unaligned']: (0,),
+            READ_CATEGORIES['aligned']: (1,)}[category]
+        return MockReadRange([
+            MockRead('r{}'.format(index), (('ACGT', 'IIII'),))
+            for index in range(first - 1, first - 1 + count)
+            if index % 2 in wanted])
+
+def test_fetch_batch_category():
+    import pytest
+    collection = MockCategoryCollection()
+    unaligned = READ_CATEGORIES['unaligned']
+    # the NGS library skips reads in other categories, so a filtered batch
+    # has fewer reads than its size
+    reads = fetch_batch(collection, 10, 10, category=unaligned)
+    assert [read[0][0] for read in reads] == [
+        'r10', 'r12', 'r14', 'r16', 'r18']
+    assert collection.ranges == [(11, 10, unaligned)]
+    assert len(fetch_batch(collection, 10, 10)) == 10
+    reader = SraReader(
+        'SRR1', category='unaligned', batch_size=10,
+        read_collection_pool=False)
+    reader.read_collection = collection
+    reader.read_count = 25
+    batches = list(reader.iter_batches())
+    assert [len(reads) for reads in batches] == [5, 5, 3]
+    assert [reads[0][0][0] for reads in batches] == ['r0', 'r10', 'r20']
+    # random access and sampling are only supported for all reads
+    with pytest.raises(ValueError):
+        reader[0]
+    with pytest.raises(ValueError):
+        reader[0:10]
+    with pytest.raises(ValueError):
+        SraReader('SRR1', category='unaligned', sample=Sampler(count=1))
+    with pytest.raises(ValueError):
+        SraReader('SRR1', category='spliced')
+
+class MockPairedCollection(object):
+    """Mimics a read collection of paired spots, in which spot 2 has a shorter
+    second fragment than the others.
+    """
+    def getReadRange(self, first, count, category):
+        return MockReadRange([
+            MockRead('r{}'.format(index), (
+                ('ACGT', 'IIII'),
+                ('GG', '#I') if index == 2 else ('GGC', '#I5')))
+            for index in range(first - 1, first - 1 + count)])
+
+def test_fetch_columnar():
+    import pytest
+    np = pytest.importorskip('numpy')
+    collection = MockPairedCollection()
+    for fragment_lengths in (None, (4, 3)):
+        expected = ColumnarBatch.from_reads(
+            fetch_batch(collection, 1, 3, fragment_lengths))
+        batch = fetch_columnar(collection, 1, 3, fragment_lengths)
+        assert list(batch.names) == ['r1', 'r2', 'r3']
+        assert list(batch.lengths) == [4, 3, 4, 2, 4, 3]
+        for attr in (
+                'names', 'bases', 'qualities', 'offsets', 'lengths',
+                'read_offsets'):
+            assert np.array_equal(
+                getattr(batch, attr), getattr(expected, attr))
+    metrics = Metrics()
+    reader = SraReader('SRR1', batch_size=2, metrics=metrics)
+    reader.read_collection = collection
+    reader.read_count = 3
+    batches = list(reader.iter_columnar())
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert batches[1].to_reads() == [
+        (('r2', 'ACGT', 'IIII'), ('r2', 'GG', '#I'))]
+    assert metrics.summary()['stages']['fetch']['items'] == 3
+
+def test_fetch_batch_worker(monkeypatch):
+    import pickle
+    import srastream.alignments
+    from srastream import _fetch_batch_worker
+    from srastream.alignments import _worker_read_collection
+    opened = []
+    def open_read_collection(accn):
+        opened.append(MockCategoryCollection())
+        return opened[-1]
+    monkeypatch.setattr(
+        srastream.alignments.NGS, 'openReadCollection', open_read_collection)
+    reads = _fetch_batch_worker('SRR_WORKER', 0, 4, members=[1, 2])
+    assert [read[0][0] for read in reads] == ['r1', 'r2']
+    reads = _fetch_batch_worker('SRR_WORKER', 4, 4, category='unaligned')
+    assert [read[0][0] for read in reads] == ['r4', 'r6']
+    # read and alignment fetches in a worker share one read collection
+    assert _worker_read_collection('SRR_WORKER') is opened[0]
+    assert len(opened) == 1
+    # measurements are returned to the parent process with the reads
+    reads, log = _fetch_batch_worker(
+        'SRR_WORKER', 0, 4, members=[1, 2], metrics=True)
+    assert [read[0][0] for read in reads] == ['r1', 'r2']
+    metrics = Metrics()
+    metrics.merge(pickle.loads(pickle.dumps(log)))
+    summary = metrics.summary()
+    assert summary['stages']['fetch']['items'] == 4
+    assert summary['stages']['decode']['items'] == 4
+    assert 'read_range' in summary['stages']
+    assert summary['counters']['native_calls'] > 0
+    # and recorded by a reader that fetches with workers
+    metrics = Metrics()
+    reader = SraReader(
+        'SRR_WORKER', workers=2, batch_size=4, metrics=metrics)
+    reader.read_collection = opened[0]
+    reader.read_count = 8
+    reader._fetch_parallel = lambda worker, args: (
+        worker(*arg) for arg in args)
+    assert _read_names(reader) == ['r{}'.format(i) for i in range(8)]
+    stages = metrics.summary()['stages']
+    assert stages['fetch']['calls'] == stages['decode']['calls'] == 2
+    assert stages['fetch_wait']['items'] == 8
+
+def test_sra_reads_fragment_lengths():
+    frags = (('ACGT', 'IIII'), ('GGC', '#I5'))
+    expected = (('r1', 'ACGT', 'IIII'), ('r1', 'GGC', '#I5'))
+    slow = MockRead('r1', frags)
+    assert sra_reads(slow) == expected
+    fast = MockRead('r1', frags)
+    assert sra_reads(fast, fragment_lengths=(4, 3)) == expected
+    assert fast.calls < slow.calls
+    # falls back when the layout doesn't match
+    assert sra_reads(MockRead('r1', frags), fragment_lengths=(4, 4)) == expected
+
+def test_sra_reads_fields():
+    frags = (('ACGT', 'IIII'), ('GGC', '#I5'))
+    full = MockRead('r1', frags)
+    sra_reads(full)
+    for fragment_lengths in (None, (4, 3)):
+        projected = MockRead('r1', frags)
+        assert sra_reads(
+            projected, fragment_lengths=fragment_lengths,
+            fields=('name', 'bases')) == (
+                ('r1', 'ACGT', None), ('r1', 'GGC', None))
+        assert sra_reads(
+            MockRead('r1', frags), fragment_lengths=fragment_lengths,
+            fields=('bases', 'qualities')) == (
+                (None, 'ACGT', 'IIII'), (None, 'GGC', '#I5'))
+    assert sra_reads(MockRead('r1', frags), fields=('bases',))[0] == (
+        None, 'ACGT', None)
+
+def test_project_fields():
+    from srastream import _cache_variant, _project_fields
+    import pytest
+    assert _project_fields(None) is None
+    assert _project_fields(('qualities', 'bases', 'name')) is None
+    assert _project_fields(['bases', 'name']) == ('name', 'bases')
+    with pytest.raises(ValueError):
+        _project_fields(('name',))
+    with pytest.raises(ValueError):
+        _project_fields(('bases', 'flags'))
+    assert _cache_variant('all') is None
+    assert _cache_variant('unaligned') == 'unaligned'
+    assert _cache_variant('all', ('name', 'bases')) == 'name-bases'
+    assert _cache_variant('unaligned', ('bases',)) == 'unaligned-bases'
+
+def test_fasta_writer():
+    reads = [
+        (('r{}'.format(i), 'ACGT', None), ('r{}'.format(i), 'TT', None))
+        for i in range(3)]
+    writer = ListWriter(paired=True)
+    with FastaWriter(writer, 2) as fasta:
+        fasta.write_batch(reads)
+    assert ''.join(writer.strings[0]) == '>r0\nACGT\n>r1\nACGT\n>r2\nACGT\n'
+    assert ''.join(writer.strings[1]) == '>r0\nTT\n>r1\nTT\n>r2\nTT\n'
+    assert FastaWriter.fields == ('name', 'bases')
+    assert READ_WRITERS['fastq'].fields == READ_FIELDS
+
+def test_metadata_cache():
+    import tempfile
+    import time
+    with tempfile.TemporaryDirectory() as path:
+        cache = MetadataCache(path, ttl=60, max_entries=2)
+        assert cache.get('SRR1') is None
+        cache.put('SRR1', dict(read_count=10))
+        assert cache.get('SRR1') == dict(read_count=10)
+        # oldest entries are evicted
+        time.sleep(0.01)
+        cache.put('SRR2', dict(read_count=20))
+        time.sleep(0.01)
+        cache.put('SRR3', dict(read_count=30))
+        assert cache.get('SRR1') is None
+        assert cache.get('SRR3') == dict(read_count=30)
+        # expired entries are ignored
+        cache.ttl = 0
+        time.sleep(0.01)
+        assert cache.get('SRR3') is None
+        cache.clear()
+        assert cache.get('SRR2') is None
+
+def test_cache_local_runs():
+    import tempfile
+    from srastream.cache import _entry_name
+    assert _entry_name('SRR1') == 'SRR1'
+    assert _entry_name('/data/SRR1.sra').startswith('_SRR1.sra-')
+    assert _entry_name('../SRR1') != _entry_name('/SRR1')
+    reads = [(('r1', 'ACGT', 'IIII'),)]
+    with tempfile.TemporaryDirectory() as path:
+        cache_dir = os.path.join(path, 'cache')
+        # a local run that exists, and the path of a run that doesn't
+        run = os.path.join(path, 'SRR1.sra')
+        with open(run, 'wb'):
+            pass
+        for accn in (run, os.path.join(path, 'other', 'SRR2.sra')):
+            metadata_cache = MetadataCache(cache_dir)
+            metadata_cache.put(accn, dict(read_count=10))
+            assert metadata_cache.get(accn) == dict(read_count=10)
+            batch_cache = BatchCache(cache_dir)
+            batch_cache.put(accn, 0, 1, reads)
+            assert batch_cache.get(accn, 0, 1) == reads
+        # entries are only written inside the cache directory
+        assert sorted(os.listdir(path)) == ['SRR1.sra', 'cache']
+        assert os.path.getsize(run) == 0
+
+def test_batch_cache():
+    import tempfile
+    import time
+    reads = [(('r1', 'ACGT', 'IIII'), ('r1', 'GG', 'II'))]
+    with tempfile.TemporaryDirectory() as path:
+        cache = BatchCache(path, low_water=1)
+        assert cache.get('SRR1', 0, 1) is None
+        fetched = []
+        def fetch():
+            fetched.append(True)
+            return reads
+        assert cache.get_or_fetch('SRR1', 0, 1, fetch) == reads
+        assert cache.get_or_fetch('SRR1', 0, 1, fetch) == reads
+        assert len(fetched) == 1
+        # least recently used batches are evicted when over budget
+        cache.max_bytes = 2 * os.path.getsize(cache._entry_path('SRR1', 0, 1))
+        time.sleep(0.01)
+        cache.put('SRR1', 1, 1, reads)
+        time.sleep(0.01)
+        cache.get('SRR1', 0, 1)
+        time.sleep(0.01)
+        cache.put('SRR1', 2, 1, reads)
+        assert cache.get('SRR1', 1, 1) is None
+        assert cache.get('SRR1', 0, 1) == reads
+        assert cache.get('SRR1', 2, 1) == reads
+
+def test_batch_cache_low_water():
+    import tempfile
+    reads = [(('r1', 'ACGT', 'IIII'),)]
+    with tempfile.TemporaryDirectory() as path:
+        cache = BatchCache(path, rescan_interval=1000)
+        cache.put('SRR1', 0, 1, reads)
+        entry_size = os.path.getsize(cache._entry_path('SRR1', 0, 1))
+        cache.max_bytes = 50 * entry_size
+        scans = []
+        entries = cache._entries
+        def count_scans():
+            scans.append(True)
+            return entries()
+        cache._entries = count_scans
+        for start in range(1, 300):
+            cache.put('SRR1', start, 1, reads)
+        # once full, the cache is only scanned every few writes
+        assert 0 < len(scans) < 60
+        assert len(entries()) <= 50
+
+def test_batch_cache_read_groups():
+    import tempfile
+    reads = [('RG1', (('r1', 'ACGT', 'IIII'),)), ('', (('r2', 'GG', None),))]
+    with tempfile.TemporaryDirectory() as path:
+        cache = BatchCache(path)
+        cache.put('SRR1', 0, 2, reads, 'read_group')
+        assert cache.get('SRR1', 0, 2, 'read_group') == [
+            ('RG1', (('r1', 'ACGT', 'IIII'),)), ('', (('r2', 'GG', None),))]
+
+class MockGroupReader(object):
+    paired = False
+    
+    def __init__(self, batches):
+        self.batches = batches
+    
+    def iter_batches(self):
+        return iter(self.batches)
+
+def test_dump_read_groups():
+    import tempfile
+    from srastream import _dump_read_groups
+    batches = [
+        [('L1', (('r1', 'AC', 'II'),)), ('L2', (('r2', 'GG', 'II'),))],
+        [('L1', (('r3', 'TT', 'II'),)), ('', (('r4', 'CC', 'II'),))]]
+    with tempfile.TemporaryDirectory() as path:
+        prefix = os.path.join(path, 'SRR1')
+        files = _dump_read_groups(
+            MockGroupReader(batches), prefix, False, FastqWriter, 10)
+        assert files == {
+            'L1': dict(file1=prefix + '.L1.1.fq'),
+            'L2': dict(file1=prefix + '.L2.1.fq'),
+            '': dict(file1=prefix + '._nogroup_.1.fq')}
+        with open(files['L1']['file1'], 'rt') as inp:
+            assert inp.read().split() == [
+                '@r1', 'AC', '+', 'II', '@r3', 'TT', '+', 'II']
+        # read groups whose labels collide are written to separate files
+        batches = [[
+            ('a/b', (('r1', 'AC', 'II'),)), ('a b', (('r2', 'GG', 'II'),)),
+            ('A_B', (('r3', 'TT', 'II'),)),
+            ('_nogroup_', (('r4', 'CC', 'II'),)),
+            ('', (('r5', 'AA', 'II'),))]]
+        files = _dump_read_groups(
+            MockGroupReader(batches), prefix, False, FastqWriter, 10)
+        assert len(set(group['file1'] for group in files.values())) == 5
+        for read_group, name in (('a/b', 'r1'), ('a b', 'r2'), ('', 'r5')):
+            with open(files[read_group]['file1'], 'rt') as inp:
+                assert inp.read().split()[0] == '@' + name
+
+def test_read_group_label():
+    from srastream import _read_group_label
+    assert _read_group_label('L1.x-y_z') == 'L1.x-y_z'
+    assert _read_group_label('a/b c*') == 'a_b_c_'
+    assert _read_group_label('') == '_nogroup_'
+    assert _read_group_label(None) == '_nogroup_'
+    assert _read_group_label('a/b', {'a_b'}) == 'a_b_2'
+    assert _read_group_label('A_B', {'a_b', 'a_b_2'}) == 'A_B_3'
+
+def test_checkpoint_file_writer():
+    import gzip
+    import tempfile
+    with tempfile.TemporaryDirectory() as path:
+        file1 = os.path.join(path, 'test.1.fq.gz')
+        file2 = os.path.join(path, 'test.2.fq.gz')
+        writer = CheckpointFileWriter(file1, file2, compression='gz')
+        writer('a1\n', 'a2\n')
+        offsets = writer.sync()
+        # simulate a failure after a partial write
+        writer('b1\n', 'b2\n')
+        writer.sync()
+        writer.files[0].write(b'garbage')
+        writer.files[0].close()
+        writer.files[1].close()
+        checkpoint = Checkpoint(os.path.join(path, 'test.checkpoint.json'))
+        checkpoint.save(batches=1, offsets=offsets)
+        # resume
+        state = checkpoint.load()
+        assert state == dict(batches=1, offsets=offsets)
+        writer = CheckpointFileWriter(
+            file1, file2, compression='gz', offsets=state['offsets'])
+        writer('c1\n', 'c2\n')
+        writer.close()
+        with gzip.open(file1, 'rt') as inp:
+            assert inp.read() == 'a1\nc1\n'
+        with gzip.open(file2, 'rt') as inp:
+            assert inp.read() == 'a2\nc2\n'
+        checkpoint.remove()
+        assert checkpoint.load() is None
+
+def test_get_compressor():
+    import gzip
+    import lzma
+    import pytest
+    assert get_compressor(None) is None
+    with pytest.raises(ValueError):
+        get_compressor('zip')
+    data = b'@r1\nACGT\n+\nIIII\n' * 100
+    assert get_compressor('gz').keywords == dict(compresslevel=4)
+    assert gzip.decompress(get_compressor('gz', 1)(data)) == data
+    assert lzma.decompress(get_compressor('xz')(data)) == data
+
+def test_check_checkpoint():
+    import pytest
+    import tempfile
+    from srastream import (
+        _checkpoint_params, _check_checkpoint, _seed_sampler)
+    batcher = Batcher(batch_size=10, item_limit=100)
+    params = _checkpoint_params(
+        'SRR1', batcher, category='all', output_format='fastq',
+        compression='gz')
+    assert params['batch_size'] == 10 and params['item_limit'] == 100
+    assert params['sample'] is None
+    with tempfile.TemporaryDirectory() as path:
+        checkpoint = Checkpoint(os.path.join(path, 'test.checkpoint.json'))
+        checkpoint.save(params=params, batches=2, reads=20, offsets=[10])
+        state = checkpoint.load()
+        _check_checkpoint(checkpoint, state, params)
+        changed = _checkpoint_params(
+            'SRR1', Batcher(batch_size=10, batch_step=2), category='all',
+            output_format='fasta', compression='gz')
+        with pytest.raises(ValueError) as excinfo:
+            _check_checkpoint(checkpoint, state, changed)
+        assert 'batch_step, item_limit, output_format' in str(excinfo.value)
+        # a sampled dump without a seed is given one, which is re-used when
+        # the dump is resumed
+        sampler = Sampler(fraction=0.1)
+        seeded = _seed_sampler(sampler)
+        assert sampler.seed is None
+        assert seeded.seed is not None
+        params = _checkpoint_params('SRR1', batcher, seeded)
+        checkpoint.save(params=params, batches=2, reads=20, offsets=[10])
+        state = checkpoint.load()
+        resumed = _seed_sampler(sampler, state)
+        assert resumed.seed == seeded.seed
+        assert resumed.indices(1000) == seeded.indices(1000)
+        _check_checkpoint(
+            checkpoint, state, _checkpoint_params('SRR1', batcher, resumed))
+        # a different sample cannot be resumed
+        for other in (None, Sampler(fraction=0.2, seed=seeded.seed)):
+            with pytest.raises(ValueError) as excinfo:
+                _check_checkpoint(
+                    checkpoint, state,
+                    _checkpoint_params('SRR1', batcher, other))
+            assert 'sample' in str(excinfo.value)
+
+def test_work_queue():
+    import tempfile
+    with tempfile.TemporaryDirectory() as path:
+        db = os.path.join(path, 'queue.db')
+        batches = Batcher(batch_size=10).batches(25)
+        with WorkQueue(db) as queue1, WorkQueue(db, lease=0) as queue2:
+            assert queue1.populate(batches, accn='SRR1')
+            assert not queue2.populate(batches, accn='SRR2')
+            assert queue2.info() == dict(accn='SRR1', populated=True)
+            assert queue1.claim('w1') == (0, 0, 10)
+            assert queue1.claim('w1') == (1, 10, 10)
+            queue1.complete(1, dict(read_count=10))
+            # with an expired lease, batch 0 is reclaimed before batch 2
+            assert queue2.claim('w2') == (0, 0, 10)
+            queue2.complete(0, dict(read_count=10))
+            assert queue1.claim('w1') == (2, 20, 5)
+            assert queue1.claim('w1') is None
+            assert queue1.progress() == (2, 3)
+            assert not queue1.is_complete()
+            queue1.complete(2, dict(read_count=5))
+            assert queue2.is_complete()
+            assert queue2.results() == [
+                (0, 0, 10, dict(read_count=10)),
+                (1, 10, 10, dict(read_count=10)),
+                (2, 20, 5, dict(read_count=5))]
+
+class MockRunCollection(MockPairedCollection):
+    """Mimics an open read collection of 25 paired spots.
+    """
+    def getName(self):
+        return 'SRR1'
+    
+    def getReadCount(self):
+        return 25
+    
+    def close(self):
+        pass
+
+def test_sra_dump_worker(monkeypatch):
+    import json
+    import tempfile
+    import time
+    import srastream
+    monkeypatch.setattr(
+        srastream.NGS, 'openReadCollection', lambda accn: MockRunCollection())
+    with tempfile.TemporaryDirectory() as path:
+        db = os.path.join(path, 'queue.db')
+        prefix = os.path.join(path, 'SRR1')
+        reader_args = dict(
+            prefix=prefix, compression=False, batch_size=10,
+            read_collection_pool=False)
+        # a worker that claims the first batch and dies
+        with WorkQueue(db) as queue:
+            queue.populate(
+                Batcher(batch_size=10).batches(25), accn='SRR1', paired=True)
+            assert queue.claim('dead') == (0, 0, 10)
+        with WorkQueue(db) as queue:
+            result = sra_dump_worker('SRR1', queue, worker='w1', **reader_args)
+        assert result['batches'] == 2
+        assert result['manifest'] is None
+        # the first batch is reclaimed by a worker once its lease expires
+        time.sleep(0.01)
+        with WorkQueue(db, lease=0) as queue:
+            result = sra_dump_worker('SRR1', queue, worker='w2', **reader_args)
+        assert result['batches'] == 1
+        assert result['manifest'] == prefix + '.manifest.json'
+        with open(result['manifest'], 'rt') as inp:
+            manifest = json.load(inp)
+        assert [
+            (chunk['batch_num'], chunk['start'], chunk['read_count'])
+            for chunk in manifest['chunks']] == [
+                (0, 0, 10), (1, 10, 10), (2, 20, 5)]
+        files = concatenate_chunks(result['manifest'])
+        for key, bases in (('file1', 'ACGT'), ('file2', 'GGC')):
+            with open(files[key], 'rt') as inp:
+                lines = inp.read().splitlines()
+            assert lines[0::4] == ['@r{}'.format(i) for i in range(25)]
+            assert lines[1] == bases
+
+def test_concatenate_chunks():
+    import gzip
+    import json
+    import tempfile
+    with tempfile.TemporaryDirectory() as path:
+        chunks = []
+        for batch_num in range(3):
+            prefix = os.path.join(path, 'SRR1.{:08d}'.format(batch_num))
+            files = dict(file1=prefix + '.1.fq.gz')
+            with FastqWriter(AtomicFileWriter(
+                    files['file1'], compression='gz'), 10) as writer:
+                writer.write_batch([
+                    (('r{}'.format(batch_num), 'ACGT', 'IIII'),)])
+            chunks.append(dict(
+                batch_num=batch_num, files=files, read_count=1))
+        output = os.path.join(path, 'SRR1.1.fq.gz')
+        manifest = os.path.join(path, 'SRR1.manifest.json')
+        with open(manifest, 'wt') as out:
+            json.dump(dict(
+                accn='SRR1', paired=False, files=dict(file1=output),
+                chunks=chunks), out)
+        result = concatenate_chunks(manifest, remove=True)
+        assert result == dict(file1=output, accn='SRR1', read_count=3)
+        with gzip.open(output, 'rt') as inp:
+            assert inp.read().split()[::4] == ['@r0', '@r1', '@r2']
+        assert not os.path.exists(chunks[0]['files']['file1'])
+
+def test_metrics():
+    recorded = []
+    metrics = Metrics(
+        callbacks=[lambda *args: recorded.append(args)], buckets=(0.1, 1))
+    metrics.record('fetch', 0.05, 1000, 2000)
+    metrics.record('fetch', 0.5, 1000)
+    metrics.record('write', 3, 2000, 100000)
+    metrics.count('native_calls', 10)
+    metrics.count('native_calls')
+    assert recorded[0] == ('fetch', 0.05, 1000, 2000)
+    summary = metrics.summary()
+    assert summary['counters'] == dict(native_calls=11)
+    fetch = summary['stages']['fetch']
+    assert fetch['calls'] == 2
+    assert fetch['items'] == 2000
+    assert fetch['bytes'] == 2000
+    assert abs(fetch['items_per_second'] - 2000 / 0.55) < 1e-6
+    assert fetch['histogram'] == {'0.1': 1, '1': 1}
+    assert summary['stages']['write']['histogram'] == {'+Inf': 1}
+    waits = list(timed_batches(iter([[1, 2], [3]]), metrics, 'fetch_wait'))
+    assert waits == [[1, 2], [3]]
+    assert metrics.summary()['stages']['fetch_wait']['items'] == 3
+
+def test_writer_metrics():
+    metrics = Metrics()
+    writer = ListWriter()
+    with FastqWriter(writer, 2) as fastq:
+        fastq.metrics = metrics
+        fastq.write_batch([(('r1', 'ACGT', 'IIII'),)] * 3)
+    output = metrics.summary()['stages']['output']
+    assert output['calls'] == 2
+    assert output['items'] == 3
+    assert output['bytes'] == len(''.join(writer.strings[0]))
+
+def test_native_calls():
+    from srastream import _native_calls
+    reads = [(('r1', 'ACGT', 'IIII'), ('r1', 'GG', 'II'))] * 10
+    assert _native_calls(reads) == 2 + 10 * 3 + 20 * 3
+    assert _native_calls(reads, fields=('name', 'bases')) == (
+        2 + 10 * 3 + 20 * 2)
+    assert _native_calls(reads, fragment_lengths=(4, 2)) == 2 + 10 * 5
+    assert _native_calls(
+        [('RG', read) for read in reads], read_groups=True) == (
+            2 + 10 * 4 + 20 * 3)
+
+def test_handle_pool():
+    import time
+    class Handle(object):
+        def __init__(self, key):
+            self.key = key
+            self.closed = False
+        def close(self):
+            self.closed = True
+    opened = []
+    def open_handle(key):
+        opened.append(key)
+        return Handle(key)
+    pool = HandlePool(open_handle, max_open=2, idle_timeout=60)
+    h1 = pool.acquire('a')
+    assert pool.acquire('a') is h1
+    assert opened == ['a']
+    pool.release('a')
+    pool.release('a')
+    # idle handles are re-used
+    assert pool.acquire('a') is h1
+    pool.release('a')
+    # the least recently used idle handle is closed when the pool is full
+    h2 = pool.acquire('b')
+    h3 = pool.acquire('c')
+    assert h1.closed and not h2.closed
+    assert len(pool) == 2
+    # when all handles are in use, another is opened beyond max_open, and
+    # idle handles over the limit are closed when released
+    h4 = pool.acquire('d')
+    assert len(pool) == 3
+    pool.release('b')
+    assert h2.closed and len(pool) == 2
+    # idle handles expire without further calls to the pool
+    pool.idle_timeout = 0.05
+    pool.release('c')
+    pool.release('d')
+    for _ in range(100):
+        if len(pool) == 0:
+            break
+        time.sleep(0.05)
+    assert h3.closed and h4.closed
+    assert len(pool) == 0
+
+def test_coalesce_ranges():
+    assert list(coalesce_ranges([1, 2, 4, 10], max_gap=1)) == [
+        (1, 4, [1, 2, 4]), (10, 1, [10])]
+    assert list(coalesce_ranges([1, 2, 4, 10])) == [
+        (1, 2, [1, 2]), (4, 1, [4]), (10, 1, [10])]
+    assert list(coalesce_ranges(range(0, 10, 2), max_gap=1, max_size=4)) == [
+        (0, 3, [0, 2]), (4, 3, [4, 6]), (8, 1, [8])]
+    assert list(coalesce_ranges([])) == []
+
+def _indexed_reader(read_count=50, **kwargs):
+    """Create a started SraReader whose reads are their own indices, and which
+    records the ranges that are fetched.
+    """
+    reader = SraReader('SRR1', **kwargs)
+    reader.read_collection = object()
+    reader.read_count = read_count
+    reader.fetched = []
+    def fetch_range(start, size):
+        reader.fetched.append((start, size))
+        return list(range(start, start + size))
+    reader.fetch_range = fetch_range
+    return reader
+
+def test_sra_reader_iter_ranges():
+    import pytest
+    with pytest.raises(ValueError):
+        SraReader('SRR1').iter_ranges()
+    reader = _indexed_reader(batch_iterator=Batcher(batch_size=20))
+    assert list(reader.iter_ranges()) == [
+        (0, 20, None), (20, 20, None), (40, 10, None)]
+    reader.skip_batches = 2
+    assert list(reader.iter_ranges()) == [(40, 10, None)]
+
+def test_sra_reader_getitem():
+    import pytest
+    reader = _indexed_reader()
+    assert len(reader) == 50
+    assert reader[3] == 3
+    assert reader[-1] == 49
+    with pytest.raises(IndexError):
+        reader[50]
+    assert reader.fetched == [(3, 1), (49, 1)]
+    # slices are lazy
+    del reader.fetched[:]
+    view = reader[10:20]
+    assert isinstance(view, SraSlice)
+    assert len(view) == 10
+    assert reader.fetched == []
+    assert list(view) == list(range(10, 20))
+    assert reader.fetched == [(10, 10)]
+
+def test_sra_slice():
+    reader = _indexed_reader()
+    # nearby indices are coalesced into a single range
+    assert list(reader[0:50:10]) == [0, 10, 20, 30, 40]
+    assert reader.fetched == [(0, 41)]
+    del reader.fetched[:]
+    view = SraSlice(reader, range(0, 50, 10), max_gap=5)
+    assert list(view) == [0, 10, 20, 30, 40]
+    assert len(reader.fetched) == 5
+    # negative steps fetch ascending ranges, but yield batches and reads in
+    # descending order
+    del reader.fetched[:]
+    view = SraSlice(reader, range(50)[::-1], max_size=20)
+    batches = list(view.iter_batches())
+    assert batches == [
+        list(range(49, 39, -1)), list(range(39, 19, -1)),
+        list(range(19, -1, -1))]
+    assert reader.fetched == [(40, 10), (20, 20), (0, 20)]
+    assert list(reader[40:10:-3]) == list(range(40, 10, -3))
+    # nested slicing and indexing
+    view = reader[10:40]
+    nested = view[5:20:2]
+    assert isinstance(nested, SraSlice)
+    assert list(nested) == list(range(15, 30, 2))
+    assert nested.max_gap == view.max_gap
+    assert view[2] == 12
+    assert view[-1] == 39
+    assert list(view[::-1][:3]) == [39, 38, 37]
+    assert len(view[100:]) == 0
+    assert list(view[100:]) == []
+
+def test_sra_reader_sample_shards():
+    import pytest
+    sampler = Sampler(count=20, seed=1, max_gap=0, batch_size=3)
+    sample = sampler.indices(50)
+    for mode in ('contiguous', 'interleaved'):
+        shards = []
+        for shard_index in range(3):
+            reader = _indexed_reader(
+                sample=sampler, shard_index=shard_index, num_shards=3,
+                shard_mode=mode)
+            reader.read_lengths = (4,)
+            shards.append(sum(reader.iter_batches(), []))
+        # the shards partition the sample
+        assert sorted(sum(shards, [])) == sample
+        assert all(shards)
+    with pytest.raises(ValueError):
+        SraReader('SRR1', sample=Sampler(count=20), num_shards=2)
+
+def test_sampler():
+    sampler = Sampler(count=10, seed=1, max_gap=0, batch_size=4)
+    indices = sampler.indices(100)
+    assert len(indices) == 10
+    assert indices == sorted(set(indices))
+    assert indices == Sampler(count=10, seed=1).indices(100)
+    batches = list(sampler(100))
+    assert [member for batch in batches for member in batch[3]] == indices
+    for batch_num, (num, start, size, members) in enumerate(batches):
+        assert num == batch_num
+        assert size <= 4
+        assert start == members[0] and start + size - 1 == members[-1]
+    
+    # each item is sampled with probability fraction
+    indices = Sampler(fraction=0.25, seed=1).indices(10000)
+    assert 2300 < len(indices) < 2700
+    assert indices == sorted(set(indices))
+    assert Sampler(fraction=1).indices(10) == list(range(10))
+    # samples are drawn lazily, without materializing the population
+    sampler = Sampler(count=1000, seed=1)
+    indices = sampler.indices(10 ** 15)
+    assert len(indices) == 1000 and indices == sorted(set(indices))
+    assert next(Sampler(fraction=0.001).iter_indices(10 ** 15)) >= 0
+    sampler = Sampler(count=5, item_start=10, item_stop=20)
+    assert len(sampler.indices(100)) == 5
+    assert all(10 <= i < 20 for i in sampler.indices(100))
+    sampler = Sampler(fraction=0.5, item_start=10, item_stop=20)
+    assert all(10 <= i < 20 for i in sampler.indices(100))
+    assert Sampler(coverage=2, genome_size=1000).sample_size(1000, 100) == 20
+    try:
+        Sampler(count=10, fraction=0.1)
+        assert False
+    except ValueError:
+        pass
+
+def test_sam_writer():
+    writer = ListWriter()
+    record = ('r1', 16, 'chr1', 101, 60, '4M', '*', 0, 0, 'ACGT', 'IIII')
+    with SamWriter(writer, 2, header='@HD\tVN:1.6') as sam:
+        sam.write_batch([(record,)] * 3)
+    assert ''.join(writer.strings[0]).split('\n') == [
+        '@HD\tVN:1.6', 'r1\t16\tchr1\t101\t60\t4M\t*\t0\t0\tACGT\tIIII',
+        'r1\t16\tchr1\t101\t60\t4M\t*\t0\t0\tACGT\tIIII',
+        'r1\t16\tchr1\t101\t60\t4M\t*\t0\t0\tACGT\tIIII', '']
+
+def test_chunked_fasta_writer():
+    writer = ListWriter()
+    with ChunkedFastaWriter(writer, 4, linesep='\n') as fasta:
+        fasta('chr1', 'ACGTA')
+        fasta('chr1', 'CGTACG')
+        fasta('chr2', 'AC')
+    assert ''.join(writer.strings[0]).split('\n') == [
+        '>chr1', 'ACGT', 'ACGT', 'ACG', '>chr2', 'AC', '']
+
+class MockPileupCollection(object):
+    """Mimics the parts of the ngs ReadCollection/Reference/PileupIterator API
+    used by fetch_pileup.
+    """
+    def __init__(self, depths):
+        self.depths = depths
+        self.position = None
+    
+    def getReference(self, name):
+        return self
+    
+    def getPileupSlice(self, start, size, category):
+        self.position = start - 2
+        self.stop = start + size + 2
+        return self
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exception_type, exception_value, traceback):
+        pass
+    
+    def nextPileup(self):
+        self.position += 1
+        return self.position < self.stop
+    
+    def getReferencePosition(self):
+        return self.position
+    
+    def getPileupDepth(self):
+        return self.depths.get(self.position, 0)
+
+def test_fetch_pileup():
+    import pytest
+    pytest.importorskip('numpy')
+    from srastream.alignments import fetch_pileup
+    collection = MockPileupCollection({9: 5, 10: 3, 12: 1, 14: 2, 15: 7})
+    depth = fetch_pileup(collection, 'chr1', 10, 5)
+    assert depth.tolist() == [3, 0, 1, 0, 2]
+
+class MockAlignmentCollection(object):
+    """Mimics the parts of the ngs ReadCollection/Reference/AlignmentIterator
+    API used by AlignmentReader and fetch_alignments. Alignments are tuples
+    (read_id, fragment_id, position, bases, qualities, reversed, category),
+    where position is 0-based; an alignment is paired if it has a fragment
+    ID.
+    """
+    def __init__(self, alignments, length=100):
+        self.alignments = sorted(alignments, key=lambda aln: aln[2])
+        self.length = length
+        self.slice = None
+    
+    def getReference(self, name):
+        return self
+    
+    def getLength(self):
+        return self.length
+    
+    def getAlignmentSlice(self, start, size, category):
+        self.slice = iter([
+            aln for aln in self.alignments
+            if aln[2] < start + size and aln[2] + len(aln[3]) > start and
+            aln[6] & category])
+        return self
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exception_type, exception_value, traceback):
+        pass
+    
+    def nextAlignment(self):
+        self.alignment = next(self.slice, None)
+        return self.alignment is not None
+    
+    def getReadId(self):
+        return self.alignment[0]
+    
+    def isPaired(self):
+        return self.alignment[1] is not None
+    
+    def getFragmentId(self):
+        return self.alignment[1]
+    
+    def getAlignmentPosition(self):
+        return self.alignment[2]
+    
+    def getFragmentBases(self):
+        return self.alignment[3]
+    
+    def getFragmentQualities(self):
+        return self.alignment[4]
+    
+    def getIsReversedOrientation(self):
+        return self.alignment[5]
+    
+    def getAlignmentCategory(self):
+        return self.alignment[6]
+    
+    def getMappingQuality(self):
+        return 60
+    
+    def getShortCigar(self, clipped):
+        return '{}M'.format(len(self.alignment[3]))
+    
+    def getTemplateLength(self):
+        return 0
+
+def test_alignment_reader():
+    from ngs.Alignment import Alignment
+    primary = Alignment.primaryAlignment
+    collection = MockAlignmentCollection([
+        # starts before the region
+        ('r1', 'SRR1.FA0.1', 2, 'ACGTAC', 'ABCDEF', False, primary),
+        # overlaps both chunks of the region
+        ('r1', 'SRR1.FA1.1', 12, 'AACGTT', 'ABCDEF', True, primary),
+        ('r2', None, 20, 'ACGT', 'ABCD', False, Alignment.secondaryAlignment),
+        ('r3', 'SRR1.FA0.3', 21, 'ACGT', 'ABCD', False, primary),
+        # after the region
+        ('r4', None, 26, 'ACGT', 'ABCD', False, primary)])
+    reader = AlignmentReader(
+        'SRR1', [('chr1', 5, 25)], category='all', chunk_size=10)
+    reader.read_collection = collection
+    assert list(reader.chunks()) == [
+        ('chr1', 5, 10, True), ('chr1', 15, 10, False)]
+    # an alignment that overlaps both chunks is only returned with the first
+    assert list(reader.iter_batches()) == [
+        [('r1', 0x41, 'chr1', 3, 60, '6M', '*', 0, 0, 'ACGTAC', 'ABCDEF'),
+         ('r1', 0x91, 'chr1', 13, 60, '6M', '*', 0, 0, 'AACGTT', 'FEDCBA')],
+        [('r2', 0x100, 'chr1', 21, 60, '4M', '*', 0, 0, 'ACGT', 'ABCD'),
+         ('r3', 0x41, 'chr1', 22, 60, '4M', '*', 0, 0, 'ACGT', 'ABCD')]]
+    reader.category = 'primary'
+    assert [record[0] for record in reader] == ['r1', 'r1', 'r3']
+
+def test_fetch_alignments():
+    from ngs.Alignment import Alignment
+    from srastream.alignments import fetch_alignments
+    collection = MockAlignmentCollection([
+        ('r1', 'SRR1.FA0.1', 8, 'ACGT', 'ABCD', True, 1),
+        ('r2', 'SRR1.FA1.2', 10, 'ACGT', 'ABCD', False, 1),
+        ('r3', 'SRR1.X.3', 11, 'ACGT', 'ABCD', False, 1)])
+    records = fetch_alignments(
+        collection, 'chr1', 10, 5, include_overlapping=False,
+        category=Alignment.all)
+    # pos is 1-based; pairing without a known fragment index is only 0x1
+    assert [record[:4] for record in records] == [
+        ('r2', 0x81, 'chr1', 11), ('r3', 0x1, 'chr1', 12)]
+    records = fetch_alignments(collection, 'chr1', 10, 5)
+    assert records[0][:4] == ('r1', 0x51, 'chr1', 9)
+    assert records[0][9:] == ('ACGT', 'DCBA')
+    assert alignment_to_fastq(records[0]) == ('r1', 'ACGT', 'ABCD')
+
+def test_read_bed():
+    import tempfile
+    with tempfile.TemporaryDirectory() as path:
+        bed = os.path.join(path, 'regions.bed')
+        with open(bed, 'wt') as out:
+            out.write('track name=test\nchr1\t100\t200\tgene1\n\nchr2\t0\t50\n')
+        assert read_bed(bed) == [('chr1', 100, 200), ('chr2', 0, 50)]
+
+def test_alignment_to_fastq():
+    record = ('r1', 16, 'chr1', 101, 60, '4M', '*', 0, 0, 'AACG', 'ABCD')
+    assert alignment_to_fastq(record) == ('r1', 'CGTT', 'DCBA')
+    record = ('r1', 0, 'chr1', 101, 60, '4M', '*', 0, 0, 'AACG', 'ABCD')
+    assert alignment_to_fastq(record) == ('r1', 'AACG', 'ABCD')